@@ -0,0 +1,5 @@
+#!/bin/bash
+
+. env.sh
+
+python3 test/bench/bench_suite.py --output bench-`git rev-parse --short HEAD`.json "$@"
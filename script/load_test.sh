@@ -0,0 +1,5 @@
+#!/bin/bash
+
+. env.sh
+
+python3 ../weblib/weblib/test/load.py "$@"
@@ -0,0 +1,58 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Measures the rendering of the test application's ComprehensiveForm. Does not need any DB: the choices are static.
+
+Usage: APP_MODULE=testapp python3 test/bench/bench_form.py [RENDERS] [REPEAT]
+
+"""
+import datetime as dt
+import logging
+import sys
+import timeit
+
+from flask import Flask
+from flask_babel import Babel
+
+from testapp.forms import ComprehensiveForm, color_choices, parent_choices
+
+COLORS = [(i, f"Color {i}") for i in range(20)]
+PARENTS = [(i, f"Parent {i}") for i in range(5)]
+DB_DICT = {
+	'id': 1,
+	'text': "Lorem ipsum",
+	'text_area': "Lorem ipsum\ndolor sit amet",
+	'boolean': True,
+	'integer': 7,
+	'decimal': 7.5,
+	'price': 7.07,
+	'select_field': 3,
+	'double_select': None,
+	'datalist': None,
+	'date': dt.date(2025, 2, 13),
+	'datetime': dt.datetime(2025, 2, 13, 8, 5),
+	'barcode': "1234567",
+	'qrcode': "https://qr.com",
+}
+
+
+def main(renders_nb=2000, repeat=5):
+	logging.disable(logging.INFO)
+	app = Flask(__name__)
+	Babel(app)
+	color_choices._provider = lambda: COLORS
+	parent_choices._provider = lambda: PARENTS
+	with app.test_request_context("/comprehensive_2/open/comprehensive/update"):
+		form = ComprehensiveForm(DB_DICT)
+		for name, statement in (
+			("instantiation", lambda: ComprehensiveForm(DB_DICT)),
+			("rendering", lambda: str(form)),
+		):
+			best = min(timeit.repeat(statement, number=renders_nb, repeat=repeat))
+			print(f"ComprehensiveForm {name}: {renders_nb} times, best of {repeat}: {best:.3f} s ({best / renders_nb * 1e6:.0f} µs each)")
+
+
+if __name__ == "__main__":
+	main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,179 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Measures the hot paths of the tables, forms and translations with synthetic data of each size and writes a JSON report
+that can be compared with the one of another commit. Does not need any Postgres DB: get_users() is measured on an in
+memory SQLite one. The size is the number of rows of the tables and users, and the number of choices of the forms'
+select field.
+
+Usage: APP_MODULE=testapp python3 test/bench/bench_suite.py [--sizes 1000 10000 100000] [--output REPORT.json]
+	[--compare PREVIOUS_REPORT.json] [--threshold 1.2]
+
+"""
+import argparse
+import datetime as dt
+import json
+import logging
+import platform
+import subprocess
+import sys
+import timeit
+
+from flask import Flask, current_app, jsonify
+from flask_babel import Babel
+from peewee import SqliteDatabase, chunked
+from werkzeug.datastructures import MultiDict
+
+from bench_form import DB_DICT, PARENTS
+from bench_table import COLUMNS, build_rows
+from testapp.forms import ComprehensiveForm, color_choices, parent_choices
+from weblib.models import WEBLIB_MODELS, RoleModel, User, UserRole
+from weblib.requests import TableRequestResult, build_row_translator, get_users, translate_row
+from weblib.table import Table
+
+FORM_DICT = MultiDict({
+	'id': "1",
+	'text': "Lorem ipsum",
+	'text_area': "Lorem ipsum\r\ndolor sit amet",
+	'boolean': "on",
+	'integer': "7",
+	'decimal': "7.5",
+	'price': "7.07",
+	'select_field': "3",
+	'date': "2025-02-13",
+	'datetime': "2025-02-13T08:05",
+	'barcode': "1234567",
+	'qrcode': "https://qr.com",
+})
+
+
+def measure(statement, repeat):
+	"""
+	:return: the best duration of one call of *statement* (in seconds), each of the *repeat* measures calling it enough
+		times to last at least 0.2 s
+
+	"""
+	timer = timeit.Timer(statement)
+	number, _duration = timer.autorange()
+	return min(timer.repeat(number=number, repeat=repeat)) / number
+
+
+def bench_table(size, repeat):
+	rows = build_rows(size)
+	table = Table("bench").build_from_request(TableRequestResult(COLUMNS, rows))
+	translate = build_row_translator(COLUMNS)
+	return {
+		'Table.build_from_request': measure(lambda: Table("bench").build_from_request(TableRequestResult(COLUMNS, rows)), repeat),
+		'translate_row': measure(lambda: [translate_row(row[1:], COLUMNS) for row in rows], repeat),
+		'build_row_translator': measure(lambda: [translate(row[1:]) for row in rows], repeat),
+		'jsonify(table.dict)': measure(lambda: jsonify(table.dict), repeat),
+	}
+
+
+def bench_users(size, repeat):
+	database = SqliteDatabase(":memory:")
+	with database.bind_ctx(WEBLIB_MODELS):
+		database.create_tables(WEBLIB_MODELS)
+		roles = [RoleModel.create(name=name).id for name in ("admin", "user")]
+		with database.atomic():
+			for batch in chunked(range(size), 100):
+				User.insert_many([{
+					'username': f"user{i}",
+					'password': "",
+					'first_name': f"First {i}",
+					'last_name': f"Last {i % 1000}",
+				} for i in batch]).execute()
+			for batch in chunked(range(1, size + 1), 100):
+				UserRole.insert_many([{'user': i, 'role': roles[i % 2]} for i in batch]).execute()
+		return {
+			'get_users': measure(lambda: list(get_users().query), repeat),
+		}
+
+
+def bench_form(size, repeat):
+	color_choices._provider = lambda: [(i, f"Color {i}") for i in range(size)]
+	color_choices.invalidate()
+	parent_choices._provider = lambda: PARENTS
+	with current_app.test_request_context(method="POST", data=FORM_DICT):
+		form = ComprehensiveForm(DB_DICT)
+		return {
+			'BaseForm(MultiDict)': measure(lambda: ComprehensiveForm(request_object=FakeRequest), repeat),
+			'BaseForm.validate': measure(lambda: ComprehensiveForm(request_object=FakeRequest).validate(), repeat),
+			'BaseForm.__str__': measure(lambda: str(form), repeat),
+		}
+
+
+class FakeRequest:
+	form = FORM_DICT
+	files = MultiDict()
+
+
+def get_commit():
+	try:
+		return subprocess.run(("git", "rev-parse", "--short", "HEAD"), capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def compare(results, previous_results, threshold):
+	"""
+	:return: the number of regressions, ie. the measures slower than *threshold* times the previous ones
+
+	"""
+	regressions_nb = 0
+	for key, duration in results.items():
+		previous_duration = previous_results.get(key)
+		if not previous_duration:
+			continue
+		ratio = duration / previous_duration
+		is_regression = ratio > threshold
+		regressions_nb += is_regression
+		print(f"{key:45} {previous_duration * 1e3:10.3f} ms -> {duration * 1e3:10.3f} ms  x{ratio:.2f}{'  REGRESSION' if is_regression else ''}", file=sys.stderr)
+	return regressions_nb
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmarks of the hot paths")
+	parser.add_argument('--sizes', type=int, nargs='+', default=(1000, 10000, 100000))
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--output', help="JSON report file (default: stdout)")
+	parser.add_argument('--compare', help="previous JSON report to compare with")
+	parser.add_argument('--threshold', type=float, default=1.2, help="ratio above which a measure is a regression")
+	args = parser.parse_args()
+
+	logging.disable(logging.INFO)
+	app = Flask(__name__)
+	Babel(app)
+	results = {}
+	with app.test_request_context():
+		for size in args.sizes:
+			for bench in (bench_table, bench_users, bench_form):
+				for name, duration in bench(size, args.repeat).items():
+					results[f"{name}[{size}]"] = duration
+					print(f"{name}[{size}]: {duration * 1e3:.3f} ms", file=sys.stderr)
+
+	report = {
+		'commit': get_commit(),
+		'date': dt.datetime.now().isoformat(timespec='seconds'),
+		'python': platform.python_version(),
+		'machine': platform.machine(),
+		'results': results,
+	}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=1)
+	else:
+		print(json.dumps(report, indent=1))
+
+	if args.compare:
+		with open(args.compare) as f:
+			previous_report = json.load(f)
+		print(f"Comparing with {previous_report.get('commit')} ({previous_report.get('date')})", file=sys.stderr)
+		if compare(results, previous_report['results'], args.threshold):
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
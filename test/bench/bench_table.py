@@ -0,0 +1,76 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Measures Table.build_from_request on a synthetic table. Does not need any DB.
+
+Usage: python3 test/bench/bench_table.py [ROWS] [REPEAT]
+
+"""
+import datetime as dt
+import sys
+import timeit
+
+from flask import Flask
+from flask_babel import Babel
+from peewee import BooleanField, DateField, DateTimeField, IntegerField, Model, TextField
+
+from weblib.requests import TableRequestResult
+from weblib.table import Table
+
+
+class BenchModel(Model):
+	text_1 = TextField()
+	text_2 = TextField()
+	text_3 = TextField(null=True)
+	text_4 = TextField()
+	text_5 = TextField()
+	integer_1 = IntegerField()
+	integer_2 = IntegerField(null=True)
+	integer_3 = IntegerField()
+	boolean_1 = BooleanField()
+	boolean_2 = BooleanField(null=True)
+	date_1 = DateField()
+	date_2 = DateField(null=True)
+	datetime_1 = DateTimeField()
+	datetime_2 = DateTimeField(null=True)
+	status = IntegerField()
+	status.lut = {0: "Available", 1: "Lent", 2: "Broken"}
+
+
+COLUMNS = [field for name, field in BenchModel._meta.fields.items() if name != 'id']
+for column in COLUMNS:
+	column.i18n = column.name
+
+
+def build_rows(rows_nb):
+	date = dt.date(2024, 3, 1)
+	datetime = dt.datetime(2024, 3, 1, 12, 30)
+	return [(
+		i,
+		f"text {i}", "polop", None if i % 3 else "optional", "Lorem ipsum", "dolor",
+		i, None if i % 2 else i * 2, -i,
+		bool(i % 2), None if i % 5 else True,
+		date, None if i % 7 else date,
+		datetime, None if i % 4 else datetime,
+		i % 3,
+	) for i in range(rows_nb)]
+
+
+def main(rows_nb=20000, repeat=5):
+	app = Flask(__name__)
+	Babel(app)
+	rows = build_rows(rows_nb)
+	with app.test_request_context():
+		timings = timeit.repeat(
+			lambda: Table("bench").build_from_request(TableRequestResult(COLUMNS, rows)),
+			number=1,
+			repeat=repeat,
+		)
+	best = min(timings)
+	print(f"Table.build_from_request: {rows_nb} rows x {len(COLUMNS)} columns, best of {repeat}: {best:.3f} s ({rows_nb / best:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+	main(*[int(arg) for arg in sys.argv[1:]])
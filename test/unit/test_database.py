@@ -0,0 +1,53 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+from unittest import mock
+
+import pytest
+from playhouse.pool import MaxConnectionsExceeded
+
+from weblib.database import InstrumentedPooledPostgresqlDatabase
+
+
+@pytest.fixture(scope='function')
+def database():
+	database = InstrumentedPooledPostgresqlDatabase("polop", max_connections=2, stale_timeout=300, timeout=None)
+	with mock.patch("peewee.PostgresqlDatabase._connect", side_effect=lambda: mock.Mock()), \
+		mock.patch("peewee.PostgresqlDatabase._set_server_version"):
+		yield database
+
+
+def test01a(database):
+	""" Pool metrics count the connections in use, idle and the checkouts """
+	assert database.connect()
+	assert database.get_metrics()['in_use'] == 1
+	assert not database.connect(reuse_if_open=True)
+	database.close()
+	metrics = database.get_metrics()
+	assert (metrics['in_use'], metrics['idle'], metrics['checkouts'], metrics['max_connections']) == (0, 1, 1, 2)
+
+
+def test01b(database):
+	""" Pool metrics count the checkouts per request """
+	database.connect()
+	database.close()
+	database.connect()
+	database.close()
+	database.end_request()
+	database.end_request()
+	metrics = database.get_metrics()
+	assert metrics['requests'] == 2
+	assert metrics['checkouts_per_request_avg'] == 1
+	assert metrics['checkouts_per_request_max'] == 2
+
+
+def test01c(database):
+	""" The pool is bounded by max_connections """
+	database.connect()
+	database._state.reset()
+	database.connect()
+	database._state.reset()
+	with pytest.raises(MaxConnectionsExceeded):
+		database.connect()
+	assert database.get_metrics()['in_use'] == 2
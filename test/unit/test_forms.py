@@ -3,14 +3,19 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
 import datetime as dt
+import gc
+import hashlib
+import json
 import time_machine
-from unittest.mock import Mock
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import Mock, patch
 
 import pytest
-from werkzeug.datastructures import MultiDict
+from werkzeug.datastructures import FileStorage, MultiDict
 
-from weblib.forms.fields import (DateField, DecimalField, DoubleSelectField, FileField, IntegerField, PriceField,
-	SelectField, TextAreaField, TextField)
+from weblib.forms.fields import (CachedChoices, DatalistField, DateField, DecimalField, DoubleSelectField, FileField,
+	IntegerField, PrefixIndex, PriceField, SelectField, TextAreaField, TextField, invalidate_choices)
 from weblib.forms.forms import BaseForm, UnknownFieldException
 from weblib.models import flask_db
 
@@ -101,6 +106,60 @@ def test_text_input_field_05a(init_forms, mock_request):
 	assert compact(form) == compact(wrap_in_form("""<input type="text" name="text_input" class="form-control" required autofocus></input>"""))
 
 
+def test_text_input_field_06a(init_forms, mock_request):
+	"""TextField: the precompiled skeleton is filled with the value, the errors and readonly of each rendering"""
+	TestForm.fields = {'text_input': TextField("The label", placeholder="{not a slot}")}
+	form = TestForm(request_object=mock_request)
+	assert compact(form) == compact(wrap_in_form("""<input type="text" name="text_input" class="form-control" placeholder="{not a slot}" autofocus></input>"""))
+	form.text_input.data = "{value}"
+	form.text_input.error_messages = ["Error"]
+	form.text_input.readonly = True
+	assert compact(form) == compact(wrap_in_form("""<input type="text" name="text_input" class="form-control is-invalid" value="{value}" placeholder="{not a slot}" autofocus readonly></input><div class="invalid-field">Error</div>"""))
+	assert compact(TestForm(request_object=mock_request)) == compact(wrap_in_form("""<input type="text" name="text_input" class="form-control" placeholder="{not a slot}" autofocus></input>"""))
+
+
+def test_text_input_field_06b(init_forms, mock_request):
+	"""TextField: one skeleton is compiled per locale since the label may be a lazy translation"""
+	locale = Mock(return_value="en")
+
+	class LazyLabel:
+		def __str__(self):
+			return {"en": "The label", "fr": "Le libellé"}[locale()]
+
+	TestForm.fields = {'text_input': TextField(LazyLabel())}
+	form = TestForm(request_object=mock_request)
+	with patch("weblib.forms.fields.get_locale", locale):
+		assert 'The label' in str(form)
+		locale.return_value = "fr"
+		assert 'Le libellé' in str(form)
+		locale.return_value = "en"
+		assert 'The label' in str(form)
+
+
+
+
+def test_form_instances_01a(init_forms, mock_request):
+	"""Two instances of a form do not share the data nor the errors of their fields"""
+	TestForm.fields = {'text_input': TextField("The label", validators=(lambda form, field_data: "Error", ))}
+	form_1 = TestForm(MultiDict((('text_input', "Value 1"), )))
+	form_2 = TestForm(MultiDict((('text_input', "Value 2"), )))
+	assert not form_1.validate()
+	assert form_1.text_input.data == "Value 1"
+	assert form_1.text_input.error_messages == ["Error"]
+	assert form_2.text_input.data == "Value 2"
+	assert form_2.text_input.error_messages == []
+	assert TestForm.fields['text_input'].data is None
+
+
+def test_form_instances_01b(init_forms, mock_request):
+	"""Posted values of a multiple select do not alter its default value"""
+	default = {"1"}
+	TestForm.fields = {'select': SelectField("The label", choices=((1, "text1"), (2, "text2")), multiple=True, default=default)}
+	form = TestForm(MultiDict((('select', 2), )))
+	assert form.select.data == {"1", "2"}
+	assert default == {"1"}
+
+
 
 
 @time_machine.travel(dt.datetime(2025, 2, 12))
@@ -350,6 +409,32 @@ def test_select_field_11d(init_forms, mock_request):
 
 
 
+def test_select_field_20a(init_forms, mock_request):
+	"""SelectField: cached choices provider -> called once until its tag is invalidated"""
+	choices_cb = Mock(return_value=((1, "text1"), (2, "text2")))
+	TestForm.fields = {'select': SelectField("The label", choices=CachedChoices(choices_cb, tags=("table_20a", )))}
+	for i in range(2):
+		form = TestForm(request_object=mock_request)
+		assert form.select.choices == ((1, "text1"), (2, "text2"))
+	assert choices_cb.call_count == 1
+	invalidate_choices("table_20a")
+	invalidate_choices("another_table")
+	form = TestForm(request_object=mock_request)
+	assert form.select.choices == ((1, "text1"), (2, "text2"))
+	assert choices_cb.call_count == 2
+
+
+def test_select_field_20b(init_forms, mock_request):
+	"""SelectField: cached choices provider -> called again when the TTL is over"""
+	choices_cb = Mock(return_value=((1, "text1"), ))
+	cached_choices = CachedChoices(choices_cb, ttl=60)
+	with patch("weblib.forms.fields.time.monotonic", side_effect=(1000, 1059, 1061)):
+		for i in range(3):
+			cached_choices()
+	assert choices_cb.call_count == 2
+
+
+
 
 def test_double_select_field_01a(init_forms, mock_request):
 	"""DoubleSelectField: set choices url"""
@@ -444,14 +529,149 @@ def test_double_select_field_02b(init_forms, mock_request):
 
 
 
+def test_double_select_field_03a(init_forms, mock_request):
+	"""DoubleSelectField: the children of all the parents are fetched from the /choices endpoint"""
+	TestForm.fields = {'double_select': DoubleSelectField(("Parent label", "Child label"), children_choices=((1, 3, "text3"), ))}
+	form = TestForm(request_object=mock_request)
+	form.double_select.choices_url = "/populate/child.json"
+	assert f'choices-url="/populate/child.json" children-url="/choices/{__name__}.TestForm/double_select"' in str(form)
+	assert BaseForm.get_form_class(f"{__name__}.TestForm") is TestForm
+	assert BaseForm.get_form_class("testform") is None
+	assert form.double_select.children_roles == {"admin"}
+
+
+def test_double_select_field_03b(init_forms, mock_request):
+	"""DoubleSelectField: the children JSON is built again only when the cached children choices are refreshed"""
+	children_cb = Mock(side_effect=lambda: [(1, 3, "text3"), (1, 4, "text4"), (2, 5, "text5")])
+	children_choices = CachedChoices(children_cb, tags=("table_children", ))
+	field = DoubleSelectField(("Parent label", "Child label"), children_choices=children_choices)
+	body, etag = field.get_children_json()
+	assert json.loads(body) == {'1': [[3, "text3"], [4, "text4"]], '2': [[5, "text5"]]}
+	assert field.get_children_json() == (body, etag)
+	invalidate_choices("table_children")
+	assert field.get_children_json() == (body, etag)
+	assert children_cb.call_count == 2
+
+
+def test_double_select_field_03c(init_forms, mock_request):
+	"""DoubleSelectField: the page's path used as choices url is escaped"""
+	TestForm.fields = {'double_select': DoubleSelectField(("Parent label", "Child label"))}
+	form = TestForm(request_object=mock_request)
+	with patch("weblib.forms.fields.request", Mock(path='/page"><script>alert(1)</script>')):
+		assert 'choices-url="/page&#34;&gt;&lt;script&gt;alert(1)&lt;/script&gt;"' in str(form)
+
+
 
-def test_file_field_01a(init_forms, mock_request):
+def test_datalist_field_01a():
+	"""DatalistField: the prefix index matches the start of the words, whatever the case and the diacritics"""
+	index = PrefixIndex(((1, "Électricité générale"), (2, "Eau"), (3, "Gaz de ville"), (4, "Général")))
+	assert index.search("gen") == [(4, "Général"), (1, "Électricité générale")]
+	assert index.search("ELEC") == [(1, "Électricité générale")]
+	assert index.search("e", limit=1) == [(2, "Eau")]
+	assert index.search("de v") == [(3, "Gaz de ville")]
+	assert index.search("ville gaz") == []
+	assert index.get_text(3) == "Gaz de ville"
+
+
+def test_datalist_field_01b(init_forms, mock_request):
+	"""DatalistField: the index of cached choices is rebuilt once they are invalidated"""
+	choices_cb = Mock(side_effect=lambda: [(1, "text1"), (2, "text2")])
+	TestForm.fields = {'datalist': DatalistField("The label", choices=CachedChoices(choices_cb, tags=("table_datalist", )))}
+	form = TestForm(request_object=mock_request)
+	index = form.datalist.get_index()
+	assert form.datalist.search("text", limit=10) == [(1, "text1"), (2, "text2")]
+	assert form.datalist.get_index() is index
+	invalidate_choices("table_datalist")
+	assert form.datalist.get_index() is not index
+
+
+def test_datalist_field_02a(init_forms, mock_request):
+	"""DatalistField: the choices beyond max_embedded_choices are not embedded in the page"""
+	TestForm.fields = {'datalist': DatalistField("The label", choices=((1, "text1"), (2, "text2")), max_embedded_choices=1)}
+	mock_request.form.update({'datalist': "2"})
+	form = TestForm(request_object=mock_request)
+	form.datalist.choices_url = "/choices"
+	assert compact(form) == compact("""
+<div name="datalist-datalist" class="form-group mb-3 datalist">
+	<label for="datalist">The label</label>
+	<input type="text" name="datalist-text" class="form-control" choices-url="/choices" value="text2" autocomplete="off" autofocus></input>
+	<input type="hidden" name="datalist" value="2"></input>
+	<ul class="dropdown-menu"></ul>
+</div>
+<input type="hidden" name="id" class="form-control" value="None"></input>
+""")
+
+
+
+
+def test_datalist_field_02b(init_forms, mock_request):
+	"""DatalistField: the page's path used as choices url is escaped"""
+	TestForm.fields = {'datalist': DatalistField("The label", choices=((1, "text1"), ))}
+	form = TestForm(request_object=mock_request)
+	with patch("weblib.forms.fields.request", Mock(path='/page"><script>alert(1)</script>')):
+		assert 'choices-url="/page&#34;&gt;&lt;script&gt;alert(1)&lt;/script&gt;"' in str(form)
+
+
+@pytest.fixture(scope='function')
+def upload_dir(tmp_path, monkeypatch):
+	monkeypatch.setenv('UPLOAD_DIR', str(tmp_path))
+	return tmp_path
+
+
+def file_storage(content, filename="report.pdf"):
+	return FileStorage(BytesIO(content), filename=filename, name='file_input')
+
+
+def test_file_field_01a(init_forms, mock_request, upload_dir):
 	"""FileField"""
 	TestForm.fields = {'file_input': FileField("The label")}
-	file_storage = Mock()
-	file_storage.read.return_value = b"polop"
-	file_storage.filename = "report.pdf"
-	mock_request.files = {'file_input': file_storage}
+	mock_request.files = {'file_input': file_storage(b"polop")}
 	form = TestForm(request_object=mock_request)
 	assert compact(form) == compact(wrap_in_form("""<input type="file" name="file_input" class="form-control" value="33c0f9010ea85b9e93fa782eb6219a280a2f30caedc03add1cdf3dec6e6d18e6.pdf" autofocus></input>""", label_for="file_input"))
 
+
+def test_file_field_02a(init_forms, mock_request, upload_dir):
+	"""FileField: the file is streamed by chunks then moved to the upload store when the form is valid"""
+	TestForm.fields = {'file_input': FileField("The label")}
+	content = bytes(range(256)) * 1000
+	mock_request.files = {'file_input': file_storage(content)}
+	form = TestForm(request_object=mock_request)
+	assert len(list(upload_dir.iterdir())) == 1
+	assert form.validate()
+	filename = f"{hashlib.sha256(content).hexdigest()}.pdf"
+	assert [p.relative_to(upload_dir) for p in upload_dir.rglob("*") if p.is_file()] == [Path(filename[0:2], filename[2:4], filename)]
+	assert (upload_dir / filename[0:2] / filename[2:4] / form.file_input.data).read_bytes() == content
+
+
+def test_file_field_02b(init_forms, mock_request, upload_dir):
+	"""FileField: an oversize file is not read beyond the max size and makes the form invalid"""
+	TestForm.fields = {'file_input': FileField("The label", max_size=100000)}
+	stream = BytesIO(b"x" * 1000000)
+	mock_request.files = {'file_input': FileStorage(stream, filename="report.pdf", name='file_input')}
+	form = TestForm(request_object=mock_request)
+	assert stream.tell() <= 100000 + FileField.CHUNK_SIZE
+	assert not form.validate()
+	assert form.file_input.error_messages == ["File size is above the max (100000 bytes)"]
+	assert list(upload_dir.iterdir()) == []
+
+
+def test_file_field_02c(init_forms, mock_request, upload_dir):
+	"""FileField: a custom action is given the received file, opened, and no file is kept"""
+	contents = []
+	TestForm.fields = {'file_input': FileField("The label", action=lambda f: contents.append(f.read()))}
+	mock_request.files = {'file_input': file_storage(b"polop")}
+	form = TestForm(request_object=mock_request)
+	assert form.validate()
+	assert contents == [b"polop"]
+	assert list(upload_dir.iterdir()) == []
+
+
+def test_file_field_02d(init_forms, mock_request, upload_dir):
+	"""FileField: the temporary file is removed when the form is not valid"""
+	TestForm.fields = {'file_input': FileField("The label", validators=(lambda form, field_data: "Error", ))}
+	mock_request.files = {'file_input': file_storage(b"polop")}
+	form = TestForm(request_object=mock_request)
+	assert not form.validate()
+	del form
+	gc.collect()
+	assert list(upload_dir.iterdir()) == []
@@ -0,0 +1,87 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+from os.path import join
+
+import pytest
+from flask import Flask, render_template_string
+from flask_babel import Babel
+
+from weblib.fragments import FragmentCache, FragmentCacheExtension, LRUBackend, SqliteBackend, fragment_cache
+
+
+@pytest.fixture(scope='function')
+def app():
+	app = Flask(__name__)
+	app.config['APP_VERSION'] = "1.0"
+	Babel(app)
+	app.jinja_env.add_extension(FragmentCacheExtension)
+	fragment_cache.configure()
+	with app.test_request_context():
+		yield app
+
+
+def test01a():
+	""" The least recently used fragments are evicted """
+	backend = LRUBackend(max_size=2)
+	backend.set("a", "A")
+	backend.set("b", "B")
+	backend.get("a")
+	backend.set("c", "C")
+	assert (backend.get("a"), backend.get("b"), backend.get("c")) == ("A", None, "C")
+
+
+def test01b(app):
+	""" A fragment is rendered once per vary keys """
+	cache = FragmentCache()
+	calls = []
+
+	def render():
+		calls.append(1)
+		return "<p>%d</p>" % len(calls)
+
+	assert cache.get_or_render('p', (1, ), render) == "<p>1</p>"
+	assert cache.get_or_render('p', (1, ), render) == "<p>1</p>"
+	assert cache.get_or_render('p', (2, ), render) == "<p>2</p>"
+	assert cache.get_metrics()['fragments'] == {'p': {'hits': 1, 'misses': 2}}
+
+
+def test01c(app):
+	""" The app version is part of the key """
+	cache = FragmentCache()
+	cache.get_or_render('p', (), lambda: "1.0")
+	app.config['APP_VERSION'] = "1.1"
+	assert cache.get_or_render('p', (), lambda: "1.1") == "1.1"
+
+
+def test02a(app, tmp_path):
+	""" The SQLite backend is shared between the caches using the same file """
+	path = join(tmp_path, "fragments.db")
+	FragmentCache(SqliteBackend(path)).get_or_render('p', ("a", ), lambda: "<p>a</p>")
+	cache = FragmentCache(SqliteBackend(path))
+	assert cache.get_or_render('p', ("a", ), lambda: "<p>b</p>") == "<p>a</p>"
+	assert cache.hits['p'] == 1
+	cache.clear()
+	assert len(cache.backend) == 0
+
+
+def test02b(app, tmp_path):
+	""" A shared backend is only cleared by the start of another app version """
+	path = join(tmp_path, "fragments.db")
+	cache = FragmentCache(SqliteBackend(path))
+	cache.set_app_version("1.0")
+	cache.get_or_render('p', (), lambda: "<p>a</p>")
+	FragmentCache(SqliteBackend(path)).set_app_version("1.0")
+	assert cache.get_or_render('p', (), lambda: "<p>b</p>") == "<p>a</p>"
+	FragmentCache(SqliteBackend(path)).set_app_version("1.1")
+	assert cache.get_or_render('p', (), lambda: "<p>b</p>") == "<p>b</p>"
+
+
+def test03a(app):
+	""" The cache tag of the templates caches its body per vary keys """
+	template = "{% cache 'greeting', name %}<p>{{ name }} {{ count }}</p>{% endcache %}"
+	assert render_template_string(template, name="polop", count=1) == "<p>polop 1</p>"
+	assert render_template_string(template, name="polop", count=2) == "<p>polop 1</p>"
+	assert render_template_string(template, name="<b>", count=3) == "<p>&lt;b&gt; 3</p>"
+	assert fragment_cache.get_metrics()['fragments'] == {'greeting': {'hits': 1, 'misses': 2}}
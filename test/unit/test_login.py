@@ -11,9 +11,10 @@ from flask import Flask
 from peewee import IntegrityError
 
 from weblib.login import load_user
-from weblib.models import WEBLIB_MODELS, DatabaseVersionException, DatabaseVersionModel, User, flask_db
+from weblib.models import WEBLIB_MODELS, DatabaseVersionException, DatabaseVersionModel, RoleModel, User, flask_db
 from weblib.requests import (
-	get_app_db_version, get_lib_db_version, init_db_version, set_app_db_version, set_lib_db_version
+	get_app_db_version, get_lib_db_version, init_db_version, set_app_db_version, set_lib_db_version, update_roles,
+	user_cache
 )
 
 for module in ("peewee", "passlib"):
@@ -33,6 +34,7 @@ def populate_db(request):
 	}
 
 	flask_db.init_app(app)
+	user_cache.clear()
 
 	for model in WEBLIB_MODELS:
 		model.drop_table(safe=True, cascade=True)
@@ -54,3 +56,14 @@ def test01b(populate_db):
 	""" load_user unknown """
 	user = load_user("666")
 	assert user is None
+
+
+def test01c(populate_db):
+	""" load_user is cached and invalidated when the user's roles are modified """
+	user = load_user("1")
+	assert user.roles == ()
+	assert load_user("1") is user
+	update_roles({'user_id': 1, 'roles': [RoleModel.create(name="admin").id]})
+	user = load_user("1")
+	assert user.roles == ("admin", )
+	assert user.is_admin
@@ -0,0 +1,121 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import sys
+import threading
+import time
+
+import pytest
+from bcrypt import gensalt, hashpw
+
+from weblib.passwords import HashingOverloadException, PasswordHasher
+
+
+@pytest.fixture(scope='function')
+def hasher():
+	return PasswordHasher(cost=4, workers=1, max_pending=2, max_per_user=1, max_per_ip=2)
+
+
+def test01a(hasher):
+	""" Passwords are hashed with the configured cost and verified """
+	password_hash = hasher.hash("polop")
+	assert password_hash.startswith("$2b$04$")
+	assert hasher.verify("polop", password_hash)
+	assert not hasher.verify("polip", password_hash)
+
+
+def test01b(hasher):
+	""" Hashes computed with another cost need to be rehashed """
+	assert not hasher.needs_rehash(hasher.hash("polop"))
+	assert hasher.needs_rehash(hashpw(b"polop", gensalt(5)).decode())
+	assert hasher.needs_rehash("")
+
+
+def blocking_hasher(hasher):
+	""" Makes the hashes of *hasher* wait for the returned event """
+	event = threading.Event()
+	run = hasher._run
+
+	def blocked_run(keys, function, *args):
+		return run(keys, lambda *args: event.wait() and function(*args), *args)
+
+	return event, blocked_run
+
+
+def wait_for(condition):
+	deadline = time.monotonic() + 5
+	while not condition():
+		assert time.monotonic() < deadline
+		time.sleep(0.001)
+
+
+def test02a(hasher):
+	""" A user can not have more hashes pending than allowed """
+	event, hasher._run = blocking_hasher(hasher)
+	thread = threading.Thread(target=hasher.hash, args=("polop", (('user', "jbeck"), )))
+	thread.start()
+	while not hasher._pending_by_key:
+		pass
+	with pytest.raises(HashingOverloadException):
+		hasher.hash("polop", keys=(('user', "jbeck"), ))
+	event.set()
+	thread.join()
+	assert not hasher._pending_by_key
+	assert hasher.hash("polop", keys=(('user', "jbeck"), ))
+	assert not hasher._pending_by_key
+
+
+def test02b(hasher):
+	""" The hashes pending are bounded """
+	event, hasher._run = blocking_hasher(hasher)
+	threads = [threading.Thread(target=hasher.hash, args=("polop", (('ip', "1.2.3.4"), ))) for _ in range(2)]
+	for thread in threads:
+		thread.start()
+	while hasher._pending._value:
+		pass
+	with pytest.raises(HashingOverloadException):
+		hasher.hash("polop", keys=(('user', "jbeck"), ))
+	event.set()
+	for thread in threads:
+		thread.join()
+
+
+def test02c(hasher):
+	""" A hash not computed in time raises HashingOverloadException but stays pending until it is computed """
+	event, hasher._run = blocking_hasher(hasher)
+	hasher.timeout = 0.01
+	with pytest.raises(HashingOverloadException):
+		hasher.hash("polop", keys=(('ip', "1.2.3.4"), ))
+	assert hasher._pending_by_key == {('ip', "1.2.3.4"): 1}
+	event.set()
+	wait_for(lambda: not hasher._pending_by_key)
+	assert hasher._pending._value == 2
+
+
+def test02d():
+	""" The hashes of a user following each other are never refused, whatever the concurrent users """
+	hasher = PasswordHasher(cost=4, workers=2, max_pending=16, max_per_user=1, max_per_ip=16)
+	password_hash = hasher.hash("polop")
+	errors = []
+
+	def run_user(username):
+		keys = (('user', username), )
+		try:
+			for _ in range(10):
+				assert hasher.verify("polop", password_hash, keys)
+				hasher.hash("polop", keys)
+		except HashingOverloadException as exception:
+			errors.append(exception)
+
+	threads = [threading.Thread(target=run_user, args=(f"user{i}", )) for i in range(16)]
+	switch_interval = sys.getswitchinterval()
+	sys.setswitchinterval(1e-6)  # Interleaves the threads as much as a loaded server would
+	try:
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	finally:
+		sys.setswitchinterval(switch_interval)
+	assert not errors
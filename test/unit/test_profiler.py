@@ -0,0 +1,52 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+
+import pytest
+from flask import Flask, jsonify
+from peewee import SqliteDatabase
+
+from weblib.profiler import RequestProfiler, timed
+
+
+@pytest.fixture(scope='function')
+def client():
+	app = Flask(__name__)
+	database = SqliteDatabase(":memory:")
+	RequestProfiler().init_app(app, database)
+
+	@app.route('/queries')
+	def queries():
+		database.execute_sql("SELECT 1")
+		database.execute_sql("SELECT 2")
+		with timed('json'):
+			return jsonify({'polop': 1})
+
+	return app.test_client()
+
+
+def test01a(client):
+	""" DB queries and sections are sent in the Server-Timing header """
+	response = client.get('/queries')
+	entries = {entry.split(";")[0]: entry for entry in response.headers['Server-Timing'].split(", ")}
+	assert set(entries) == {"db", "json", "total"}
+	assert 'desc="2"' in entries['db']
+
+
+def test01b(client, caplog):
+	""" A profile line is logged per request """
+	with caplog.at_level(logging.INFO, logger="weblib.profiler"):
+		client.get('/queries')
+	assert len(caplog.records) == 1
+	message = caplog.records[0].getMessage()
+	assert "path=/queries status=200" in message
+	assert "db_count=2" in message
+	assert "json_bytes=%d" % len(b'{"polop":1}\n') in message
+
+
+def test01c():
+	""" Timing a section outside of a request does nothing """
+	with timed('db'):
+		pass
@@ -2,17 +2,27 @@
 # Copyright 2021-2025, Johann Saunier
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import datetime as dt
 import logging
 from logging import INFO
 from os import environ
 
+from unittest.mock import Mock, patch
+
 import pytest
 from flask import Flask
+from peewee import BooleanField, DateTimeField, IntegerField, SqliteDatabase
+from werkzeug.datastructures import MultiDict
 
-from weblib.models import WEBLIB_MODELS, DatabaseVersionException, DatabaseVersionModel, RoleModel, UserRole, flask_db
+from weblib.models import (
+	WEBLIB_MODELS, DatabaseVersionException, DatabaseVersionModel, RoleModel, User, UserRole, flask_db,
+	table_modified_listeners
+)
 from weblib.requests import (
-	create_user, get_app_db_version, get_lib_db_version, get_users, init_db_version, set_app_db_version,
-	set_lib_db_version
+	TablePage, UserCache, build_row_translator, bump_table_version, create_user, create_users, delete_user,
+	get_app_db_version, bootstrap_state, get_db_versions, get_lib_db_version, get_table_versions, get_user_roles,
+	get_users, has_any_registered_user, init_db_version, populate_roles, set_app_db_version, set_lib_db_version,
+	translate_field, translate_row, update_roles
 )
 from weblib.roles import ROLE_ADMIN, ROLE_USER
 
@@ -38,6 +48,7 @@ def populate_db(request):
 		model.drop_table(safe=True, cascade=True)
 		model.create_table(safe=True)
 	DatabaseVersionModel.drop_table(safe=True, cascade=True)
+	bootstrap_state.invalidate()
 
 	with app.app_context():
 		role_admin = RoleModel.create(name=ROLE_ADMIN)
@@ -91,9 +102,174 @@ def test01e(populate_db):
 	assert get_app_db_version() == 3
 
 
+def test01f(populate_db):
+	""" both database versions are read with a single query """
+	assert get_db_versions() == (None, None)
+	init_db_version(app_version=3, lib_version=2)
+	assert get_db_versions() == (2, 3)
+
+
 def test02a(populate_db):
 	""" Get the users list """
 	assert [t for t in get_users().query] == [
-		[2, "Beck", "Jeff", "jbeck", "user"],
-		[1, "Knopfler", "Mark", "mknopfler", "admin, user"],
+		(2, "Beck", "Jeff", "jbeck", "user"),
+		(1, "Knopfler", "Mark", "mknopfler", "admin, user"),
 	]
+
+
+def test02b(populate_db):
+	""" Prefetch the roles of several users """
+	users = User.prefetch_roles(User.select().order_by(User.id))
+	assert [sorted(u.roles) for u in users] == [["admin", "user"], ["user"]]
+
+
+def test02c(populate_db):
+	""" Table versions are bumped by the user modifications and by bump_table_version """
+	versions = get_table_versions([User, RoleModel])
+	assert versions['role'] == 0
+	delete_user(2)
+	bump_table_version(RoleModel)
+	assert get_table_versions([User, RoleModel]) == {'user': versions['user'] + 1, 'role': 1}
+
+
+def test02d(populate_db):
+	""" Bulk creation of users with roles given by name or id, then modification of their roles """
+	populate_roles()
+	user_ids = create_users([
+		{'username': f"user{i}", 'last_name': "Last", 'first_name': "First", 'password': "1234", 'roles': [ROLE_USER, "1"]}
+		for i in range(1200)
+	])
+	assert len(user_ids) == 1200
+	assert sorted(get_user_roles(user_ids[-1])) == [1, 2]
+	update_roles({'user_id': user_ids[0], 'roles': ["2"]})
+	assert get_user_roles(user_ids[0]) == (2, )
+	assert sorted(get_user_roles(user_ids[1])) == [1, 2]
+
+
+PAGE_COLUMNS = [Mock(column_name=cn) for cn in ('last_name', 'first_name')]
+PAGE_ROWS = (
+	(1, "Knopfler", "Mark"),
+	(2, "Beck", "Jeff"),
+	(3, "Gilmour", "David"),
+	(4, "Page", None),
+)
+
+
+def test02e(populate_db):
+	""" The registration of a user is only queried until one exists and again once the last one is deleted """
+	assert has_any_registered_user()
+	with patch.object(User, "select") as select:
+		assert has_any_registered_user()
+	select.assert_not_called()
+	for user in User.select():
+		delete_user(user.id)
+	assert not has_any_registered_user()
+	create_user(username="dgilmour", last_name="Gilmour", first_name="David", password="1234")
+	assert has_any_registered_user()
+
+
+def test03a():
+	""" Table page: no query argument -> rows untouched and no total count """
+	rows, total_count = TablePage.from_args(MultiDict()).apply(PAGE_ROWS, PAGE_COLUMNS)
+	assert rows == list(PAGE_ROWS)
+	assert total_count is None
+
+
+def test03b():
+	""" Table page: offset and limit """
+	rows, total_count = TablePage.from_args(MultiDict({'offset': "1", 'limit': "2"})).apply(PAGE_ROWS, PAGE_COLUMNS)
+	assert [r[0] for r in rows] == [2, 3]
+	assert total_count == 4
+	with patch.object(TablePage, 'MAX_LIMIT', 3):
+		rows, _total_count = TablePage.from_args(MultiDict({'limit': "100000000"})).apply(PAGE_ROWS, PAGE_COLUMNS)
+	assert [r[0] for r in rows] == [1, 2, 3]
+
+
+def test03c():
+	""" Table page: ascending and descending sort, NULL values are last when ascending """
+	rows, _total_count = TablePage.from_args(MultiDict({'sort': "first_name"})).apply(PAGE_ROWS, PAGE_COLUMNS)
+	assert [r[0] for r in rows] == [3, 2, 1, 4]
+	rows, _total_count = TablePage.from_args(MultiDict({'sort': "-last_name"})).apply(PAGE_ROWS, PAGE_COLUMNS)
+	assert [r[0] for r in rows] == [4, 1, 3, 2]
+
+
+def test03d():
+	""" Table page: case insensitive text filter on all the columns, the total count is the filtered one """
+	rows, total_count = TablePage.from_args(MultiDict({'q': "ar", 'limit': "10"})).apply(PAGE_ROWS, PAGE_COLUMNS)
+	assert [r[0] for r in rows] == [1]
+	assert total_count == 1
+	rows, total_count = TablePage.from_args(MultiDict({'q': "E", 'limit': "1"})).apply(PAGE_ROWS, PAGE_COLUMNS)
+	assert [r[0] for r in rows] == [1]
+	assert total_count == 3
+
+
+def test03e():
+	""" Table page: unknown sort column and malformed numbers are ignored """
+	rows, total_count = TablePage.from_args(MultiDict({'sort': "unknown", 'offset': "abc"})).apply(PAGE_ROWS, PAGE_COLUMNS)
+	assert rows == list(PAGE_ROWS)
+	assert total_count is None
+
+
+def test04a():
+	""" Row translator: one translator per column depending on the field's type, lut and display_date_only """
+	status = IntegerField()
+	status.lut = {0: "Available", 1: "Lent"}
+	date_only = DateTimeField()
+	date_only.display_date_only = True
+	translate = build_row_translator([BooleanField(), DateTimeField(), date_only, status, IntegerField(), None])
+	assert translate((True, dt.datetime(2025, 2, 13, 8, 5), dt.datetime(2025, 2, 13, 8, 5), 1, 7, dt.date(2025, 2, 13))) == (
+		"Yes", "13/02/2025 08:05", "13/02/2025", "Lent", "7", "13/02/2025"
+	)
+	assert translate((None, None, dt.datetime(1970, 1, 1), 3, None, False)) == ("", "", "", "None", "", "No")
+
+
+def test04b():
+	""" Row translator: the model field's renderer is used for all the values """
+	renderer = Mock(side_effect=lambda value: f"<b>{value}</b>")
+	translate = build_row_translator([Mock(renderer=renderer)])
+	assert translate((None, )) == ("<b>None</b>", )
+	assert translate((True, )) == ("<b>True</b>", )
+
+
+def test04c():
+	""" Row translator: translate_row() reuses the translator of the same fields """
+	status = IntegerField()
+	status.lut = {0: "Available", 1: "Lent"}
+	with patch("weblib.requests.build_row_translator", wraps=build_row_translator) as build:
+		assert translate_row((1, True), [status, BooleanField()]) == ("Lent", "Yes")
+		fields = [status, None]
+		for _i in range(3):
+			assert translate_row((0, None), fields) == ("Available", "")
+		assert translate_field(1, status) == "Lent"
+	assert build.call_count == 3
+
+
+def test05a():
+	""" The saves and deletions of the versioned models' instances are notified to the table modified listeners """
+	listener = Mock()
+	database = SqliteDatabase(":memory:")
+	table_modified_listeners.append(listener)
+	try:
+		with database.bind_ctx(WEBLIB_MODELS):
+			database.create_tables(WEBLIB_MODELS)
+			role = RoleModel.create(name=ROLE_ADMIN)
+			role.delete_instance()
+			DatabaseVersionModel.create(id=1, lib=1, app=1)
+	finally:
+		table_modified_listeners.remove(listener)
+	assert listener.call_args_list == [((RoleModel, ), ), ((RoleModel, ), )]
+
+
+def test05b():
+	""" The cached users are queried again once the version of the users table changed, eg. by another process """
+	database = SqliteDatabase(":memory:")
+	user_cache = UserCache(ttl=30)
+	with database.bind_ctx(WEBLIB_MODELS):
+		database.create_tables(WEBLIB_MODELS)
+		user = User.create(username="jbeck", password="", first_name="Jeff", last_name="Beck")
+		UserRole.create(user=user, role=RoleModel.create(name=ROLE_ADMIN))
+		assert user_cache.get(user.id).role_set == {ROLE_ADMIN}
+		UserRole.delete().execute()
+		assert user_cache.get(user.id).role_set == {ROLE_ADMIN}
+		bump_table_version(User)
+		assert user_cache.get(user.id).role_set == set()
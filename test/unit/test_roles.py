@@ -0,0 +1,71 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+from werkzeug.exceptions import Forbidden
+
+from weblib.roles import ROLE_ADMIN, ROLE_USER, PermissionIndex, roles_required
+
+
+class FakeUser:
+
+	def __init__(self, *roles):
+		self.role_set = frozenset(roles)
+
+
+@pytest.fixture(scope='function')
+def app():
+	app = Flask(__name__)
+
+	@app.route('/users')
+	@roles_required(ROLE_USER)
+	def users():
+		return "users"
+
+	@app.route('/admin')
+	def admin():
+		return "admin"
+
+	return app
+
+
+def test01a(app):
+	""" A view is only called if the user has one of its roles, the admin role being always allowed """
+	view = app.view_functions['users']
+	for roles, is_allowed in ((("user", ), True), (("admin", ), True), (("guest", ), False), ((), False)):
+		with patch("weblib.roles.current_user", FakeUser(*roles)):
+			if is_allowed:
+				assert view() == "users"
+			else:
+				with pytest.raises(Forbidden):
+					view()
+
+
+def test01b(app):
+	""" The permission index maps the endpoints to their roles, the views without roles being reserved to the admins """
+	index = PermissionIndex()
+	index.init_app(app)
+	assert index.get_roles('users') == {ROLE_USER, ROLE_ADMIN}
+	assert index.get_roles('admin') == {ROLE_ADMIN}
+	assert index.is_allowed(frozenset((ROLE_USER, )), 'users')
+	assert not index.is_allowed(frozenset((ROLE_USER, )), 'admin')
+	assert not index.is_allowed(frozenset(), 'unknown')
+
+
+def test01c(app):
+	""" Buttons are built once per role set and key """
+	index = PermissionIndex()
+	index.init_app(app)
+	calls = []
+
+	def builder():
+		calls.append(1)
+		return ("button", )
+
+	for role_set in (frozenset((ROLE_USER, )), frozenset((ROLE_USER, )), frozenset((ROLE_ADMIN, ))):
+		assert index.get_buttons(role_set, ("key", ), builder) == ("button", )
+	assert len(calls) == 2
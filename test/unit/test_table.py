@@ -2,6 +2,7 @@
 # Copyright 2021-2025, Johann Saunier
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import json
 from unittest.mock import Mock
 
 from playhouse.flask_utils import FlaskDB
@@ -58,3 +59,30 @@ def test01a():
 	# ~ }
 
 
+
+
+def test02a():
+	""" Streamed table: the JSON document is the same as the built table's one """
+	mock_model_fields_to_display = [Mock(spec=FlaskDB.Model, column_name=cn, i18n=i18n, lut=None) for cn, i18n in (
+		('last_name' , "Nom"),
+		('is_alive'  , "Vivant"),
+	)]
+	mock_query = (
+		(2, "Beck", False),
+		(1, "Gilmour", True),
+	)
+	table = Table("table_name")
+	table.buttons = ({'href': "/table_name/update", 'i18n': "Modify"}, )
+	chunks = table.iter_json(TableRequestResult(mock_model_fields_to_display, mock_query))
+	streamed = json.loads("".join(chunks))
+	table.build_from_request(TableRequestResult(mock_model_fields_to_display, mock_query))
+	assert streamed == json.loads(json.dumps(table.dict))
+
+
+def test02b():
+	""" Streamed table: empty table """
+	mock_model_fields_to_display = [Mock(spec=FlaskDB.Model, column_name="last_name", i18n="Nom", lut=None)]
+	table = Table("table_name")
+	streamed = json.loads("".join(table.iter_json(TableRequestResult(mock_model_fields_to_display, ()))))
+	assert streamed['rows'] == []
+	assert streamed['header'] == [{'name': 'last_name', 'i18n': "Nom", 'values': []}]
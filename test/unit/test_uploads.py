@@ -0,0 +1,187 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import os
+import time
+
+import pytest
+from flask import Flask
+from peewee import Model, SqliteDatabase, TextField
+
+from weblib.models import FileField
+from weblib.uploads import UnsafeUploadStoreException, UploadStore, get_references, upload_response
+
+FILENAME_1 = "33c0f9010ea85b9e93fa782eb6219a280a2f30caedc03add1cdf3dec6e6d18e6.pdf"
+FILENAME_2 = "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08.png"
+
+
+@pytest.fixture(scope='function')
+def store(tmp_path):
+	return UploadStore(str(tmp_path))
+
+
+def add(store, filename, content=b"polop", age=0):
+	temporary_path = os.path.join(store.root, ".upload-tmp")
+	with open(temporary_path, "wb") as f:
+		f.write(content)
+	is_written = store.add(temporary_path, filename)
+	mtime = time.time() - age
+	os.utime(store.get_path(filename), (mtime, mtime))
+	return is_written
+
+
+def test01a(store):
+	""" Files are stored in sharded directories """
+	assert add(store, FILENAME_1)
+	assert store.get_relative_path(FILENAME_1) == os.path.join("33", "c0", FILENAME_1)
+	assert open(store.get_path(FILENAME_1), "rb").read() == b"polop"
+	assert [filename for filename, _path, _mtime in store.iter_files()] == [FILENAME_1]
+
+
+def test01b(store):
+	""" A content already stored is not written again """
+	assert add(store, FILENAME_1)
+	assert not add(store, FILENAME_1)
+	assert os.listdir(store.root) == ["33"]
+
+
+def test01c(store):
+	""" Files stored flat by the previous versions are still found, then moved by shard() """
+	open(os.path.join(store.root, FILENAME_1), "wb").write(b"polop")
+	assert store.get_relative_path(FILENAME_1) == FILENAME_1
+	store.shard()
+	assert store.get_relative_path(FILENAME_1) == os.path.join("33", "c0", FILENAME_1)
+	assert os.path.exists(store.get_path(FILENAME_1))
+	assert sorted(os.listdir(store.root)) == ["33"]
+
+
+def test02a(store):
+	""" Garbage collection removes the old unreferenced files and temporary files only """
+	add(store, FILENAME_1, age=7200)
+	add(store, FILENAME_2, age=7200)
+	open(os.path.join(store.root, ".upload-interrupted"), "wb").close()
+	os.utime(os.path.join(store.root, ".upload-interrupted"), (time.time() - 7200, ) * 2)
+	assert store.collect_garbage({FILENAME_1: 1}, dry_run=True) == [os.path.join("9f", "86", FILENAME_2), ".upload-interrupted"]
+	assert len(list(store.iter_files())) == 2
+	assert store.collect_garbage({FILENAME_1: 1}) == [os.path.join("9f", "86", FILENAME_2), ".upload-interrupted"]
+	assert [filename for filename, _path, _mtime in store.iter_files()] == [FILENAME_1]
+	assert sorted(os.listdir(store.root)) == ["33", "9f"]
+
+
+def test02b(store):
+	""" Garbage collection keeps the files younger than the grace period """
+	add(store, FILENAME_1, age=60)
+	assert store.collect_garbage({}) == []
+	assert store.collect_garbage({}, grace_period=0) == [os.path.join("33", "c0", FILENAME_1)]
+
+
+def test02c(store):
+	""" The files not named after a hash in their shard are neither sharded nor collected """
+	for path in ("2024-tax-return.pdf", "cafe-menu.txt", os.path.join("00", "11", "photo.jpg"), os.path.join("9f", "86", FILENAME_1)):
+		os.makedirs(os.path.dirname(os.path.join(store.root, path)), exist_ok=True)
+		open(os.path.join(store.root, path), "wb").close()
+		os.utime(os.path.join(store.root, path), (time.time() - 7200, ) * 2)
+	assert store.shard() == []
+	assert store.collect_garbage({}) == []
+	assert sorted(os.listdir(store.root)) == ["00", "2024-tax-return.pdf", "9f", "cafe-menu.txt"]
+
+
+def test02d(store):
+	""" Storing an already stored content protects it from the garbage collection's grace period """
+	add(store, FILENAME_1, age=7200)
+	temporary_path = os.path.join(store.root, ".upload-tmp")
+	open(temporary_path, "wb").close()
+	assert not store.add(temporary_path, FILENAME_1)
+	assert store.collect_garbage({}) == []
+
+
+def test02e(tmp_path, monkeypatch):
+	""" The store refuses to be the home directory, before creating anything in it """
+	monkeypatch.setenv('HOME', str(tmp_path))
+	with pytest.raises(UnsafeUploadStoreException):
+		UploadStore("~")
+	with pytest.raises(UnsafeUploadStoreException):
+		UploadStore(f"{tmp_path}/.")
+	assert list(tmp_path.iterdir()) == []
+
+
+def test02f(store):
+	""" A dry run of shard() moves nothing """
+	open(os.path.join(store.root, FILENAME_1), "wb").close()
+	assert store.shard(dry_run=True) == [FILENAME_1]
+	assert os.listdir(store.root) == [FILENAME_1]
+
+
+def test03a():
+	""" References are counted over the columns declared as FileField """
+
+	class Document(Model):
+		name = TextField()
+		document = FileField(null=True)
+		picture = FileField(null=True)
+
+	database = SqliteDatabase(":memory:")
+	with database.bind_ctx([Document]):
+		database.create_tables([Document])
+		Document.insert_many([
+			("a", FILENAME_1, FILENAME_2),
+			("b", FILENAME_1, None),
+			("c", "", None),
+		], fields=[Document.name, Document.document, Document.picture]).execute()
+		assert get_references([Document]) == {FILENAME_1: 2, FILENAME_2: 1}
+
+
+@pytest.fixture(scope='function')
+def app(store, monkeypatch):
+	monkeypatch.setenv('UPLOAD_DIR', store.root)
+	add(store, FILENAME_1, content=b"0123456789")
+	app = Flask(__name__)
+	app.add_url_rule("/upload/<filename>", view_func=upload_response)
+	return app
+
+
+def test04a(app):
+	""" Download: immutable and strong ETag """
+	response = app.test_client().get(f"/upload/{FILENAME_1}")
+	assert response.status_code == 200
+	assert response.data == b"0123456789"
+	assert response.headers['ETag'] == f'"{FILENAME_1[:-4]}"'
+	assert response.cache_control.immutable
+	assert response.cache_control.private
+	assert not response.cache_control.public
+	assert response.mimetype == "application/pdf"
+
+
+def test04b(app):
+	""" Download: conditional and range requests """
+	client = app.test_client()
+	response = client.get(f"/upload/{FILENAME_1}", headers={'If-None-Match': f'"{FILENAME_1[:-4]}"'})
+	assert response.status_code == 304
+	assert response.data == b""
+	response = client.get(f"/upload/{FILENAME_1}", headers={'Range': "bytes=2-5"})
+	assert response.status_code == 206
+	assert response.data == b"2345"
+	assert response.headers['Content-Range'] == "bytes 2-5/10"
+
+
+def test04c(app, store):
+	""" Download: sending the file is delegated to the web server """
+	app.config['USE_X_SENDFILE'] = True
+	response = app.test_client().get(f"/upload/{FILENAME_1}")
+	assert response.data == b""
+	assert response.headers['X-Sendfile'] == store.get_path(FILENAME_1)
+	app.config['X_ACCEL_REDIRECT_PREFIX'] = "/internal-uploads/"
+	response = app.test_client().get(f"/upload/{FILENAME_1}")
+	assert response.data == b""
+	assert response.headers['X-Accel-Redirect'] == f"/internal-uploads/33/c0/{FILENAME_1}"
+	assert response.headers['ETag'] == f'"{FILENAME_1[:-4]}"'
+
+
+def test04d(app):
+	""" Download: unknown or invalid file names """
+	client = app.test_client()
+	assert client.get(f"/upload/{FILENAME_2}").status_code == 404
+	assert client.get("/upload/..%2Fsecret").status_code == 404
+	app.config['USE_X_SENDFILE'] = True
+	assert client.get(f"/upload/{FILENAME_2}").status_code == 404
@@ -17,6 +17,7 @@ class InconsistentConfig(Exception):
 CONFIG_FILEPATH = join(dirname(__file__), "..", "config.ini")
 CONFIG_SECRETS = get_config(filepath=CONFIG_FILEPATH, section="secrets")
 CONFIG_CUSTOMIZATION = get_config(filepath=CONFIG_FILEPATH, section="customization")
+CONFIG_DATABASE = get_config(filepath=CONFIG_FILEPATH, section="database")
 
 
 # app specific
@@ -1,12 +1,14 @@
 import logging
 
 from flask_babel import gettext as _, lazy_gettext as _l
-from testapp.requests import get_color_choices, get_parent_choices
+from testapp.requests import get_children_choices, get_color_choices, get_parent_choices
 
-from testapp.models import ComprehensiveModel
-from weblib.forms.fields import (BARCODE_FORMAT, BarcodeField, BooleanField, DatalistField, DateField, DateTimeField,
-	DecimalField, DoubleSelectField, FileField, IntegerField, PriceField, SelectField, TextAreaField, TextField)
+from testapp.models import ChildModel, ColorModel, ComprehensiveModel, ParentModel
+from weblib.forms.fields import (BARCODE_FORMAT, BarcodeField, BooleanField, CachedChoices, DatalistField, DateField,
+	DateTimeField, DecimalField, DoubleSelectField, FileField, IntegerField, PriceField, SelectField, TextAreaField,
+	TextField)
 from weblib.forms.forms import BaseForm
+from weblib.roles import ROLE_USER
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -20,6 +22,11 @@ def get_datalist_sources():
 	return "URL"
 
 
+color_choices = CachedChoices(get_color_choices, tags=(ColorModel, ))
+parent_choices = CachedChoices(get_parent_choices, tags=(ParentModel, ))
+children_choices = CachedChoices(get_children_choices, tags=(ParentModel, ChildModel))
+
+
 class ComprehensiveForm(BaseForm):
 	fields = {
 		#'hidden':        HiddenField      (ComprehensiveModel),
@@ -29,8 +36,9 @@ class ComprehensiveForm(BaseForm):
 		'integer':       IntegerField     (ComprehensiveModel),
 		'decimal':       DecimalField     (ComprehensiveModel),
 		'price':         PriceField       (ComprehensiveModel),
-		'select_field':  SelectField      (ComprehensiveModel, choices=get_color_choices),
-		'double_select': DoubleSelectField((_l("Parent"), _("Child")), parent_choices=get_parent_choices),
+		'select_field':  SelectField      (ComprehensiveModel, choices=color_choices),
+		'double_select': DoubleSelectField((_l("Parent"), _("Child")), parent_choices=parent_choices, children_choices=children_choices,
+			children_roles=(ROLE_USER, )),
 		'datalist':      DatalistField    (ComprehensiveModel, choices=get_datalist_sources, creation_request=create_datalist_source),
 		'date':          DateField        (ComprehensiveModel),
 		'datetime':      DateTimeField    (ComprehensiveModel),
@@ -50,8 +58,9 @@ class ComprehensiveRequiredForm(BaseForm):
 		'integer':       IntegerField     (ComprehensiveModel, required=True),
 		'decimal':       DecimalField     (ComprehensiveModel, required=True),
 		'price':         PriceField       (ComprehensiveModel, required=True),
-		'select_field':  SelectField      (ComprehensiveModel, required=True, choices=get_color_choices),
-		'double_select': DoubleSelectField((_l("Parent"), _("Child")), parent_choices=get_parent_choices),
+		'select_field':  SelectField      (ComprehensiveModel, required=True, choices=color_choices),
+		'double_select': DoubleSelectField((_l("Parent"), _("Child")), parent_choices=parent_choices, children_choices=children_choices,
+			children_roles=(ROLE_USER, )),
 		'datalist':      DatalistField    (ComprehensiveModel, required=True, choices=get_datalist_sources, creation_request=create_datalist_source),
 		'date':          DateField        (ComprehensiveModel, required=True),
 		'datetime':      DateTimeField    (ComprehensiveModel, required=True),
@@ -71,8 +80,9 @@ class ComprehensiveDefaultsForm(BaseForm):
 		'integer':       IntegerField     (ComprehensiveModel, default=7),
 		'decimal':       DecimalField     (ComprehensiveModel, default=7.5, min=0, step=0.5, max=100),
 		'price':         PriceField       (ComprehensiveModel, default=7.07, min=0, step=0.01),  # FIXME
-		'select_field':  SelectField      (ComprehensiveModel, default=2, choices=get_color_choices),
-		'double_select': DoubleSelectField((_l("Parent"), _("Child")), parent_choices=get_parent_choices),  # TODO default
+		'select_field':  SelectField      (ComprehensiveModel, default=2, choices=color_choices),
+		'double_select': DoubleSelectField((_l("Parent"), _("Child")), parent_choices=parent_choices, children_choices=children_choices,
+			children_roles=(ROLE_USER, )),  # TODO default
 		#'datalist':     DatalistField    -> Non sense
 		'date':          DateField        (ComprehensiveModel, default="now"),
 		'datetime':      DateTimeField    (ComprehensiveModel, default="now"),
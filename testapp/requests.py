@@ -40,6 +40,10 @@ def get_child_choices():
 	return ChildModel.select().where(ChildModel.id == parent_id).order_by(ChildModel.name).tuples()  # TODO
 
 
+def get_children_choices():
+	return [(parent_id, *child) for parent_id, _name in get_parent_choices() for child in get_child_choices()]
+
+
 def get_comprehensive_request():
 	columns = (
 		ComprehensiveModel.text,
@@ -1,7 +1,6 @@
 import logging
-from os import environ
 
-from flask import Blueprint, jsonify, redirect, request, send_from_directory, url_for
+from flask import Blueprint, redirect, url_for
 from flask_babel import gettext as _
 from flask_babel import lazy_gettext as _l
 from flask_login import login_required
@@ -9,9 +8,10 @@ from flask_login import login_required
 from testapp.forms import (
 	ComprehensiveDefaultsForm, ComprehensiveForm, ComprehensiveRequiredForm, ComprehensiveValidatorsForm
 )
-from testapp.models import ComprehensiveModel
-from testapp.requests import get_child_choices, get_comprehensive_request
+from testapp.models import ColorModel, ComprehensiveModel
+from testapp.requests import get_comprehensive_request
 from weblib.roles import ROLE_ADMIN, ROLE_USER, roles_required
+from weblib.uploads import upload_response
 from weblib.views import Tab, crud_page, site
 
 _LOGGER = logging.getLogger(__name__)
@@ -81,13 +81,7 @@ def comprehensive():
 @roles_required(ROLE_ADMIN, ROLE_USER)
 def comprehensive_2(form_type, table_name=None, crud_step="read", filename=None):
 	if filename is not None:
-		return send_from_directory(environ.get('UPLOAD_DIR', environ['HOME']), filename)  #, as_attachment=True)
-
-	if request.method == 'GET':
-		resource_to_fetch = request.args.get('fetch')
-		if resource_to_fetch:
-			_LOGGER.info(f"Treating AJAX request for '{resource_to_fetch}'")
-			return jsonify({'double_select.choices': get_child_choices}.get(resource_to_fetch)())
+		return upload_response(filename)
 
 	query, columns = get_comprehensive_request()
 	return crud_page(table_name, crud_step,
@@ -97,6 +91,7 @@ def comprehensive_2(form_type, table_name=None, crud_step="read", filename=None)
 		tables={
 			'comprehensive': {
 				'model_factory': ComprehensiveModel,
+				'depends_on': (ColorModel, ),
 				'query': query,
 				'columns': columns,
 				'order_by': ComprehensiveModel.text,
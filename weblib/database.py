@@ -3,12 +3,72 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
 import logging
+import threading
+import time
 
 from playhouse.migrate import PostgresqlMigrator, migrate
+from playhouse.pool import PooledPostgresqlDatabase
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class InstrumentedPooledPostgresqlDatabase(PooledPostgresqlDatabase):
+	"""
+	Connection pool keeping the metrics needed for sizing it (and Postgres' max_connections against the number of
+	workers), see get_metrics(). The checkout time is the time spent waiting for a free connection, or opening one.
+
+	"""
+
+	def __init__(self, *args, **kwargs):
+		self._metrics_lock = threading.Lock()
+		self._local_checkouts = threading.local()
+		self._checkouts = 0
+		self._checkout_time = 0.
+		self._max_checkout_time = 0.
+		self._requests = 0
+		self._request_checkouts = 0
+		self._max_request_checkouts = 0
+		super().__init__(*args, **kwargs)
+
+	def connect(self, reuse_if_open=False):
+		start = time.monotonic()
+		is_connected = super().connect(reuse_if_open)
+		if is_connected:
+			elapsed = time.monotonic() - start
+			with self._metrics_lock:
+				self._checkouts += 1
+				self._checkout_time += elapsed
+				self._max_checkout_time = max(self._max_checkout_time, elapsed)
+			self._local_checkouts.count = getattr(self._local_checkouts, 'count', 0) + 1
+		return is_connected
+
+	def end_request(self, _exception=None):
+		"""
+		To be called at the end of each request: accounts the checkouts done by the current thread since the previous call.
+
+		"""
+		checkouts = getattr(self._local_checkouts, 'count', 0)
+		self._local_checkouts.count = 0
+		with self._metrics_lock:
+			self._requests += 1
+			self._request_checkouts += checkouts
+			self._max_request_checkouts = max(self._max_request_checkouts, checkouts)
+
+	def get_metrics(self):
+		with self._metrics_lock:
+			return {
+				'max_connections': self._max_connections,
+				'in_use': len(self._in_use),
+				'idle': len(self._connections),
+				'checkouts': self._checkouts,
+				'checkout_time_avg': self._checkout_time / self._checkouts if self._checkouts else 0.,
+				'checkout_time_max': self._max_checkout_time,
+				'requests': self._requests,
+				'checkouts_per_request_avg': self._request_checkouts / self._requests if self._requests else 0.,
+				'checkouts_per_request_max': self._max_request_checkouts,
+			}
+
+
 class AbstractMigrator:
 	"""
 	https://docs.peewee-orm.com/en/latest/peewee/playhouse.html#migrate
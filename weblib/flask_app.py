@@ -3,24 +3,37 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
 import logging
+from contextlib import contextmanager
 from os import environ
 
 from flask import Flask, request
 from flask_babel import Babel
 from flask_babel import gettext as _
 from flask_babel import lazy_gettext as _l
+from peewee import PostgresqlDatabase, Proxy
 
+from weblib.fragments import FragmentCacheExtension, LRUBackend, SqliteBackend, fragment_cache
 from weblib.login import login_manager
 from weblib.models import VERSION as WEBLIB_VERSION
-from weblib.models import WEBLIB_MODELS
+from weblib.models import WEBLIB_MODELS, DatabaseVersionModel
 from weblib.models import Migrator as WeblibMigrator
 from weblib.models import flask_db
-from weblib.requests import get_app_db_version, get_lib_db_version, init_db_version, populate_roles, set_db_version
-from weblib.roles import AVAILABLE_ROLES
+from weblib.passwords import password_hasher
+from weblib.profiler import RequestProfiler
+from weblib.requests import (TablePage, bootstrap_state, get_db_versions, init_db_version, populate_roles, set_db_version,
+	user_cache)
+from weblib.roles import AVAILABLE_ROLES, permission_index
 from weblib.views import page_forbidden, page_server_error
 
 _LOGGER = logging.getLogger(__name__)
 
+MIGRATION_LOCK_ID = 0x7765626c6962  # "weblib"
+
+
+class StaleDatabaseException(Exception):
+	pass
+
+
 def disable_client_cache(response):
 	# response.cache_control.no_store = True
 	# ~ if 'Cache-Control' not in response.headers:
@@ -45,6 +58,7 @@ def init_db(
 		_LOGGER.info("Cleaning up DB...")
 		_LOGGER.info("Removing tables '%s'", models_to_cleanup)
 		db.drop_tables(models_to_cleanup, safe=True, cascade=True)
+		bootstrap_state.invalidate()
 	if cleanup or cleanup_app_part or cur_lib_db_version is None:
 		_LOGGER.info("Create tables...")
 		db.create_tables(models_to_cleanup, safe=True)
@@ -60,7 +74,23 @@ def init_db(
 		):
 			migrator_factory(db, db_part, cur_version, target_version, set_db_version_factory=set_db_version).migrate()
 	populate_roles()
-	db.close()
+
+
+@contextmanager
+def migration_lock(db):
+	"""
+	Postgres advisory lock held while initializing or migrating the DB so that only one process does it at once.
+
+	"""
+	if not isinstance(db.obj if isinstance(db, Proxy) else db, PostgresqlDatabase):
+		yield
+		return
+	_LOGGER.info("Waiting for the migration lock...")
+	db.execute_sql("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID, ))
+	try:
+		yield
+	finally:
+		db.execute_sql("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID, ))
 
 
 class FlaskApp:
@@ -91,7 +121,13 @@ class FlaskApp:
 		_LOGGER.debug("AVAILABLE_ROLES are %s", AVAILABLE_ROLES)
 		self._is_disable_client_cache = is_disable_client_cache
 
-	def create_app(self, cleanup=False, cleanup_app_part=False):
+	def create_app(self, cleanup=False, cleanup_app_part=False, is_migrating=True):
+		"""
+		:param is_migrating: if False, the DB is neither initialized nor migrated: its versions are only checked with a
+			single query and StaleDatabaseException is raised if they are not the expected ones. The web server's processes
+			should boot this way, the DB being migrated beforehand with weblib/migrate.py.
+
+		"""
 
 		@self._app.route('/shutdown')
 		def shutdown():
@@ -120,34 +156,54 @@ class FlaskApp:
 			self._app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 			#self._app.config['EXPLAIN_TEMPLATE_LOADING'] = True
 
-		self._app.config['DATABASE'] = {
-			'host': "localhost",
-			'name': (
-				self._config_dict.pop('OVERRIDEN_DATABASE_NAME')
-				or self._app.config.get('OVERRIDEN_DATABASE_NAME')
-				or self._app.config['PROJECT_REPO_NAME']
-			),
-			'engine': 'playhouse.pool.PooledPostgresqlDatabase',
+		database_name = (
+			self._config_dict.pop('OVERRIDEN_DATABASE_NAME')
+			or self._app.config.get('OVERRIDEN_DATABASE_NAME')
+			or self._app.config['PROJECT_REPO_NAME']
+		)
+		self._app.config.update(self._config_dict)
+		# The pool is per process: max_connections * number of processes must stay below Postgres' max_connections
+		self._app.config['DATABASE'] = self._app.config.get('DATABASE_URL') or {
+			'host': self._app.config.get('DATABASE_HOST', "localhost"),
+			'name': database_name,
+			'engine': 'weblib.database.InstrumentedPooledPostgresqlDatabase',
 			'user': environ.get('USER', ""),
+			'max_connections': int(self._app.config.get('DATABASE_MAX_CONNECTIONS', 20)),
+			# Seconds after which an idle connection is recycled
+			'stale_timeout': int(self._app.config.get('DATABASE_STALE_TIMEOUT', 300)),
+			# Seconds to wait for a free connection when all are in use, 0 for waiting forever
+			'timeout': int(self._app.config.get('DATABASE_TIMEOUT', 10)),
 		}
-		self._app.config.update(self._config_dict)
+		user_cache.ttl = self._app.config.get('USER_CACHE_TTL', user_cache.ttl)
+		TablePage.MAX_LIMIT = self._app.config.get('TABLE_MAX_LIMIT', TablePage.MAX_LIMIT)
+		# Bytes of a request body read by werkzeug at most, uploads included (413 beyond)
+		self._app.config['MAX_CONTENT_LENGTH'] = self._app.config.get('MAX_CONTENT_LENGTH') or 16 * 1024 * 1024
+		password_hasher.configure(
+			cost=self._app.config.get('BCRYPT_COST', 12),
+			workers=self._app.config.get('BCRYPT_WORKERS', 2),
+			max_pending=self._app.config.get('BCRYPT_MAX_PENDING', 16),
+			max_per_user=self._app.config.get('BCRYPT_MAX_PER_USER', 1),
+			max_per_ip=self._app.config.get('BCRYPT_MAX_PER_IP', 8),
+		)
+		# A SQLite file shares the fragments between the processes of the host
+		fragment_cache_path = self._app.config.get('FRAGMENT_CACHE_PATH')
+		fragment_cache.configure(
+			SqliteBackend(fragment_cache_path) if fragment_cache_path
+			else LRUBackend(self._app.config.get('FRAGMENT_CACHE_SIZE', 1024))
+		)
+		fragment_cache.set_app_version(self._app.config.get('APP_VERSION'))
+		self._app.jinja_env.add_extension(FragmentCacheExtension)
 
 		flask_db.init_app(self._app)
-		lib_db_version = get_lib_db_version()
-		app_db_version = get_app_db_version()
-		_LOGGER.info("Initializing DB '%s'...", self._app.config['DATABASE']['name'])
-		init_db(
-			flask_db.database,
-			self._models,
-			init_db_version,
-			lib_db_version,
-			app_db_version,
-			self._app_db_version,
-			self._app_db_migrator,
-			cleanup=cleanup,
-			cleanup_app_part=cleanup_app_part,
-			populate_function=self._populate_function,
-		)
+		if hasattr(flask_db.database, 'end_request'):
+			self._app.teardown_request(flask_db.database.end_request)
+		# Off by default: the timings would be sent to any client and a line would be logged per request
+		if self._app.config.get('IS_PROFILING_REQUESTS', False):
+			RequestProfiler().init_app(self._app, flask_db.database)
+		if is_migrating:
+			self.migrate_db(cleanup=cleanup, cleanup_app_part=cleanup_app_part)
+		else:
+			self.check_db_versions()
 
 		login_manager.init_app(self._app)
 
@@ -155,9 +211,38 @@ class FlaskApp:
 		self._app.register_error_handler(500, page_server_error)
 		for bp in self._blueprints:
 			self._app.register_blueprint(bp)
+		permission_index.init_app(self._app)
 
 
 		if self._is_disable_client_cache:
 			self._app.after_request(disable_client_cache)
 
 		return self._app, flask_db.database
+
+	def migrate_db(self, cleanup=False, cleanup_app_part=False):
+		db = flask_db.database
+		with migration_lock(db):
+			# Read under the lock: another process may just have migrated the DB
+			lib_db_version, app_db_version = get_db_versions() if DatabaseVersionModel.table_exists() else (None, None)
+			_LOGGER.info("Initializing DB '%s'...", db.database)
+			init_db(
+				db,
+				self._models,
+				init_db_version,
+				lib_db_version,
+				app_db_version,
+				self._app_db_version,
+				self._app_db_migrator,
+				cleanup=cleanup,
+				cleanup_app_part=cleanup_app_part,
+				populate_function=self._populate_function,
+			)
+		db.close()
+
+	def check_db_versions(self):
+		versions = get_db_versions()
+		flask_db.database.close()
+		if versions != (WEBLIB_VERSION, self._app_db_version):
+			raise StaleDatabaseException(
+				"DB versions (lib, app) are %s instead of %s: run weblib/migrate.py" % (versions, (WEBLIB_VERSION, self._app_db_version))
+			)
@@ -6,18 +6,25 @@ import hashlib
 import json
 import logging
 import mimetypes
+import time
+import unicodedata
+from bisect import bisect_left
 from datetime import datetime
-from os import environ
-from os.path import expanduser, join
+from functools import partial
+from os import environ, remove
+from tempfile import NamedTemporaryFile
+from weakref import finalize
 
 from bcrypt import checkpw
 from flask import request
-from flask_babel import gettext as _
+from flask_babel import get_locale, gettext as _
 from flask_babel import lazy_gettext as _l
 from markupsafe import Markup, escape
 from werkzeug.datastructures import MultiDict
 
 from weblib.requests import get_roles_choices, get_user_by_username
+from weblib.roles import ADMIN_ONLY
+from weblib.uploads import TEMPORARY_FILE_PREFIX, UploadStore
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -35,6 +42,110 @@ def format_attribute(name, value):
 		return ""
 
 
+def _escape_format(value):
+	return str(value).replace("{", "{{").replace("}", "}}")
+
+
+class CachedChoices:
+	"""
+	Wraps a choices provider function so that it is called at most once every *ttl* seconds. The cached choices are also
+	dropped as soon as one of the *tags* is invalidated (see invalidate_choices()), eg. by crud_page() when it modifies the
+	table the choices come from. A tag is either a string or a DB model (its table name is then used).
+
+	"""
+	_tagged = {}
+
+	def __init__(self, provider, ttl=60, tags=()):
+		self._provider = provider
+		self._ttl = ttl
+		self._choices = ()
+		self._expiration_time = 0
+		self._index = None
+		for tag in tags:
+			self._tagged.setdefault(_get_tag_name(tag), []).append(self)
+
+	def __call__(self):
+		now = time.monotonic()
+		if now >= self._expiration_time:
+			self._choices = tuple(self._provider())
+			self._expiration_time = now + self._ttl
+		return self._choices
+
+	def invalidate(self):
+		self._expiration_time = 0
+
+	def get_index(self):
+		"""
+		:return: the PrefixIndex of the choices, rebuilt only when they are refreshed
+
+		"""
+		choices = self()
+		index = self._index
+		if index is None or index.choices is not choices:
+			index = self._index = PrefixIndex(choices)
+		return index
+
+
+def normalize_text(text):
+	"""
+	:return: the *text* in lower case and without diacritics, as compared by lib.js
+
+	"""
+	return "".join(c for c in unicodedata.normalize("NFD", str(text)) if not unicodedata.combining(c)).lower()
+
+
+class PrefixIndex:
+	"""
+	Sorted index of the (value, text) *choices* answering the typeahead requests of DatalistField: a choice matches a
+	prefix if one of the words of its normalized text starts with it (see normalize_text()).
+
+	"""
+
+	def __init__(self, choices):
+		self.choices = choices
+		self._texts = {}
+		entries = []
+		for value, text in choices:
+			text = str(text)
+			self._texts[str(value)] = text
+			normalized_text = normalize_text(text)
+			for position, character in enumerate(normalized_text):
+				if character.isalnum() and (position == 0 or not normalized_text[position - 1].isalnum()):
+					entries.append((normalized_text[position:], value, text))
+		entries.sort(key=lambda entry: entry[0])
+		self._keys = [key for key, _value, _text in entries]
+		self._choices = [(value, text) for _key, value, text in entries]
+
+	def search(self, prefix, limit=10):
+		"""
+		:return: the first *limit* (value, text) choices matching the *prefix*
+
+		"""
+		prefix = normalize_text(prefix).strip()
+		matches = []
+		values = set()
+		for position in range(bisect_left(self._keys, prefix), len(self._keys)):
+			if len(matches) >= limit or not self._keys[position].startswith(prefix):
+				break
+			value, text = self._choices[position]
+			if value not in values:
+				values.add(value)
+				matches.append((value, text))
+		return matches
+
+	def get_text(self, value):
+		return self._texts.get(str(value), "")
+
+
+def _get_tag_name(tag):
+	return getattr(getattr(tag, '_meta', None), 'table_name', tag)
+
+
+def invalidate_choices(tag):
+	for cached_choices in CachedChoices._tagged.get(_get_tag_name(tag), ()):
+		cached_choices.invalidate()
+
+
 class BaseField:
 	"""
 	Fields can have arbitrary HTML attributes passed by kwargs. The underscores (_) of the kwargs' keys are replaced by dashes (-) for building the HTML attribute's name.
@@ -56,6 +167,30 @@ class BaseField:
 		self._data = default
 		self.validators = list(validators)
 		self.error_messages = []
+		self._skeletons = {}
+
+	def compile(self):
+		"""
+		Drops the HTML skeletons of the field: must be called once its static parts (name, label, attributes...) are set.
+
+		"""
+		self._skeletons = {}
+
+	def _get_skeleton(self):
+		"""
+		The HTML of the field where only the dynamic parts (value, errors...) are left as str.format() slots. It is built once
+		per locale because the labels and attributes may be lazy translations.
+
+		"""
+		locale = get_locale()
+		try:
+			return self._skeletons[locale]
+		except KeyError:
+			skeleton = self._skeletons[locale] = self._build_skeleton()
+			return skeleton
+
+	def _get_readonly(self):
+		return " readonly" if self.readonly else ""
 
 	def build_id(self):
 		return self.name
@@ -90,7 +225,21 @@ class BaseField:
 	def __getattr__(self, name):
 		return self.attributes.get(name)
 
+	def __copy__(self):
+		"""
+		Shallow copy used by the forms for getting a per instance state of their fields. It does not go through
+		__getattr__ (the copy has no attributes yet).
+
+		"""
+		field = self.__class__.__new__(self.__class__)
+		field.__dict__.update(self.__dict__)
+		return field
+
 	def _build_attributes(self, attributes_dict=None):
+		"""
+		:return: the static HTML attributes, escaped for being part of a skeleton (the readonly one is dynamic)
+
+		"""
 		attributes_dict = self.attributes if attributes_dict is None else attributes_dict
 		attributes = [format_attribute(name, attributes_dict[name]) for name in attributes_dict]
 		attributes = [a for a in attributes if a]
@@ -99,29 +248,34 @@ class BaseField:
 			attributes = " " + attributes
 		if self.is_first_field:
 			attributes += " autofocus"
-		if self.readonly:
-			attributes += " readonly"
-		return attributes
+		return _escape_format(attributes)
 
 	def _get_errors(self):
 		return f'<div class="invalid-field">{"<br>".join(self.error_messages)}</div>' if self.error_messages else ""
 
-	def __str__(self):
-		value = f' value="{self.to_repr()}"' if self.data is not None else ""
-		attributes = self._build_attributes()
+	def _build_skeleton(self):
 		units = getattr(self, 'units', None)
 		if units is not None:
 			pre_units = '<div class="input-group mb-3">'
-			units = f'<span class="input-group-text">{units}</span></div>'
+			units = f'<span class="input-group-text">{_escape_format(units)}</span></div>'
 		else:
 			pre_units = units = ""
-		errors = self._get_errors()
-		self.readonly = False
 		return f"""<div class="form-group mb-3">
-	<label for="{self.name}">{self.label}</label>
-	{pre_units}<{self.html_tag} type="{self.html_type}" name="{self.name}" class="form-control{" is-invalid" if errors else ""}"{value}{attributes}></{self.html_tag}>{units}{errors}
+	<label for="{self.name}">{_escape_format(self.label)}</label>
+	{pre_units}<{self.html_tag} type="{self.html_type}" name="{self.name}" class="form-control{{invalid}}"{{value}}{self._build_attributes()}{{readonly}}></{self.html_tag}>{units}{{errors}}
 </div>"""
 
+	def __str__(self):
+		errors = self._get_errors()
+		html = self._get_skeleton().format(
+			value=f' value="{self.to_repr()}"' if self.data is not None else "",
+			errors=errors,
+			invalid=" is-invalid" if errors else "",
+			readonly=self._get_readonly(),
+		)
+		self.readonly = False
+		return html
+
 
 class HiddenField(BaseField):
 
@@ -141,32 +295,35 @@ class PasswordField(BaseField):
 	html_tag = "input"
 	html_type = "password"
 
-	def __str__(self):
-		value = f' value="{self.to_repr()}"' if self.data is not None else ""
-		attributes = self._build_attributes()
-		units = "👁"
-		if units is not None:
-			pre_units = '<div class="input-group mb-3">'
-			units = f'<span class="input-group-text not-a-text password-toggle" id="{self.build_id()}-toggle">{units}</span></div>'
-		else:
-			pre_units = units = ""
-		error = f'<div class="invalid-field">{"".join(self.error_messages)}</div>' if self.error_messages else ""
+	def _build_skeleton(self):
 		return f"""<div class="form-group mb-3">
-	<label for="{self.name}">{self.label}</label>
-	{pre_units}<{self.html_tag} type="{self.html_type}" id="{self.build_id()}" name="{self.name}" class="form-control{" is-invalid" if self.error_messages else ""}"{value}{attributes}></{self.html_tag}>{units}{error}
+	<label for="{self.name}">{_escape_format(self.label)}</label>
+	<div class="input-group mb-3"><{self.html_tag} type="{self.html_type}" id="{self.build_id()}" name="{self.name}" class="form-control{{invalid}}"{{value}}{self._build_attributes()}{{readonly}}></{self.html_tag}><span class="input-group-text not-a-text password-toggle" id="{self.build_id()}-toggle">👁</span></div>{{errors}}
 </div>"""
 
+	def __str__(self):
+		return self._get_skeleton().format(
+			value=f' value="{self.to_repr()}"' if self.data is not None else "",
+			errors=f'<div class="invalid-field">{"".join(self.error_messages)}</div>' if self.error_messages else "",
+			invalid=" is-invalid" if self.error_messages else "",
+			readonly=self._get_readonly(),
+		)
+
 
 class TextAreaField(BaseField):
 
-	def __str__(self):
-		attributes = self._build_attributes()
-		value = escape(self.data) if self.data is not None else ""
+	def _build_skeleton(self):
 		return f"""<div class="form-group mb-3">
-	<label for="{self.name}">{self.label}</label>
-	<textarea name="{self.name}" class="form-control"{attributes}>{value}</textarea>
+	<label for="{self.name}">{_escape_format(self.label)}</label>
+	<textarea name="{self.name}" class="form-control"{self._build_attributes()}{{readonly}}>{{value}}</textarea>
 </div>"""
 
+	def __str__(self):
+		return self._get_skeleton().format(
+			value=escape(self.data) if self.data is not None else "",
+			readonly=self._get_readonly(),
+		)
+
 
 class IntegerField(BaseField):
 	html_tag = "input"
@@ -223,12 +380,14 @@ class BooleanField(BaseField):
 	def data(self, value):
 		self._data = bool(value)
 
-	def __str__(self):
-		attributes = " checked" if bool(self.data) else ""
+	def _build_skeleton(self):
 		return f"""<div class="form-group mb-3">
-	<{self.html_tag} type="{self.html_type}" name="{self.name}"{attributes}></{self.html_tag}> <label for="{self.name}">{self.label}</label>
+	<{self.html_tag} type="{self.html_type}" name="{self.name}"{{checked}}></{self.html_tag}> <label for="{self.name}">{_escape_format(self.label)}</label>
 </div>"""
 
+	def __str__(self):
+		return self._get_skeleton().format(checked=" checked" if bool(self.data) else "")
+
 
 class DateField(BaseField):
 	html_tag = "input"
@@ -296,7 +455,7 @@ class SelectField(BaseField):
 			else:
 				self._data = {str(value)}
 		else:
-			self._data.add(str(value))
+			self._data = self.data_as_set() | {str(value)}  # Do not modify the default value in place
 
 	def data_as_set(self):
 		if self._data is None:
@@ -305,30 +464,30 @@ class SelectField(BaseField):
 
 	@property
 	def choices(self):
-		try:
-			return self._choices()
-		except TypeError:
-			return self._choices
+		return self._choices() if callable(self._choices) else self._choices
 
 	@choices.setter
 	def choices(self, value):
 		self._choices = value
 
+	def _build_skeleton(self):
+		return f"""<div class="form-group mb-3">
+	<label for="{self.name}">{_escape_format(self.label)}</label>
+	<select name="{self.name}" class="form-control"{self._build_attributes()}{{readonly}}{{size}}>
+{{options}}
+</select>
+</div>"""
+
 	def __str__(self):
-		attributes = self._build_attributes()
 		choices = self.choices
 		if not self.default and not self.multiple:
 			choices = [("", "")] + list(choices)
 		size = ""
 		if self.multiple:
 			size = ' size="%s"' % min(len(choices), 10)
-		options = "\n".join(f'<option value="{value}"' + (" selected" if str(value) in self.data_as_set() else "") + f'>{text}</option>' for value, text in choices)
-		return f"""<div class="form-group mb-3">
-	<label for="{self.name}">{self.label}</label>
-	<select name="{self.name}" class="form-control"{attributes}{size}>
-{options}
-</select>
-</div>"""
+		selected_values = self.data_as_set()
+		options = "\n".join(f'<option value="{value}"' + (" selected" if str(value) in selected_values else "") + f'>{text}</option>' for value, text in choices)
+		return self._get_skeleton().format(options=options, size=size, readonly=self._get_readonly())
 
 
 class DoubleSelectField(SelectField):
@@ -336,9 +495,14 @@ class DoubleSelectField(SelectField):
 	Two select elements on the same line. The left one is the parent and the content of the right one depends on the
 	parent's selected item.
 	**parent_choices** is either a list of pairs (idem select) or a callback that returns the list of pairs.
+	**children_choices** is either a list of (parent value, value, text) triples or a callback that returns them, ideally
+	CachedChoices. The children of all the parents are then fetched at once by the browser from the /choices endpoint
+	(see get_children_json()), which serves them only to the admins and the users having one of the **children_roles**.
+	Otherwise, the browser fetches the children of each parent from *choices_url* with the fetch=<name>.choices and
+	get_children=<parent value> arguments.
 
 	"""
-	def __init__(self, labels, parent_choices=(), parent_attributes=None, choices=(), choices_url=None, **attributes):
+	def __init__(self, labels, parent_choices=(), parent_attributes=None, choices=(), choices_url=None, children_choices=None, children_roles=(), **attributes):
 		super(DoubleSelectField, self).__init__(None, **attributes)
 		self.labels = labels
 		self._parent_choices = parent_choices
@@ -346,45 +510,87 @@ class DoubleSelectField(SelectField):
 		self.selected_parent_value = None
 		self._choices = choices
 		self.choices_url = choices_url
+		self.children_choices = children_choices
+		self.children_roles = frozenset(children_roles) | ADMIN_ONLY
+		self._children_json = None
 
 	@property
 	def parent_choices(self):
-		try:
-			return self._parent_choices()
-		except TypeError:
-			return self._parent_choices
+		return self._parent_choices() if callable(self._parent_choices) else self._parent_choices
 
 	@parent_choices.setter
 	def parent_choices(self, value):
 		self._parent_choices = value
 
-	def __str__(self):
-		parent_options = "\n".join("<option" + (" selected" if (value == self.selected_parent_value and self.data) else "") + f' value="{value}">{text}</option>' for value, text in self.parent_choices)
-		options = "\n".join("<option" + (" selected " if value == self.data else " ") + f'value="{value}">{text}</option>' for value, text in self.choices)
-		choices_url = self.choices_url or request.path
-		attributes = self._build_attributes()
-		parent_attributes = self._build_attributes(self._parent_attributes)
+	def get_children_json(self):
+		"""
+		:return: the JSON of the {parent value: [[value, text], ...]} children choices of all the parents and its ETag,
+			built again only when the *children_choices* change
+
+		"""
+		choices = self.children_choices() if callable(self.children_choices) else self.children_choices
+		children_json = self._children_json
+		if children_json is None or children_json[0] is not choices:
+			children = {}
+			for parent_value, value, text in choices:
+				children.setdefault(str(parent_value), []).append((value, str(text)))
+			body = json.dumps(children)
+			children_json = self._children_json = (choices, body, hashlib.sha1(body.encode()).hexdigest())
+		return children_json[1], children_json[2]
+
+	def _build_skeleton(self):
+		children_url = f' children-url="/choices/{escape(self.form_path)}/{self.name}"' if self.children_choices is not None else ""
 		return f"""<div class="form-group mb-3 double-select">
 	<div class="col">
-		<label for="{self.name}-parent">{self.labels[0]}</label>
-		<select id="{self.build_id()}-parent" name="{self.name}-parent" class="form-control" data-parent-select{parent_attributes}>{parent_options}</select>
+		<label for="{self.name}-parent">{_escape_format(self.labels[0])}</label>
+		<select id="{self.build_id()}-parent" name="{self.name}-parent" class="form-control" data-parent-select{self._build_attributes(self._parent_attributes)}{{readonly}}>{{parent_options}}</select>
 	</div>
 	<div class="col">
-		<label for="{self.name}">{self.labels[1]}</label>
-		<select id="{self.build_id()}" name="{self.name}" class="form-control" data-child-select choices-url="{choices_url}"{attributes.replace(" autofocus", "")}>{options}</select>
+		<label for="{self.name}">{_escape_format(self.labels[1])}</label>
+		<select id="{self.build_id()}" name="{self.name}" class="form-control" data-child-select choices-url="{{choices_url}}"{children_url}{self._build_attributes().replace(" autofocus", "")}{{readonly}}>{{options}}</select>
 	</div>
 </div>"""
 
+	def __str__(self):
+		parent_options = "\n".join("<option" + (" selected" if (value == self.selected_parent_value and self.data) else "") + f' value="{value}">{text}</option>' for value, text in self.parent_choices)
+		options = "\n".join("<option" + (" selected " if value == self.data else " ") + f'value="{value}">{text}</option>' for value, text in self.choices)
+		return self._get_skeleton().format(
+			parent_options=parent_options,
+			options=options,
+			choices_url=escape(self.choices_url or request.path),
+			readonly=self._get_readonly(),
+		)
+
 
 class DatalistField(SelectField):
+	"""
+	Text input completed with the *choices*. Up to *max_embedded_choices*, they are embedded in the page and filtered by
+	the browser. Beyond, the browser requests the matching ones while typing: GET *choices_url* (the page's one by
+	default, answered by crud_page()) with the fetch=<name>.choices, q=<prefix> and limit=<N> arguments, see search().
+	The choices should then be CachedChoices, their index being only rebuilt when they change.
 
-	def __init__(self, label, creation_request=None, choices_url=None, choices=None, **attributes):
+	"""
+
+	def __init__(self, label, creation_request=None, choices_url=None, choices=None, max_embedded_choices=100, **attributes):
 		self._creation_request = creation_request
 		super(DatalistField, self).__init__(label, choices=choices, autocomplete="off", **attributes)
 		self.choices_url = choices_url
 		self.choices = choices
+		self.max_embedded_choices = max_embedded_choices
 		self._data = None
 
+	def get_index(self):
+		if isinstance(self._choices, CachedChoices):
+			return self._choices.get_index()
+		return PrefixIndex(self.choices or ())
+
+	def search(self, prefix, limit=10):
+		"""
+		:return: the first *limit* (value, text) choices having a word starting with *prefix*
+
+		"""
+		return self.get_index().search(prefix, limit)
+
 	@property
 	def data(self):
 		return self._data
@@ -403,24 +609,38 @@ class DatalistField(SelectField):
 				except AttributeError:
 					db_id = value
 				self._data = db_id
+				if isinstance(self._choices, CachedChoices):
+					self._choices.invalidate()
 
-	def __str__(self):
-		choices_url = self.choices_url or request.path
-		id_value = self.data if self.data is not None else ""
-		choices = f'<input type="hidden" name="{self.name}-choices" value="{escape(json.dumps(self.choices))}"></input>' if self.choices is not None else ""
-		attributes = self._build_attributes()
-		try:
-			text_value = dict(self.choices)[int(id_value)]
-		except:
-			text_value = ""
+	def _build_skeleton(self):
 		return f"""<div name="{self.name}-datalist" class="form-group mb-3 datalist">
-	<label for="{self.name}">{self.label}</label>
-	<input type="text" name="{self.name}-text" class="form-control" choices-url="{self.choices_url}" value="{text_value}"{attributes}></input>
-	<input type="hidden" name="{self.name}" value="{id_value}"></input>
-	{choices}
+	<label for="{self.name}">{_escape_format(self.label)}</label>
+	<input type="text" name="{self.name}-text" class="form-control" choices-url="{{choices_url}}" value="{{text_value}}"{self._build_attributes()}{{readonly}}></input>
+	<input type="hidden" name="{self.name}" value="{{id_value}}"></input>
+	{{choices}}
 	<ul class="dropdown-menu"></ul>
 </div>"""
 
+	def __str__(self):
+		id_value = self.data if self.data is not None else ""
+		all_choices = self.choices
+		if all_choices is not None and len(all_choices) <= self.max_embedded_choices:
+			choices = f'<input type="hidden" name="{self.name}-choices" value="{escape(json.dumps(all_choices))}"></input>'
+			try:
+				text_value = dict(all_choices)[int(id_value)]
+			except:
+				text_value = ""
+		else:
+			choices = ""
+			text_value = self.get_index().get_text(id_value) if id_value != "" else ""
+		return self._get_skeleton().format(
+			text_value=text_value,
+			id_value=id_value,
+			choices=choices,
+			choices_url=escape(self.choices_url or request.path),
+			readonly=self._get_readonly(),
+		)
+
 
 QR_CODE_FORMAT = "qrcode"
 BARCODE_FORMAT = "barcode"
@@ -431,35 +651,50 @@ class BarcodeField(BaseField):
 		BaseField.__init__(self, label, **attributes)
 		self._code_format = code_format
 
-	def __str__(self):
-		value = f' value="{self.to_repr()}"' if self.data is not None else ""
-		errors = self._get_errors()
+	def _build_skeleton(self):
 		return f"""<div class="form-group mb-3" data-{self._code_format}>
-	<label for="{self.name}">{self.label}</label>
+	<label for="{self.name}">{_escape_format(self.label)}</label>
 	<div class="input-group mb-3">
 		<button class="btn btn-outline-secondary" type="button" id="scan-btn">Scan</button>
-		<input type="text" id="{self.name}-scan-input" name="{self.name}" class="form-control{" is-invalid" if errors else ""}"{value}></input>
-	</div>{errors}
+		<input type="text" id="{self.name}-scan-input" name="{self.name}" class="form-control{{invalid}}"{{value}}></input>
+	</div>{{errors}}
 	<div id="{self.name}-camera" data-camera></div>
 </div>"""
 
+	def __str__(self):
+		errors = self._get_errors()
+		return self._get_skeleton().format(
+			value=f' value="{self.to_repr()}"' if self.data is not None else "",
+			errors=errors,
+			invalid=" is-invalid" if errors else "",
+		)
+
 
 class FileField(BaseField):
+	"""
+	The uploaded file is streamed by chunks into a temporary file of the upload directory while being hashed, so that the
+	memory used does not depend on the file's size. The temporary file is moved to the upload store (see
+	uploads.UploadStore) by the upload action, or removed if the form is not valid. Since werkzeug has already received the
+	whole request body, *max_size* only bounds what is kept: the app's MAX_CONTENT_LENGTH bounds what is received.
+
+	"""
 	html_tag = "input"
 	html_type = "file"
+	CHUNK_SIZE = 64 * 1024
 
 	def __init__(self, label, max_size=(10 * 1024 * 1024), action=None, **attributes):
 		"""
 		:param max_size: maximum allowed file size in bytes (defaults to 10Mb)
-		:param action: a functor that will be given the file content as parameter
+		:param action: a functor that will be given the received file, opened in binary mode, instead of uploading it
 
 		"""
 		BaseField.__init__(self, label, **attributes)
 		self._max_size = max_size  # TODO handle max size on JS side too
-		self.action = action or self.action_upload
-		self.validators.insert(0, self.file_size_validator)
-		self._file_content = None
+		self._action = action
 		self._file_storage = None
+		self._is_oversize = False
+		self._temporary_filepath = None
+		self._remove_temporary_file = None
 
 	@property
 	def data(self):
@@ -468,33 +703,68 @@ class FileField(BaseField):
 	@data.setter
 	def data(self, value):
 		file_storage = self.form.request_object.files.get(self.name)
-		if file_storage:
-			self._file_storage = file_storage
-			self._file_content = file_storage.read()
-			_LOGGER.info("Content lenght is '%s'", len(self._file_content))
-			h = hashlib.sha256(self._file_content).hexdigest()
-			mimetype = mimetypes.guess_type(self._file_storage.filename)[0]
-			try:
-				ext = mimetypes.guess_extension(mimetype)
-			except AttributeError:
-				ext = ""
-			self._data =  h + ext
-		else:
+		if not file_storage:
 			self._data = None
+		elif file_storage is not self._file_storage:
+			self._file_storage = file_storage
+			self._data = self._receive(file_storage)
 
-	def file_size_validator(self, form, field_data):
-		if len(self._file_content) > self._max_size:
-			return _("File size is above the max (%s bytes)") % self._max_size
+	def _receive(self, file_storage):
+		"""
+		:return: the file's name: the hash of its content followed by the extension of its MIME type
 
-	def do_action(self):
-		self.action(self._file_content)
+		"""
+		self._is_oversize = (file_storage.content_length or 0) > self._max_size
+		if self._is_oversize:
+			_LOGGER.info("File '%s' is announced above the max size", file_storage.filename)
+			return file_storage.filename
+		file_hash = hashlib.sha256()
+		size = 0
+		store = UploadStore(self.upload_dir)  # Checks the upload directory before writing in it
+		temporary_file = NamedTemporaryFile(dir=store.root, prefix=TEMPORARY_FILE_PREFIX, delete=False)
+		with temporary_file:
+			for chunk in iter(partial(file_storage.stream.read, self.CHUNK_SIZE), b""):
+				size += len(chunk)
+				if size > self._max_size:
+					break
+				file_hash.update(chunk)
+				temporary_file.write(chunk)
+		self._temporary_filepath = temporary_file.name
+		self._remove_temporary_file = finalize(self, remove, temporary_file.name)
+		if size > self._max_size:
+			_LOGGER.info("File '%s' is above the max size -> upload stopped", file_storage.filename)
+			self._is_oversize = True
+			self._remove_temporary_file()
+			return file_storage.filename
+		_LOGGER.info("Content length is '%s'", size)
+		mimetype = mimetypes.guess_type(file_storage.filename)[0]
+		try:
+			ext = mimetypes.guess_extension(mimetype)
+		except AttributeError:
+			ext = ""
+		return file_hash.hexdigest() + ext
 
-	def action_upload(self, *_args, **_kwargs):
-		if self._data is None:
+	def validate(self):
+		is_invalid = BaseField.validate(self)
+		if self._is_oversize:
+			self.error_messages.insert(0, _("File size is above the max (%s bytes)") % self._max_size)
+			return True
+		return is_invalid
+
+	def do_action(self):
+		if self._remove_temporary_file is None or not self._remove_temporary_file.alive:
 			return
+		if self._action is None:
+			self.action_upload()
+		else:
+			with open(self._temporary_filepath, "rb") as f:
+				self._action(f)
+			self._remove_temporary_file()
+
+	def action_upload(self):
 		_LOGGER.info("Uploading file '%s'", self._file_storage.filename)
-		filepath = expanduser(join(self.upload_dir, self._data))
-		self._file_storage.seek(0)
-		self._file_storage.save(filepath)
+		store = UploadStore(self.upload_dir)
+		self._remove_temporary_file.detach()
+		store.add(self._temporary_filepath, self._data)
 		self._file_storage.close()
-		_LOGGER.info("File '%s' saved as '%s'", self._file_storage.filename, filepath)
+		_LOGGER.info("File '%s' stored as '%s'", self._file_storage.filename, store.get_path(self._data))
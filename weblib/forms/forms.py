@@ -3,16 +3,19 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
 import logging
+from copy import copy
 from os import environ
+from threading import Lock
 
-from bcrypt import checkpw
 from flask import request
 from flask_babel import gettext as _, lazy_gettext as _l
 from markupsafe import Markup
 from weblib.requests import get_roles_choices, get_user_by_username
 from werkzeug.datastructures import MultiDict
 
-from weblib.forms.fields import BooleanField, FileField, HiddenField, PasswordField, SelectField, TextField
+from weblib.forms.fields import BooleanField, CachedChoices, FileField, HiddenField, PasswordField, SelectField, TextField
+from weblib.models import RoleModel
+from weblib.passwords import HashingOverloadException, get_hashing_keys, password_hasher
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -23,32 +26,60 @@ class UnknownFieldException(Exception):
 
 
 class BaseForm:
+	"""
+	The fields declared in the class' **fields** dict are initialized once per class. Each form instance works on its own
+	shallow copies of them so that concurrent requests do not share their data nor their error messages.
+
+	"""
 	_is_initialized = False
+	_initialization_lock = Lock()
+	_form_classes = {}
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls.form_path = f"{cls.__module__}.{cls.__qualname__}"
+		BaseForm._form_classes[cls.form_path] = cls
+
+	@staticmethod
+	def get_form_class(form_path):
+		"""
+		:return: the form class whose qualified name (module and class) is *form_path*, None if there is none
+
+		"""
+		return BaseForm._form_classes.get(form_path)
 
 	def __new__(cls, *_args, **_kwargs):
 		if not cls._is_initialized:
-			cls.form_name = cls.__name__.lower()
-			_LOGGER.info(f"Initializing from '{cls.form_name}'")
-			upload_dir = environ.get('UPLOAD_DIR', environ['HOME'])
-			is_first_field = True
-			for name, field in cls.fields.items():
-				field.name = name
-				field.form_name = cls.form_name
-				field.upload_dir = upload_dir
-				if not isinstance(field, HiddenField):
-					field.is_first_field = is_first_field
-					is_first_field = False
-				try:
-					model_field = field.label
-					field.label = getattr(model_field, name).i18n
-					field.units = getattr(model_field, name).units
-				except AttributeError:
-					pass
-			cls.fields['id'] = HiddenField()
-			cls.fields['id'].name = "id"
-			cls._is_initialized = True
+			with cls._initialization_lock:
+				if not cls._is_initialized:
+					cls._initialize_fields()
 		return super(BaseForm, cls).__new__(cls)
 
+	@classmethod
+	def _initialize_fields(cls):
+		cls.form_name = cls.__name__.lower()
+		_LOGGER.info(f"Initializing from '{cls.form_name}'")
+		upload_dir = environ.get('UPLOAD_DIR', environ['HOME'])
+		is_first_field = True
+		for name, field in cls.fields.items():
+			field.name = name
+			field.form_name = cls.form_name
+			field.form_path = cls.form_path
+			field.upload_dir = upload_dir
+			if not isinstance(field, HiddenField):
+				field.is_first_field = is_first_field
+				is_first_field = False
+			try:
+				model_field = field.label
+				field.label = getattr(model_field, name).i18n
+				field.units = getattr(model_field, name).units
+			except AttributeError:
+				pass
+			field.compile()
+		cls.fields['id'] = HiddenField()
+		cls.fields['id'].name = "id"
+		cls._is_initialized = True
+
 	def __init__(self, db_dict=None, request_object=request):
 		"""
 		The data of the form's fields are populated from the dict of the Flask request's form. If the db_dict parameter is set,
@@ -56,6 +87,7 @@ class BaseForm:
 
 		"""
 		self.request_object = request_object
+		self.fields = dict([(key, copy(field)) for key, field in type(self).fields.items()])
 		if db_dict is None:
 			form_dict = request_object.form
 			is_from_db = False
@@ -137,6 +169,9 @@ def equal_to_field(field_name):
 	return wrapped
 
 
+roles_choices = CachedChoices(get_roles_choices, tags=(RoleModel, ))
+
+
 def validate_username_unique(form, field_data):
 	if get_user_by_username(field_data) is not None:
 		return _('Username already exists')
@@ -149,7 +184,7 @@ class RegistrationForm(BaseForm):
 		'password_confirmation': PasswordField(_l("Password confirmation"), required=True, validators=(equal_to_field('password'), )),
 		'first_name': TextField(_l("First name"), required=True),
 		'last_name': TextField(_l("Last name"), required=True),
-		'roles': SelectField(_l("Roles"), choices=get_roles_choices, multiple=True, required=True),
+		'roles': SelectField(_l("Roles"), choices=roles_choices, multiple=True, required=True),
 	}
 
 
@@ -171,7 +206,7 @@ class ModifyPasswordForm(BaseForm):
 class ModifyRolesForm(BaseForm):
 	fields = {
 		'user_id': HiddenField(),
-		'roles': SelectField(_l("Roles"), choices=get_roles_choices, multiple=True, required=True),
+		'roles': SelectField(_l("Roles"), choices=roles_choices, multiple=True, required=True),
 	}
 
 
@@ -181,8 +216,13 @@ def validate_username(form, field_data):
 		return _("Invalid user")
 
 def validate_password(form, field_data):
-	if form.user is not None and not checkpw(form.password.data.encode(), form.user.password.encode()):
-		return _("Invalid password")
+	if form.user is None:
+		return None
+	try:
+		if not password_hasher.verify(form.password.data, form.user.password, keys=get_hashing_keys(form.user.username)):
+			return _("Invalid password")
+	except HashingOverloadException:
+		return _("Too many login attempts, please retry later")
 
 
 class LoginForm(BaseForm):
@@ -0,0 +1,188 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Cache of the rendered HTML fragments, usable from the templates:
+
+	{% cache "footer" %}...{% endcache %}
+	{% cache "user_menu", current_user.username, current_user.is_admin %}...{% endcache %}
+
+or from the code with fragment_cache.get_or_render(). A fragment is cached per name and vary keys (the values its HTML
+depends on, besides the locale and the app version which are always part of the key). The vary keys must be strings,
+numbers, booleans, None or tuples of them so that the key is the same in every process.
+
+"""
+import logging
+import sqlite3
+import threading
+from collections import Counter, OrderedDict
+from hashlib import sha1
+
+from flask import current_app, has_app_context
+from flask_babel import get_locale
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+_LOGGER = logging.getLogger(__name__)
+
+# Key of the app version whose fragments the backend stores, not a hash so that it never collides with the fragment keys
+APP_VERSION_KEY = "app_version"
+
+
+class LRUBackend:
+	"""
+	In process backend keeping the *max_size* most recently used fragments.
+
+	"""
+
+	def __init__(self, max_size=1024):
+		self.max_size = max_size
+		self._fragments = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			try:
+				self._fragments.move_to_end(key)
+			except KeyError:
+				return None
+			return self._fragments[key]
+
+	def set(self, key, html):
+		with self._lock:
+			self._fragments[key] = html
+			self._fragments.move_to_end(key)
+			while len(self._fragments) > self.max_size:
+				self._fragments.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._fragments.clear()
+
+	def __len__(self):
+		return len(self._fragments)
+
+
+class SqliteBackend:
+	"""
+	Backend shared by the processes of the host, stored in the SQLite file *path*.
+
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._local = threading.local()
+		self._get_connection().execute("CREATE TABLE IF NOT EXISTS fragment (key TEXT PRIMARY KEY, html TEXT NOT NULL)")
+
+	def _get_connection(self):
+		connection = getattr(self._local, 'connection', None)
+		if connection is None:
+			connection = self._local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+			connection.execute("PRAGMA journal_mode=WAL")
+		return connection
+
+	def get(self, key):
+		row = self._get_connection().execute("SELECT html FROM fragment WHERE key = ?", (key, )).fetchone()
+		return row[0] if row else None
+
+	def set(self, key, html):
+		self._get_connection().execute("INSERT OR REPLACE INTO fragment (key, html) VALUES (?, ?)", (key, html))
+
+	def clear(self):
+		self._get_connection().execute("DELETE FROM fragment")
+
+	def __len__(self):
+		return self._get_connection().execute("SELECT COUNT(*) FROM fragment").fetchone()[0]
+
+
+class FragmentCache:
+
+	def __init__(self, backend=None):
+		self._lock = threading.Lock()
+		self.configure(backend)
+
+	def configure(self, backend=None):
+		"""
+		:param backend: LRUBackend, SqliteBackend or any object having their get(), set(), clear() and __len__() methods.
+			An LRUBackend by default.
+
+		"""
+		self.backend = backend if backend is not None else LRUBackend()
+		self.hits = Counter()
+		self.misses = Counter()
+
+	@staticmethod
+	def get_key(name, vary=()):
+		locale = get_locale()
+		app_version = current_app.config.get('APP_VERSION') if has_app_context() else None
+		return sha1(repr((name, str(locale) if locale else None, app_version) + tuple(vary)).encode()).hexdigest()
+
+	def get_or_render(self, name, vary, render):
+		"""
+		:param vary: the values the HTML of the fragment depends on
+		:param render: function returning the HTML of the fragment, called if it is not cached
+		:return: the HTML of the fragment *name* for the *vary* keys
+
+		"""
+		key = self.get_key(name, vary)
+		html = self.backend.get(key)
+		with self._lock:
+			(self.misses if html is None else self.hits)[name] += 1
+		if html is None:
+			html = str(render())
+			self.backend.set(key, html)
+		return Markup(html)
+
+	def clear(self):
+		self.backend.clear()
+
+	def set_app_version(self, app_version):
+		"""
+		Clears the fragments if the backend was last used by another *app_version*. The fragments of the current version
+		are kept, a shared backend being used by all the processes of the app.
+
+		"""
+		app_version = repr(app_version)
+		if self.backend.get(APP_VERSION_KEY) != app_version:
+			_LOGGER.info("Clearing the fragments of the previous app version")
+			self.backend.clear()
+			self.backend.set(APP_VERSION_KEY, app_version)
+
+	def get_metrics(self):
+		with self._lock:
+			return {
+				'backend': type(self.backend).__name__,
+				'size': len(self.backend),
+				'fragments': {
+					name: {'hits': self.hits[name], 'misses': self.misses[name]}
+					for name in sorted(set(self.hits) | set(self.misses))
+				},
+			}
+
+
+fragment_cache = FragmentCache()
+
+
+class FragmentCacheExtension(Extension):
+	"""
+	Adds the {% cache name[, vary key...] %}...{% endcache %} tag to the templates, caching in fragment_cache.
+
+	"""
+	tags = {'cache'}
+
+	def parse(self, parser):
+		lineno = next(parser.stream).lineno
+		name = parser.parse_expression()
+		vary = []
+		while parser.stream.skip_if('comma'):
+			vary.append(parser.parse_expression())
+		body = parser.parse_statements(('name:endcache', ), drop_needle=True)
+		return nodes.CallBlock(
+			self.call_method('_render', [name, nodes.Tuple(vary, 'load')]), [], [], body
+		).set_lineno(lineno)
+
+	@staticmethod
+	def _render(name, vary, caller):
+		return fragment_cache.get_or_render(name, vary, caller)
@@ -5,8 +5,7 @@
 from flask import redirect, url_for
 from flask_login import LoginManager
 
-from weblib.models import User
-from weblib.requests import get_users
+from weblib.requests import has_any_registered_user, user_cache
 
 login_manager = LoginManager()
 login_manager.login_view = "user_views.login"
@@ -15,11 +14,11 @@ login_manager.refresh_view = "user_views.login"
 
 @login_manager.user_loader
 def load_user(user_id):
-	return User.get_or_none(id=user_id)
+	return user_cache.get(user_id)
 
 
 @login_manager.unauthorized_handler
 def unauthorized():
-	for r in get_users().query:
+	if has_any_registered_user():
 		return redirect(url_for(login_manager.login_view))
 	return redirect("/user/register")
@@ -0,0 +1,31 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Initializes or migrates the DB, to be run once before (re)starting the web server whose processes only check the DB
+versions, see FlaskApp.create_app(is_migrating=False).
+
+Usage: python3 weblib/migrate.py [--cleanup | --cleanup-app-part]
+
+"""
+import argparse
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="DB initialization and migration")
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument('--cleanup', action='store_true', help="drop all the tables before initializing the DB")
+	group.add_argument('--cleanup-app-part', action='store_true', help="drop the app's tables before initializing the DB")
+	args = parser.parse_args()
+
+	from weblib.server import create_app
+	create_app(cleanup=args.cleanup, cleanup_app_part=args.cleanup_app_part)
+	_LOGGER.info("DB is up to date")
+
+
+if __name__ == "__main__":
+	main()
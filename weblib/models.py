@@ -10,7 +10,7 @@ from os.path import join
 from flask import request
 from flask_babel import lazy_gettext as _l
 from flask_login import UserMixin
-from peewee import BooleanField, DecimalField, ForeignKeyField, IntegerField, Metadata, TextField, make_snake_case
+from peewee import BooleanField, DecimalField, ForeignKeyField, IntegerField, Metadata, TextField, chunked, make_snake_case
 from playhouse.flask_utils import FlaskDB
 
 from weblib.database import AbstractMigrator
@@ -34,7 +34,7 @@ class PriceField(DecimalField):
 
 
 class FileField(TextField):
-	# TODO manage deletion. For now on, the filename is removed from the DB but the file itself is not removed from the filesystem
+	# The files no longer referenced by any FileField column are removed by the upload store's GC (see uploads.py)
 
 	mime2fa = {
 		'': "-archive",
@@ -75,13 +75,39 @@ class _BaseMetadata(Metadata):
 		return make_snake_case(re.sub(r'model$', '', self.model.__name__.lower()))
 
 
+# Functions called with the model class after each save() or delete_instance() of an instance of a versioned model
+table_modified_listeners = []
+
+
 class BaseModel(flask_db.Model):
+	"""
+	The saves and deletions of instances are notified to the table_modified_listeners. The modifications made by queries
+	(insert(), update(), delete()...) are not: views.table_modified() must be called after them.
+
+	"""
+	is_versioned = True
 
 	class Meta:
 		model_metadata_class = _BaseMetadata
 
+	def _notify_table_modified(self):
+		if self.is_versioned:
+			for listener in table_modified_listeners:
+				listener(type(self))
+
+	def save(self, *args, **kwargs):
+		result = super().save(*args, **kwargs)
+		self._notify_table_modified()
+		return result
+
+	def delete_instance(self, *args, **kwargs):
+		result = super().delete_instance(*args, **kwargs)
+		self._notify_table_modified()
+		return result
+
 
 class DatabaseVersionModel(BaseModel):
+	is_versioned = False
 	lib = IntegerField(null=True, unique=True)
 	app = IntegerField(null=True, unique=True)
 
@@ -95,17 +121,63 @@ class User(UserMixin, BaseModel):
 	last_name = TextField()
 	last_name.i18n = _l("Last name")
 	active = BooleanField(default=True)
-	roles = TextField()  # not used anymore. Keep it for DB migration
+	legacy_roles = TextField(column_name="roles", default="")  # not used anymore. Keep it for DB migration
 
-	def __init__(self, *args, **kwargs):
-		super(User, self).__init__(*args, **kwargs)
+	@property
+	def roles(self):
+		"""
+		The names of the user's roles. They are queried on first access unless they were already loaded by
+		prefetch_roles() or by the query that built the user.
+
+		"""
+		try:
+			return self._roles
+		except AttributeError:
+			self.roles = [r.role.name for r in (UserRole
+				.select(RoleModel.name)
+				.where(UserRole.user == self.id)
+				.join(RoleModel)
+			)]
+			return self._roles
+
+	@roles.setter
+	def roles(self, value):
+		self._roles = tuple(value)
+		self._role_set = frozenset(self._roles)
+
+	@property
+	def role_set(self):
+		"""
+		The user's roles as a frozenset, for the permission checks (see roles.PermissionIndex).
+
+		"""
+		try:
+			return self._role_set
+		except AttributeError:
+			self.roles  # pylint: disable=pointless-statement
+			return self._role_set
+
+	@classmethod
+	def prefetch_roles(cls, users):
+		"""
+		Loads the roles of all the given users with a single query.
+
+		:return: the users as a list.
+
+		"""
+		users = list(users)
+		roles = dict([(user.id, []) for user in users])
 		query = (UserRole
-			.select(RoleModel.name)
-			.where(UserRole.user == self.id)
+			.select(UserRole.user, RoleModel.name)
 			.join(RoleModel)
+			.where(UserRole.user.in_(list(roles)))
+			.tuples()
 		)
-		self.roles = tuple(r.role.name for r in query)
-		#_LOGGER.debug("Current user roles are '%s'", self.roles)
+		for user_id, role_name in query:
+			roles[user_id].append(role_name)
+		for user in users:
+			user.roles = roles[user.id]
+		return users
 
 	@property
 	def is_active(self):
@@ -129,15 +201,27 @@ class UserRole(BaseModel):
 	role = ForeignKeyField(RoleModel)
 
 
+class TableVersionModel(BaseModel):
+	"""
+	Version of the content of a table, bumped each time the table is modified through weblib. Used as a cheap validator
+	of the tables' content (ETag).
+
+	"""
+	is_versioned = False
+	name = TextField(unique=True)
+	version = IntegerField(default=0)
+
+
 WEBLIB_MODELS = [
 	DatabaseVersionModel,
 	User,
 	RoleModel,
 	UserRole,
+	TableVersionModel,
 ]
 
 
-VERSION = 4
+VERSION = 5
 
 
 class MigratorException(Exception):
@@ -151,29 +235,34 @@ class Migrator(AbstractMigrator):
 
 	def migrate_to_version_3(self):
 		ROLES_SEP = ','
-		for user in User.select():
-			roles = user.roles
-			_LOGGER.info("Current '%s' roles : '%s'", user.username, roles)
+		users_by_roles = {}
+		for user_id, username, roles in User.select(User.id, User.username, User.legacy_roles).tuples():
+			_LOGGER.info("Current '%s' roles : '%s'", username, roles)
 			roles = ROLES_SEP.join([r for r in roles.split(ROLES_SEP) if r != "user"])
-			_LOGGER.info("New '%s' roles : '%s'", user.username, roles)
-			query = User.update({'roles': roles}).where(User.id == user.id)
-			if query.execute() != 1:
+			_LOGGER.info("New '%s' roles : '%s'", username, roles)
+			users_by_roles.setdefault(roles, []).append(user_id)
+		for roles, user_ids in users_by_roles.items():
+			query = User.update({User.legacy_roles: roles}).where(User.id.in_(user_ids))
+			if query.execute() != len(user_ids):
 				raise MigratorException("Could not upgrade roles")
 
 	def migrate_to_version_4(self):
 		ROLES_SEP = ','
 		_LOGGER.info("Creating tables RoleModel and UserRole")
 		self._db.create_tables((RoleModel, UserRole))
-		for role in AVAILABLE_ROLES:
-			if RoleModel.get_or_none(name=role) is None:
-				_LOGGER.info("Populating roles table with '%s'", role)
-				RoleModel.create(name=role)
-		roles_map = {}
-		for role in RoleModel.select():
-			roles_map[role.name] = role.id
-		for user_id, roles in User.select(User.id, User.roles).tuples():
+		_LOGGER.info("Populating roles table with '%s'", AVAILABLE_ROLES)
+		RoleModel.insert_many([(role, ) for role in AVAILABLE_ROLES], fields=[RoleModel.name]).on_conflict_ignore().execute()
+		roles_map = dict(RoleModel.select(RoleModel.name, RoleModel.id).tuples())
+		user_roles = set()
+		for user_id, roles in User.select(User.id, User.legacy_roles).tuples():
 			for role in roles.split(ROLES_SEP):
 				if role == "manager":
 					role = ROLE_USER
-				_LOGGER.info("Populating UserRole table with %s,%s", user_id, role)
-				UserRole.create(user=user_id, role=roles_map[role])
+				user_roles.add((user_id, roles_map[role]))
+		_LOGGER.info("Populating UserRole table with %s rows", len(user_roles))
+		for batch in chunked(sorted(user_roles), 500):
+			UserRole.insert_many(batch, fields=[UserRole.user, UserRole.role]).execute()
+
+	def migrate_to_version_5(self):
+		_LOGGER.info("Creating table TableVersionModel")
+		self._db.create_tables((TableVersionModel, ))
@@ -0,0 +1,130 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from bcrypt import checkpw, gensalt, hashpw
+from flask import has_request_context, request
+from werkzeug.exceptions import TooManyRequests
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class HashingOverloadException(TooManyRequests):
+	pass
+
+
+class PasswordHasher:
+	"""
+	Runs the bcrypt computations (about 250 ms each at cost 12) in a bounded pool of threads, bcrypt releasing the GIL
+	while hashing. A burst of logins can thus not use more than *workers* CPUs. The hashes waiting for a thread are limited
+	to *max_pending*, and each user and IP address can only have *max_per_user* and *max_per_ip* hashes pending at once
+	(see get_hashing_keys()): beyond, HashingOverloadException is raised instead of queueing more work. It is also raised
+	when a hash is not computed within *timeout* seconds. A hash stays accounted as pending until it is computed, even if
+	its caller gave up waiting.
+
+	"""
+
+	def __init__(self, **kwargs):
+		self._lock = threading.Lock()
+		self._pending_by_key = Counter()
+		self._executor = None
+		self.configure(**kwargs)
+
+	def configure(self, cost=12, workers=2, max_pending=16, max_per_user=1, max_per_ip=8, timeout=10):
+		"""
+		:param cost: the bcrypt cost of the new hashes, the existing ones being rehashed at login if it changed
+		:param timeout: seconds waiting for a hash before giving up
+
+		"""
+		self.cost = cost
+		self._max_per_key_kind = {'user': max_per_user, 'ip': max_per_ip}
+		self.timeout = timeout
+		self._pending = threading.BoundedSemaphore(max_pending)
+		if self._executor is not None:
+			self._executor.shutdown(wait=False)
+		self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+
+	def _acquire(self, keys):
+		"""
+		:return: the release function of the pending hash accounted for the *keys*
+
+		"""
+		keys = [key for key in keys if key]
+		pending = self._pending  # The one to release, even if configure() replaced it in between
+		with self._lock:
+			if any(self._pending_by_key[key] >= self._max_per_key_kind[key[0]] for key in keys):
+				_LOGGER.warning("Too many password hashes pending for '%s'", keys)
+				raise HashingOverloadException()
+			if not pending.acquire(blocking=False):
+				_LOGGER.warning("Too many password hashes pending")
+				raise HashingOverloadException()
+			self._pending_by_key.update(keys)
+
+		def release(_future=None):
+			pending.release()
+			with self._lock:
+				self._pending_by_key.subtract(keys)
+				self._pending_by_key += Counter()  # Drop the keys having no more pending hashes
+
+		return release
+
+	def _run(self, keys, function, *args):
+		release = self._acquire(keys)
+		try:
+			future = self._executor.submit(function, *args)
+		except BaseException:
+			release()
+			raise
+		is_computing = False
+		try:
+			return future.result(timeout=self.timeout)
+		except FutureTimeoutError:
+			_LOGGER.warning("Password hash not computed within %s s", self.timeout)
+			is_computing = True
+			raise HashingOverloadException()
+		finally:
+			# Released before returning so that the next hash of the same user is not refused
+			if is_computing:
+				future.add_done_callback(release)
+			else:
+				release()
+
+	def hash(self, password, keys=()):
+		"""
+		:return: the hash of the *password*, as a string
+
+		"""
+		return self._run(keys, hashpw, password.encode(), gensalt(self.cost)).decode()
+
+	def verify(self, password, password_hash, keys=()):
+		return self._run(keys, checkpw, password.encode(), password_hash.encode())
+
+	def needs_rehash(self, password_hash):
+		"""
+		:return: True if the *password_hash* was not computed with the current cost
+
+		"""
+		try:
+			return int(password_hash.split("$")[2]) != self.cost
+		except (IndexError, ValueError):
+			return True
+
+
+def get_hashing_keys(username=None):
+	"""
+	:return: the keys limiting the password hashes pending for the *username* and the IP address of the request
+
+	"""
+	return (
+		('user', username) if username else None,
+		('ip', request.remote_addr) if has_request_context() else None,
+	)
+
+
+password_hasher = PasswordHasher()
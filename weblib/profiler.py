@@ -0,0 +1,113 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Request scoped profiler: the number and duration of the DB queries and the time spent in the rendering of the pages,
+the building of the tables and the JSON serialization are sent in the Server-Timing header of each response and logged
+in one line per request. Enabled by the IS_PROFILING_REQUESTS config, for the development and the load tests.
+
+"""
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from peewee import Proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class RequestProfile:
+
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.durations = defaultdict(float)
+		self.counts = defaultdict(int)
+		self.status = None
+		self.json_size = None
+
+	def add(self, section, duration):
+		self.durations[section] += duration
+		self.counts[section] += 1
+
+	@property
+	def total(self):
+		return time.perf_counter() - self.start
+
+	@property
+	def server_timing(self):
+		entries = [f'{section};desc="{self.counts[section]}";dur={duration * 1000:.1f}' for section, duration in self.durations.items()]
+		entries.append(f"total;dur={self.total * 1000:.1f}")
+		return ", ".join(entries)
+
+
+@contextmanager
+def timed(section):
+	"""
+	Accounts the time spent in the block (or the decorated function) in the *section* of the current request's profile.
+	Does nothing outside of a request or if the profiler is not enabled.
+
+	"""
+	profile = g.get('_profile') if has_request_context() else None
+	if profile is None:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		profile.add(section, time.perf_counter() - start)
+
+
+class RequestProfiler:
+
+	def init_app(self, app, database):
+		"""
+		:param database: its queries are timed in the 'db' section by wrapping its execute_sql()
+
+		"""
+		database = database.obj if isinstance(database, Proxy) else database
+		execute_sql = database.execute_sql
+
+		def profiled_execute_sql(sql, *args, **kwargs):
+			with timed('db'):
+				return execute_sql(sql, *args, **kwargs)
+
+		database.execute_sql = profiled_execute_sql
+		app.before_request(self._start)
+		app.after_request(self._set_header)
+		app.teardown_request(self._log)
+
+	@staticmethod
+	def _start():
+		g._profile = RequestProfile()
+
+	@staticmethod
+	def _set_header(response):
+		profile = g.get('_profile')
+		if profile is not None:
+			profile.status = response.status_code
+			if response.is_json and not response.is_streamed:
+				profile.json_size = response.content_length
+			response.headers['Server-Timing'] = profile.server_timing
+		return response
+
+	@staticmethod
+	def _log(_exception=None):
+		profile = g.pop('_profile', None)
+		if profile is None:
+			return
+		_LOGGER.info(
+			"Profile method=%s path=%s status=%s total_ms=%.1f %s json_bytes=%s",
+			request.method,
+			request.path,
+			profile.status,
+			profile.total * 1000,
+			" ".join(
+				f"{section}_count={profile.counts[section]} {section}_ms={duration * 1000:.1f}"
+				for section, duration in profile.durations.items()
+			),
+			profile.json_size,
+		)
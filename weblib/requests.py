@@ -4,14 +4,22 @@
 #
 import datetime
 import logging
-
-from babel.dates import format_date, format_datetime
-from flask_babel import gettext as _
+import operator
+import threading
+import time
+from collections import OrderedDict
+from functools import reduce
+
+from babel.core import Locale
+from babel.dates import LC_TIME, parse_pattern
+from flask_babel import get_locale, gettext as _
 from flask_babel import lazy_gettext as _l
-from peewee import ProgrammingError
+from peewee import (JOIN, BooleanField, DateField, DateTimeField, ProgrammingError, Proxy, SelectBase, SqliteDatabase, chunked,
+	fn)
 
 from weblib.models import VERSION as WEBLIB_VERSION
-from weblib.models import DatabaseVersionException, DatabaseVersionModel, RoleModel, User, UserRole, flask_db
+from weblib.models import (DatabaseVersionException, DatabaseVersionModel, RoleModel, TableVersionModel, User, UserRole,
+	flask_db)
 from weblib.roles import AVAILABLE_ROLES
 
 _LOGGER = logging.getLogger(__name__)
@@ -28,81 +36,359 @@ class TableRequestResult:
 		self.model_fields_for_compute = model_fields_for_compute or []
 
 
+class TablePage:
+	"""
+	Server side pagination, sorting and filtering of a table as requested by the query arguments of its content URL:
+	``offset``, ``limit``, ``sort`` (a column name, prefixed by ``-`` for a descending order) and ``q`` (a text to search in
+	all the columns). The ``limit`` is clamped to MAX_LIMIT rows (the TABLE_MAX_LIMIT config).
+
+	"""
+	MAX_LIMIT = 1000
+
+	def __init__(self, offset=0, limit=None, sort=None, text_filter=None):
+		self.offset = max(offset, 0)
+		self.limit = None if limit is None else min(max(limit, 0), self.MAX_LIMIT)
+		self.sort = sort
+		self.text_filter = text_filter
+
+	@classmethod
+	def from_args(cls, args):
+		return cls(
+			offset=args.get('offset', 0, type=int),
+			limit=args.get('limit', None, type=int),
+			sort=args.get('sort') or None,
+			text_filter=args.get('q') or None,
+		)
+
+	@property
+	def is_paginated(self):
+		return self.limit is not None
+
+	@property
+	def is_descending(self):
+		return bool(self.sort) and self.sort.startswith('-')
+
+	def _get_sort_column(self, columns):
+		if not self.sort:
+			return None, None
+		column_name = self.sort.lstrip('-')
+		for idx, column in enumerate(columns):
+			if getattr(column, 'column_name', None) == column_name:
+				return idx, column
+		_LOGGER.warning("Can not sort on unknown column '%s'", column_name)
+		return None, None
+
+	def apply(self, query, columns):
+		"""
+		:param query: either a peewee query (filtered, sorted and paginated by the DB) or an iterable of rows with the ID as first element.
+		:param columns: the DB Model fields corresponding to the columns of the rows.
+		:return: the (query, total_count) pair. The total count is the number of filtered rows and is only computed when paginated.
+
+		"""
+		if isinstance(query, SelectBase):
+			return self._apply_to_query(query, columns)
+		return self._apply_to_rows(query, columns)
+
+	def _apply_to_query(self, query, columns):
+		if self.text_filter:
+			predicate = reduce(operator.or_, [column.unwrap().cast('text').contains(self.text_filter) for column in columns])
+			# The aggregated columns of a grouped query can only be filtered after the grouping
+			query = query.having(predicate) if query._group_by else query.where(predicate)
+		_idx, column = self._get_sort_column(columns)
+		if column is not None:
+			query = query.order_by(column.unwrap().desc() if self.is_descending else column.unwrap().asc())
+		if not self.is_paginated:
+			return query, None
+		return query.offset(self.offset).limit(self.limit), query.count()
+
+	def _apply_to_rows(self, rows, columns):
+		rows = list(rows)
+		if self.text_filter:
+			text_filter = self.text_filter.lower()
+			rows = [row for row in rows if any(text_filter in str(value).lower() for value in row[1:len(columns) + 1] if value is not None)]
+		idx, column = self._get_sort_column(columns)
+		if column is not None:
+			rows.sort(key=lambda row: (row[idx + 1] is None, row[idx + 1]), reverse=self.is_descending)
+		if not self.is_paginated:
+			return rows, None
+		return rows[self.offset:self.offset + self.limit], len(rows)
+
+
 def alias(field, alias_name, i18n):
 	aliased_field = field.alias(alias_name)
 	aliased_field.i18n = i18n
 	return aliased_field
 
 
-def translate_field(field_value, model_field=None, is_internationalizable=False):
-	try:
-		return model_field.renderer(field_value)
-	except:
-		pass #_LOGGER.debug("Model '%s' doesn't have a renderer -> will duck translate", model_field)
-	if field_value is None:
-		field_value = ""
-	elif field_value is True:
-		field_value = _("Yes")
-	elif field_value is False:
-		field_value = _("No")
-	elif isinstance(field_value, datetime.date):
-		if isinstance(field_value, datetime.datetime):  # FIXME don not consider < 1970 as a non populated field
-			if field_value > datetime.datetime(1970, 1, 1):
-				if getattr(model_field, 'display_date_only', False):
-					field_value = format_date(field_value, "dd/MM/yyyy")
-				else:
-					field_value = format_datetime(field_value, "dd/MM/yyyy HH:mm")
-			else:
-				field_value = ""
-		else:
-			if field_value > datetime.date(1970, 1, 1):
-				field_value = format_date(field_value, "dd/MM/yyyy")
-			else:
-				field_value = ""
-	else:
-		try:
+def _build_date_translators(model_field):
+	locale = Locale.parse(LC_TIME)
+	date_pattern = parse_pattern("dd/MM/yyyy")
+	datetime_pattern = date_pattern if getattr(model_field, 'display_date_only', False) else parse_pattern("dd/MM/yyyy HH:mm")
+
+	def translate_date(field_value):
+		if field_value is None or field_value <= datetime.date(1970, 1, 1):  # FIXME don not consider < 1970 as a non populated field
+			return ""
+		return date_pattern.apply(field_value, locale)
+
+	def translate_datetime(field_value):
+		if field_value is None or field_value <= datetime.datetime(1970, 1, 1):
+			return ""
+		return datetime_pattern.apply(field_value, locale)
+
+	return translate_date, translate_datetime
+
+
+def _build_value_translator(model_field):
+	lut = getattr(model_field, 'lut', None)
+	if callable(lut):
+		return lambda field_value: str(lut(field_value))
+	elif hasattr(lut, 'get'):
+		return lambda field_value: str(lut.get(field_value))
+	return str
+
+
+def build_field_translator(model_field=None):
+	"""
+	Resolves once the function that translates the values of a column for being displayed, depending on the model field's
+	renderer, type, lut and display_date_only attributes. The returned function never raises for the values the DB can
+	give for this field.
+
+	"""
+	renderer = getattr(model_field, 'renderer', None)
+	if renderer is not None:
+		return renderer
+
+	yes, no = _("Yes"), _("No")
+	if isinstance(model_field, BooleanField):
+		return lambda field_value: "" if field_value is None else (yes if field_value else no)
+
+	translate_date, translate_datetime = _build_date_translators(model_field)
+	if isinstance(model_field, (DateField, DateTimeField)):
+		return lambda field_value: translate_datetime(field_value) if isinstance(field_value, datetime.datetime) else translate_date(field_value)
+
+	translate_value = _build_value_translator(model_field)
+
+	def translate_any(field_value):
+		if field_value is None:
+			return ""
+		elif field_value is True:
+			return yes
+		elif field_value is False:
+			return no
+		elif isinstance(field_value, datetime.datetime):
+			return translate_datetime(field_value)
+		elif isinstance(field_value, datetime.date):
+			return translate_date(field_value)
+		return translate_value(field_value)
+
+	return translate_any
+
+
+def build_row_translator(model_fields):
+	"""
+	:param model_fields: the list of DB Model fields corresponding to the columns of the rows.
+	:return: a function translating a whole row with one translator per column resolved once.
+
+	"""
+	translators = tuple([build_field_translator(model_field) for model_field in model_fields])
+
+	def translate(row):
+		return tuple([translator(field_value) for translator, field_value in zip(translators, row)])
+
+	return translate
+
+
+class RowTranslatorCache:
+	"""
+	Per process cache of the row translators (see build_row_translator()) per model fields and locale, keeping the
+	*max_size* most recently used ones. The fields are compared by identity since peewee overloads their == operator;
+	they are kept alive by their entry so that their ids are not reused.
+
+	"""
+
+	def __init__(self, max_size=256):
+		self.max_size = max_size
+		self._translators = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, model_fields):
+		locale = get_locale()
+		key = (tuple(id(model_field) for model_field in model_fields), str(locale) if locale else None)
+		with self._lock:
 			try:
-				field_value = model_field.lut(field_value)
-			except TypeError:
-				field_value = str(model_field.lut.get(field_value))
-			_LOGGER.debug("Translated field '%s' value -> '%s'", model_field.__name__, model_field)
-		except AttributeError:
-			field_value = str(field_value)
+				self._translators.move_to_end(key)
+				return self._translators[key][1]
+			except KeyError:
+				pass
+		translate = build_row_translator(model_fields)
+		with self._lock:
+			self._translators[key] = (tuple(model_fields), translate)
+			while len(self._translators) > self.max_size:
+				self._translators.popitem(last=False)
+		return translate
+
 
-	return field_value
+row_translator_cache = RowTranslatorCache()
+
+
+def translate_field(field_value, model_field=None, is_internationalizable=False):
+	return row_translator_cache.get((model_field, ))((field_value, ))[0]
 
 
 def translate_row(row, model_fields=None, internationalizable_fields=()):
-	if not model_fields:
-		model_fields = [None] * len(row)
-	return tuple([
-		translate_field(field_value, model_field=model_field, is_internationalizable=not internationalizable_fields or getattr(model_field, 'column_name', False) in internationalizable_fields)
-		for field_value, model_field in zip(row, model_fields)
-	])
+	return row_translator_cache.get(model_fields or (None, ) * len(row))(row)
 
 
 def request_table(model_fields, query):
 	header = dict([(field.column_name, {'i18n': field.i18n, 'values': ()}) for field in model_fields])
-	return {'header': header, 'rows': tuple([(r[0], translate_row(r[1:], model_fields)) for r in query])}
+	translate = build_row_translator(model_fields)
+	return {'header': header, 'rows': tuple([(r[0], translate(r[1:])) for r in query])}
+
+
+class UserCache:
+	"""
+	Per process cache of the users with their roles, keyed by user ID, for identifying the user of each request without
+	querying the DB. Each user is cached with the version of the users table read before querying it: since every
+	modification of a user, of its roles or of its password bumps this version (see bump_table_version()), even from
+	another process, a cached user is only served while the version is unchanged. Checking it is a single row query. The
+	entries also expire after *ttl* seconds (0 disables the cache).
+
+	"""
+
+	def __init__(self, ttl=30):
+		self.ttl = ttl
+		self._users = {}
+
+	def get(self, user_id):
+		user_id = str(user_id)
+		if self.ttl <= 0:
+			return get_user_with_roles(user_id)
+		version = get_table_versions((User, ))[User._meta.table_name]
+		now = time.monotonic()
+		try:
+			expiration_time, user_version, user = self._users[user_id]
+			if now < expiration_time and user_version == version:
+				return user
+		except KeyError:
+			pass
+		user = get_user_with_roles(user_id)
+		if user is not None:
+			self._users[user_id] = (now + self.ttl, version, user)
+		return user
 
+	def invalidate(self, user_id):
+		self._users.pop(str(user_id), None)
 
-def create_user(**kwargs):
-	roles = kwargs.pop('roles', ())
-	user = User.create(**kwargs)
+	def clear(self):
+		self._users.clear()
+
+
+user_cache = UserCache()
+
+
+class BootstrapState:
+	"""
+	Per process cache of whether any user is registered, ie. whether the first run of the application is over. Once some
+	user exists, the users table is no more queried for this unless delete_user() empties it (or the DB is cleaned up).
+	The table stays the source of truth: the state is queried again as long as it is not complete.
+
+	"""
+
+	def __init__(self):
+		self._is_complete = False
+
+	def is_complete(self):
+		if not self._is_complete:
+			self._is_complete = User.select(User.id).exists()
+		return self._is_complete
+
+	def set_complete(self):
+		self._is_complete = True
+
+	def invalidate(self):
+		self._is_complete = False
+
+
+bootstrap_state = BootstrapState()
+
+
+BULK_INSERT_SIZE = 500
+
+
+def get_roles_map():
+	"""
+	:return: a dict with the role's name as key and its id as value
+
+	"""
+	return dict(RoleModel.select(RoleModel.name, RoleModel.id).tuples())
+
+
+def get_role_ids(roles, roles_map=None):
+	"""
+	:param roles: roles given either by id or by name
+	:param roles_map: see get_roles_map(), fetched on the first role given by name if not set
+
+	"""
+	role_ids = []
 	for role in roles:
 		try:
-			int(role)
+			role_id = int(role)
 		except ValueError:
-			role = RoleModel.get(name=role).id
-		UserRole.create(user=user, role=role)
-	return user.id
+			if roles_map is None:
+				roles_map = get_roles_map()
+			role_id = roles_map[role]
+		if role_id not in role_ids:
+			role_ids.append(role_id)
+	return role_ids
+
+
+def insert_user_roles(user_roles):
+	"""
+	:param user_roles: (user id, role id) pairs inserted by batches of BULK_INSERT_SIZE
+
+	"""
+	for batch in chunked(user_roles, BULK_INSERT_SIZE):
+		UserRole.insert_many(batch, fields=[UserRole.user, UserRole.role]).execute()
+
+
+def create_users(users):
+	"""
+	Creates the *users* (dicts of User's fields and 'roles', a list of role ids or names) in a single transaction, with
+	one INSERT per batch of BULK_INSERT_SIZE users.
+
+	:return: the ids of the created users
+
+	"""
+	users = [user.copy() for user in users]
+	roles = [user.pop('roles', ()) for user in users]
+	roles_map = get_roles_map()
+	user_ids = []
+	with flask_db.database.atomic():
+		for batch in chunked(users, BULK_INSERT_SIZE):
+			user_ids.extend(user_id for user_id, in User.insert_many(batch).returning(User.id).tuples().execute())
+		insert_user_roles([(user_id, role_id)
+			for user_id, user_roles in zip(user_ids, roles)
+			for role_id in get_role_ids(user_roles, roles_map)
+		])
+	for user_id in user_ids:
+		user_cache.invalidate(user_id)
+	if user_ids:
+		bootstrap_state.set_complete()
+	bump_table_version(User)
+	return user_ids
+
+
+def create_user(**kwargs):
+	return create_users([kwargs])[0]
 
 
 def update_roles(modify_roles_dict):
 	user_id = modify_roles_dict['user_id']
-	UserRole.delete().where(UserRole.user == user_id).execute()
-	for r in modify_roles_dict['roles']:
-		UserRole.create(user=user_id, role=r)
+	with flask_db.database.atomic():
+		UserRole.delete().where(UserRole.user == user_id).execute()
+		insert_user_roles([(user_id, role_id) for role_id in get_role_ids(modify_roles_dict['roles'])])
+	user_cache.invalidate(user_id)
+	bump_table_version(User)
 
 
 def get_db_version(column):
@@ -117,6 +403,21 @@ def get_db_version(column):
 		flask_db.database.close()
 
 
+def get_db_versions():
+	"""
+	:return: the (lib, app) versions of the DB with a single query, (None, None) if it is not initialized
+
+	"""
+	try:
+		return DatabaseVersionModel.select(DatabaseVersionModel.lib, DatabaseVersionModel.app).tuples().get()
+	except DatabaseVersionModel.DoesNotExist:
+		return None, None
+	except ProgrammingError:
+		_LOGGER.info("Table databaseversion does not exist")
+		flask_db.database.close()
+		return None, None
+
+
 def get_lib_db_version():
 	return get_db_version('lib')
 
@@ -153,39 +454,71 @@ def set_app_db_version(number):
 	set_db_version('app', number)
 
 
-def has_any_registered_user():
-	return bool(User.get_or_none())
-
+def bump_table_version(model):
+	"""
+	Must be called each time the content of the *model*'s table is modified for invalidating the ETags of the tables
+	displaying it.
 
-def get_users():
-	columns = [User.last_name, User.first_name, User.username]
-	query = (User
-		.select(User.id, User.last_name, User.first_name, User.username)
-		.order_by(User.last_name)
-		.tuples()
+	"""
+	(TableVersionModel
+		.insert(name=model._meta.table_name, version=1)
+		.on_conflict(
+			conflict_target=[TableVersionModel.name],
+			update={TableVersionModel.version: TableVersionModel.version + 1},
+		)
+		.execute()
 	)
-	rows = [list(r) for r in query]
 
-	query = (UserRole
-		.select(UserRole.user, RoleModel.name)
-		.join(RoleModel)
+
+def get_table_versions(models):
+	"""
+	:return: a dict with the table name as key and its version as value for each of the *models* (0 if never modified).
+
+	"""
+	versions = dict([(model._meta.table_name, 0) for model in models])
+	query = (TableVersionModel
+		.select(TableVersionModel.name, TableVersionModel.version)
+		.where(TableVersionModel.name.in_(list(versions)))
 		.tuples()
 	)
+	versions.update(dict(query))
+	return versions
 
-	roles = {}
-	for row in query:
-		try:
-			roles[row[0]].append(row[1])
-		except KeyError:
-			roles[row[0]] = [row[1]]
 
-	for row in rows:
-		try:
-			row.append(", ".join(sorted(roles.get(row[0], []))))
-		except KeyError:
-			pass
+def has_any_registered_user():
+	return bootstrap_state.is_complete()
+
+
+def _string_agg(field, separator):
+	"""
+	:return: the aggregation of the *field*'s values sorted and joined by the *separator*, SQLite (without any order)
+		standing in for Postgres
 
-	return TableRequestResult(columns + [RoleModel.name], rows)
+	"""
+	database = field.model._meta.database
+	if isinstance(database.obj if isinstance(database, Proxy) else database, SqliteDatabase):
+		return fn.group_concat(field, separator)
+	return fn.string_agg(field, separator).order_by(field)
+
+
+def get_users():
+	"""
+	Gets the users and their roles, aggregated by the DB, with a single query. Being a SQL query, it can be sorted,
+	filtered and paginated by the DB, see TablePage.
+
+	"""
+	roles = alias(fn.COALESCE(_string_agg(RoleModel.name, ", "), ""), 'roles', RoleModel.name.i18n)
+	roles.column_name = 'roles'
+	columns = [User.last_name, User.first_name, User.username, roles]
+	query = (User
+		.select(User.id, User.last_name, User.first_name, User.username, roles)
+		.join(UserRole, JOIN.LEFT_OUTER)
+		.join(RoleModel, JOIN.LEFT_OUTER)
+		.group_by(User.id)
+		.order_by(User.last_name)
+		.tuples()
+	)
+	return TableRequestResult(columns, query)
 
 
 def get_user(user_id):
@@ -196,6 +529,37 @@ def get_user(user_id):
 	return query[0]
 
 
+def get_user_with_roles(user_id):
+	"""
+	Gets the user and its roles with a single query.
+
+	"""
+	query = (User
+		.select(User, RoleModel.name.alias('role_name'))
+		.join(UserRole, JOIN.LEFT_OUTER)
+		.join(RoleModel, JOIN.LEFT_OUTER)
+		.where(User.id == user_id)
+		.objects()
+	)
+	user = None
+	roles = []
+	for row in query:
+		user = user or row
+		if row.role_name is not None:
+			roles.append(row.role_name)
+	if user is not None:
+		user.roles = roles
+	return user
+
+
+def set_user_password(user_id, password_hash):
+	query = User.update(password=password_hash).where(User.id == user_id)
+	if query.execute() != 1:
+		raise DatabaseException("Could not update user '%s'" % user_id)
+	user_cache.invalidate(user_id)
+	bump_table_version(User)
+
+
 def get_user_by_username(username):
 	user = User.get_or_none(username=username)
 	_LOGGER.debug("User is '%s' for username '%s'", user, username)
@@ -209,13 +573,15 @@ def delete_user(user_id):
 	query = User.delete().where(User.id == user_id)
 	if query.execute() != 1:
 		raise DatabaseException("Could not delete user '%s'" % user_id)
+	user_cache.invalidate(user_id)
+	if not User.select(User.id).exists():
+		bootstrap_state.invalidate()
+	bump_table_version(User)
 
 
 def populate_roles():
-	for role in AVAILABLE_ROLES:
-		if RoleModel.get_or_none(name=role) is None:
-			_LOGGER.debug("Populating roles table with '%s'", role)
-			RoleModel.create(name=role)
+	_LOGGER.debug("Populating roles table with '%s'", AVAILABLE_ROLES)
+	RoleModel.insert_many([(role, ) for role in AVAILABLE_ROLES], fields=[RoleModel.name]).on_conflict_ignore().execute()
 
 
 def get_roles_names():
@@ -16,6 +16,15 @@ ROLE_USER = "user"
 AVAILABLE_ROLES = [ROLE_ADMIN, ROLE_USER]
 
 
+ADMIN_ONLY = frozenset((ROLE_ADMIN, ))
+NO_ROLES = frozenset()
+
+
+def get_role_set(user):
+	""" The roles of the *user* as a frozenset, none for the anonymous user """
+	return getattr(user, 'role_set', NO_ROLES)
+
+
 def user_has_role(current_user, role):
 	return role in current_user.roles
 
@@ -28,20 +37,58 @@ def roles_required(*roles):
 
 	def decorator(functor):
 
-		requires_roles = list(roles)
-		requires_roles.append(ROLE_ADMIN)
+		requires_roles = frozenset(roles) | ADMIN_ONLY
 		functor.roles = requires_roles
 
 		@wraps(functor)
 		def wrapper(*args, **kwargs):
-			_LOGGER.debug("User has roles '%s' and functor accepts '%s'", current_user.roles, requires_roles)
-			if any([user_has_role(current_user, role) for role in requires_roles]):
-				return functor(*args, **kwargs)
-			else:
+			if requires_roles.isdisjoint(get_role_set(current_user)):
 				abort(403)
+			return functor(*args, **kwargs)
 
 		return wrapper
 
 	return decorator
 
 
+
+
+class PermissionIndex:
+	"""
+	The roles allowed by each view endpoint (see roles_required()), indexed once the blueprints of the app are registered.
+	The views not declaring any role are reserved to the admins.
+
+	"""
+
+	def __init__(self):
+		self._roles_by_endpoint = {}
+		self._buttons = {}
+
+	def init_app(self, app):
+		self._roles_by_endpoint = {}
+		for endpoint, view in app.view_functions.items():
+			try:
+				self._roles_by_endpoint[endpoint] = frozenset(view.roles)
+			except AttributeError:
+				self._roles_by_endpoint[endpoint] = ADMIN_ONLY
+		self._buttons.clear()
+
+	def get_roles(self, endpoint):
+		return self._roles_by_endpoint.get(endpoint, ADMIN_ONLY)
+
+	def is_allowed(self, role_set, endpoint):
+		return not self.get_roles(endpoint).isdisjoint(role_set)
+
+	def get_buttons(self, role_set, key, builder):
+		"""
+		:return: the buttons built by *builder* for the users having the *role_set*, cached under the *key*
+
+		"""
+		try:
+			return self._buttons[role_set, key]
+		except KeyError:
+			buttons = self._buttons[role_set, key] = builder()
+			return buttons
+
+
+permission_index = PermissionIndex()
@@ -10,6 +10,7 @@ if environ.get('APP_MODULE') == "testapp":
 	import testapp
 	print(testapp.__path__)
 	from testapp import CONFIG_SECRETS
+	CONFIG_DATABASE = getattr(testapp, 'CONFIG_DATABASE', {})
 	from testapp.models import MODELS
 	from testapp.models import VERSION as WEBAPP_VERSION
 	from testapp.models import Migrator
@@ -19,6 +20,7 @@ if environ.get('APP_MODULE') == "testapp":
 else:
 	import webapp
 	from webapp import CONFIG_SECRETS
+	CONFIG_DATABASE = getattr(webapp, 'CONFIG_DATABASE', {})
 	from webapp.models import MODELS
 	from webapp.models import VERSION as WEBAPP_VERSION
 	from webapp.models import Migrator
@@ -45,12 +47,20 @@ except ImportError:
 	populate_db = None
 
 
-def create_app(cleanup=False, cleanup_app_part=False, database_name="", is_disable_client_cache=False):
+def create_app(cleanup=False, cleanup_app_part=False, database_name="", is_disable_client_cache=False, is_migrating=True,
+		database_url=""):
+	"""
+	:param database_url: a peewee DB URL (eg. sqlite:///path/to/file.db) replacing the Postgres DB
+
+	"""
 	config_dict = {
 		# Generate the key with: secrets.token_urlsafe()
 		'SECRET_KEY': bytes(CONFIG_SECRETS['session_key'], encoding='utf8'),
 		'OVERRIDEN_DATABASE_NAME': database_name or environ.get('DATABASE_NAME', ""),
+		'DATABASE_URL': database_url or environ.get('DATABASE_URL', ""),
 	}
+	# The [database] section of config.ini: host, max_connections, stale_timeout, timeout
+	config_dict.update({f"DATABASE_{key.upper()}": value for key, value in CONFIG_DATABASE.items()})
 	return FlaskApp(
 			config_dict,
 			MODELS,
@@ -61,7 +71,7 @@ def create_app(cleanup=False, cleanup_app_part=False, database_name="", is_disab
 			app_repo_name=APP_REPO_NAME,
 			is_disable_client_cache=is_disable_client_cache,
 			populate_function=populate_db,
-		).create_app(cleanup=cleanup, cleanup_app_part=cleanup_app_part)
+		).create_app(cleanup=cleanup, cleanup_app_part=cleanup_app_part, is_migrating=is_migrating)
 
 
 if __name__ == "__main__":
@@ -4,9 +4,12 @@
 //
 define(["bootstrap", "log", "lib"], function(bootstrap, log, lib) {
 
-	/* mappings with 'tableElt' as key */
-	let mResponses = {};
-	let mFilteredIds = {};
+	const PAGE_SIZE = 50;
+	const SEARCH_DELAY_MS = 300;
+	const CACHE_PREFIX = "dyn-table:";
+
+	/* mapping with the table's name as key */
+	let mStates = {};
 
 	function _displayButtonBox(data, row) {
 		let title = document.getElementById(`button-box-${data.name}-title`);
@@ -29,12 +32,59 @@ define(["bootstrap", "log", "lib"], function(bootstrap, log, lib) {
 		new bootstrap.Modal(buttonBox).show();
 	}
 
+	function _sortTable(tableElt, columnName) {
+		let state = mStates[tableElt.getAttribute("name")];
+		state.sort = (state.sort == columnName) ? `-${columnName}` : columnName;
+		state.offset = 0;
+		fetchDynTablePage(tableElt);
+	}
+
+	function _goToPage(tableElt, offset) {
+		let state = mStates[tableElt.getAttribute("name")];
+		state.offset = Math.max(0, offset);
+		fetchDynTablePage(tableElt);
+	}
+
+	function _populatePager(tableElt, data) {
+		const state = mStates[data.name];
+		let foot = tableElt.querySelector("tfoot");
+		foot.replaceChildren();
+		if (state.total <= state.limit && state.offset == 0) {
+			return;
+		}
+		let tr = document.createElement("tr");
+		let td = document.createElement("td");
+		td.setAttribute("colspan", data.header.length);
+		let previous = document.createElement("button");
+		previous.setAttribute("type", "button");
+		previous.classList.add("btn", "btn-outline-secondary", "btn-sm", "me-2");
+		previous.innerHTML = "&lt;";
+		previous.disabled = (state.offset == 0);
+		previous.addEventListener("click", (evt) => {
+			_goToPage(tableElt, state.offset - state.limit);
+		});
+		let next = document.createElement("button");
+		next.setAttribute("type", "button");
+		next.classList.add("btn", "btn-outline-secondary", "btn-sm", "ms-2");
+		next.innerHTML = "&gt;";
+		next.disabled = (state.offset + state.limit >= state.total);
+		next.addEventListener("click", (evt) => {
+			_goToPage(tableElt, state.offset + state.limit);
+		});
+		let position = document.createElement("span");
+		position.innerHTML = `${Math.min(state.offset + 1, state.total)}-${Math.min(state.offset + state.limit, state.total)} / ${state.total}`;
+		td.append(previous, position, next);
+		tr.appendChild(td);
+		foot.appendChild(tr);
+	}
+
 	function _populateTable(tableElt, data) {
 		console.log(`[dyn-table] Populate table '${data.name}' with data:`);
 		console.log(data);
+		const state = mStates[data.name];
 
 		/* Do not display empty tables */
-		if (data.rows.length == 0) {
+		if (state.total == 0 && ! state.q && tableElt.querySelector(`#${data.name}-empty`) !== null) {
 			console.log(`[dyn-table] Table '${data.name}' is empty`);
 			tableElt.querySelector(`#${data.name}-empty`).classList.remove("hidden");
 			tableElt.querySelector(`#${data.name}-spinner`).classList.add("hidden");
@@ -47,17 +97,21 @@ define(["bootstrap", "log", "lib"], function(bootstrap, log, lib) {
 				th = document.createElement("th");
 				th.setAttribute('name', field.name);
 				th.innerHTML = field.i18n;
+				if (state.sort == field.name) {
+					th.innerHTML += " &#9650;";
+				} else if (state.sort == `-${field.name}`) {
+					th.innerHTML += " &#9660;";
+				}
+				th.addEventListener("click", (evt) => {
+					_sortTable(tableElt, field.name);
+				});
 				tr.appendChild(th);
 			}
 
 			/* Body */
 			body = tableElt.querySelector("tbody");
 			body.replaceChildren();
-			len_buttons = data.buttons === undefined ? 0 : data.buttons.length;
 			for (let row of data.rows) {
-				if (! mFilteredIds[tableElt].includes(row.id)) {
-					continue;
-				}
 				tr = document.createElement("tr");
 				for (let c of row.class) {
 					tr.classList.add(c);
@@ -80,6 +134,9 @@ define(["bootstrap", "log", "lib"], function(bootstrap, log, lib) {
 				}
 				body.appendChild(tr);
 			}
+
+			/* Footer */
+			_populatePager(tableElt, data);
 		}
 		lib.setElementLoaded(tableElt);
 	}
@@ -89,45 +146,85 @@ define(["bootstrap", "log", "lib"], function(bootstrap, log, lib) {
 		const dynTables = document.querySelectorAll("table[data-content]")
 		for (let tableElt of dynTables) {
 			let contentUrl = tableElt.getAttribute("data-content")
-			lib.startElementLoading(tableElt);
 			console.log(`[dyn-table] Treating tableElt '${tableElt.getAttribute("name")}'`);
 			fetchDynTable(contentUrl, tableElt);
 		}
 	}
 
 	function fetchDynTable(location, tableElt) {
-		console.log(`GET Fetch '${location}'`);
-		fetch(location).then((response) => {
-			mResponses[tableElt] = response;
-			buildDynTable(tableElt);
-		});
+		mStates[tableElt.getAttribute("name")] = {
+			location: location,
+			offset: 0,
+			limit: PAGE_SIZE,
+			sort: "",
+			q: "",
+			total: 0,
+		};
+		fetchDynTablePage(tableElt);
 	}
 
-	function buildDynTable(tableElt, textToFilter) {
-		mResponses[tableElt].clone().json().then((data) => {
-			processDynTableData(tableElt, data, textToFilter);
+	function fetchDynTablePage(tableElt) {
+		const state = mStates[tableElt.getAttribute("name")];
+		let params = {'offset': state.offset, 'limit': state.limit};
+		if (state.sort) {
+			params['sort'] = state.sort;
+		}
+		if (state.q) {
+			params['q'] = state.q;
+		}
+		const request = state.location + "?" + new URLSearchParams(params).toString();
+		lib.startElementLoading(tableElt);
+		const cached = _getCachedPage(request);
+		let headers = new Headers();
+		if (cached !== null) {
+			headers.append("If-None-Match", cached.etag);
+		}
+		console.log(`GET Fetch '${request}'`);
+		fetch(request, {headers: headers}).then((response) => {
+			if (response.status == 304) {
+				console.log(`[dyn-table] '${request}' not modified, reusing cached response`);
+				state.total = cached.total;
+				_populateTable(tableElt, cached.data);
+				return;
+			}
+			const totalCount = response.headers.get("X-Total-Count");
+			const etag = response.headers.get("ETag");
+			response.json().then((data) => {
+				state.total = (totalCount === null) ? data.rows.length : parseInt(totalCount);
+				_setCachedPage(request, etag, state.total, data);
+				_populateTable(tableElt, data);
+			});
 		});
 	}
 
-	function processDynTableData(tableElt, data, textToFilter) {
-		mFilteredIds[tableElt] = [];
-		for (let row of Object.values(data.rows)) {
-			for (let field of row.fields) {
-				console.log(`Filtering field '${field}' with filter '${textToFilter}'`);
-				if (textToFilter === undefined || field.normalize("NFD").replace(/\p{Diacritic}/gu, "").toLowerCase().includes(textToFilter.toLowerCase())) {
-					mFilteredIds[tableElt].push(row.id);
-					break;
-				}
-			}
+	function _getCachedPage(request) {
+		const cached = sessionStorage.getItem(CACHE_PREFIX + request);
+		return (cached === null) ? null : JSON.parse(cached);
+	}
+
+	function _setCachedPage(request, etag, total, data) {
+		if (etag === null) {
+			return;
+		}
+		try {
+			sessionStorage.setItem(CACHE_PREFIX + request, JSON.stringify({etag: etag, total: total, data: data}));
+		} catch (e) {
+			console.log(`[dyn-table] Could not cache '${request}': ${e}`);
 		}
-		_populateTable(tableElt, data);
 	}
 
 	function bindSearchBoxes() {
 		for (let searchBoxElt of document.querySelectorAll(".searchbox")) {
 			const tableElt = document.querySelectorAll(`table[name="${searchBoxElt.name}"]`)[0];
+			let timeoutId = null;
 			searchBoxElt.addEventListener("input", (evt) => {
-				buildDynTable(tableElt, searchBoxElt.value);
+				clearTimeout(timeoutId);
+				timeoutId = setTimeout(() => {
+					let state = mStates[searchBoxElt.name];
+					state.q = searchBoxElt.value;
+					state.offset = 0;
+					fetchDynTablePage(tableElt);
+				}, SEARCH_DELAY_MS);
 			});
 		}
 	}
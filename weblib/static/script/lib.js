@@ -24,10 +24,15 @@ define(["log"], function(log) {
 			request = request + "?" + new URLSearchParams(params).toString();
 		}
 		console.log(`GET Fetch '${request}'`);
-		fetch(request, {
+		return fetch(request, {
 			method: "GET"
 		})
-		.then((response) => response.json())
+		.then((response) => {
+			if (! response.ok) {
+				throw new Error(`GET '${request}' failed with status ${response.status}`);
+			}
+			return response.json();
+		})
 		.then(callback);
 	}
 
@@ -85,27 +90,54 @@ define(["log"], function(log) {
 			const parentSelect = elt.querySelector("select[data-parent-select]");
 			const childSelect = elt.querySelector("select[data-child-select]");
 			const choicesUrl = childSelect.getAttribute("choices-url");
-			if (childSelect.querySelector("option") === null) {
-				startElementLoading(childSelect);
-				fetchGet(choicesUrl, {
+			const childrenUrl = childSelect.getAttribute("children-url");
+			// Promises of the children of each parent value, requested once unless they failed
+			const children = new Map();
+			let allChildren = null;
+
+			function getChildren(parentValue) {
+				if (childrenUrl) {
+					if (allChildren === null) {
+						allChildren = fetchGet(childrenUrl, "").catch((error) => {
+							allChildren = null;
+							throw error;
+						});
+					}
+					return allChildren.then((data) => data[parentValue] || []);
+				}
+				if (! children.has(parentValue)) {
+					children.set(parentValue, fetchGet(choicesUrl, {
 						'fetch': `${childSelect.getAttribute("name")}.choices`,
-						'get_children': parentSelect.querySelector("option").getAttribute("value")
-					}, (data) => {
-					_populateOptions(data, childSelect);
+						'get_children': parentValue
+					}).catch((error) => {
+						children.delete(parentValue);
+						throw error;
+					}));
+				}
+				return children.get(parentValue);
+			}
+
+			function populateChildren(parentValue) {
+				startElementLoading(childSelect);
+				getChildren(parentValue).then((data) => {
+					// Ignore the children of a parent which is no longer selected
+					if (parentSelect.value == parentValue) {
+						_populateOptions(data, childSelect);
+					} else {
+						setElementLoaded(childSelect);
+					}
+				}).catch((error) => {
+					console.log(`[double select] cannot get the children of '${parentValue}': ${error}`);
+					setElementLoaded(childSelect);
 				});
 			}
+
+			if (childSelect.querySelector("option") === null) {
+				populateChildren(parentSelect.value);
+			}
 			parentSelect.addEventListener("change", (evt) => {
-				startElementLoading(childSelect);
 				console.log("[double select] event triggered from lib !");
-				setTimeout(() => {
-					fetchGet(choicesUrl, {
-							'fetch': `${childSelect.getAttribute("name")}.choices`,
-							'get_children': evt.target.value
-						}, (data) => {
-						_populateOptions(data, childSelect);
-					});
-					console.log("[double select] event end from lib");
-				}, 300);
+				populateChildren(evt.target.value);
 			});
 		}
 	}
@@ -128,68 +160,102 @@ define(["log"], function(log) {
 		}
 	}
 
+	const TYPEAHEAD_DELAY = 250;  // ms without typing before requesting the matching choices
+	const TYPEAHEAD_LIMIT = 10;
+
+	function normalizeText(text) {
+		return text.normalize("NFD").replace(/\p{Diacritic}/gu, "").toLowerCase();
+	}
+
 	function populateDataLists() {
 		console.log("[populateDataLists] populating choices of input search elements");
 		for (let fieldElt of document.querySelectorAll(".datalist")) {
 			const inputElt = fieldElt.querySelector("[choices-url]");
 			const hiddenElt = fieldElt.querySelector('[type="hidden"]');
-			const choicesElt = fieldElt.querySelector(`[name=${hiddenElt.getAttribute("name")}-choices]`);
+			const name = hiddenElt.getAttribute("name");
+			const choicesElt = fieldElt.querySelector(`[name=${name}-choices]`);
 			const listElt = fieldElt.querySelector("ul");
-			console.log(`${hiddenElt.getAttribute("name")} is datalist`);
+			console.log(`${name} is datalist`);
+
+			function displayChoices(choices) {
+				console.log(`Filtered choices are ${choices}`);
+				listElt.replaceChildren();
+				for (let choice of choices) {
+					let li = document.createElement("li");
+					li.classList.add("dropdown-item");
+					li.innerHTML = choice[1];
+					li.addEventListener("click", (evt) => {
+						hiddenElt.value = choice[0];
+						inputElt.value = choice[1];
+						hideElement(listElt);
+						inputElt.focus();
+					});
+					listElt.appendChild(li);
+				}
+				if (choices.length > 0) {
+					showElement(listElt);
+				} else {
+					hideElement(listElt);
+				}
+			}
 
-			function buildDatalist(choices) {
+			if (choicesElt) {
+				// All the choices are embedded in the page
+				const choices = JSON.parse(choicesElt.getAttribute("value"));
 				console.log(`[populateDataLists] choices are '${choices}'`);
-				console.log(inputElt);
 				inputElt.addEventListener("input", (evt) => {
 					hiddenElt.value = inputElt.value;
-					let str = evt.target.value.normalize("NFD").replace(/\p{Diacritic}/gu, "").toLowerCase();
+					let str = normalizeText(evt.target.value);
 					console.log(`${inputElt} has changed to ${str}`);
 					let filteredChoices = [];
 					for (let choice of choices) {
-						let normalizedStr = choice[1].normalize("NFD").replace(/\p{Diacritic}/gu, "").toLowerCase()
-						if (normalizedStr.toLowerCase().includes(str)) {
+						if (normalizeText(choice[1]).includes(str)) {
 							filteredChoices.push(choice);
 						}
 					}
-					console.log(`Filtered choices are ${filteredChoices}`);
-					listElt.replaceChildren();
-					for (let choice of filteredChoices) {
-						let li = document.createElement("li");
-						li.classList.add("dropdown-item");
-						li.innerHTML = choice[1];
-						li.addEventListener("click", (evt) => {
-							hiddenElt.value = choice[0];
-							inputElt.value = choice[1];
-							hideElement(listElt);
-							inputElt.focus();
-						});
-						listElt.appendChild(li);
-					}
-					if (filteredChoices.length > 0 && filteredChoices.length < 10) {
-						showElement(listElt);
-					} else {
-						hideElement(listElt);
-					}
+					displayChoices(filteredChoices.length < TYPEAHEAD_LIMIT ? filteredChoices : []);
 				});
-				//~ fieldElt.addEventListener("focusout", (evt) => {
-				inputElt.addEventListener("keydown", (evt) => {
-					keyName = evt.key;
-					if (keyName == "ArrowDown") {
-						console.log("ArrowDown");
-						listElt.querySelector("li:nth-child(1)").focus();
-						listElt.querySelector("li").focus();
+			} else {
+				// The matching choices are requested once the user stops typing, and remembered
+				const matchingChoices = new Map();
+				let timeoutId = null;
+				inputElt.addEventListener("input", (evt) => {
+					hiddenElt.value = inputElt.value;
+					clearTimeout(timeoutId);
+					const str = normalizeText(evt.target.value).trim();
+					if (! str) {
+						displayChoices([]);
+					} else if (matchingChoices.has(str)) {
+						displayChoices(matchingChoices.get(str));
+					} else {
+						timeoutId = setTimeout(() => {
+							fetchGet(inputElt.getAttribute("choices-url"), {
+									'fetch': `${name}.choices`,
+									'q': str,
+									'limit': TYPEAHEAD_LIMIT,
+								}, (choices) => {
+								matchingChoices.set(str, choices);
+								// Ignore the answers to the previous values of the input
+								if (normalizeText(inputElt.value).trim() == str) {
+									displayChoices(choices);
+								}
+							});
+						}, TYPEAHEAD_DELAY);
 					}
 				});
-				inputElt.addEventListener("focus", (evt) => {
-					hideElement(listElt);
-				});
-			}
-
-			if (choicesElt) {
-				buildDatalist(JSON.parse(choicesElt.getAttribute("value")));
-			} else {
-				fetchGet(inputElt.getAttribute("choices-url"), "", buildDatalist);
 			}
+			//~ fieldElt.addEventListener("focusout", (evt) => {
+			inputElt.addEventListener("keydown", (evt) => {
+				keyName = evt.key;
+				if (keyName == "ArrowDown") {
+					console.log("ArrowDown");
+					listElt.querySelector("li:nth-child(1)").focus();
+					listElt.querySelector("li").focus();
+				}
+			});
+			inputElt.addEventListener("focus", (evt) => {
+				hideElement(listElt);
+			});
 		}
 	}
 
@@ -5,10 +5,13 @@
 import json
 import logging
 
+from flask.json import dumps as flask_json_dumps
 from flask_babel import gettext as _
 from flask_babel import lazy_gettext as _l
+from peewee import SelectBase
 
-from weblib.requests import translate_row
+from weblib.profiler import timed
+from weblib.requests import build_row_translator
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -25,6 +28,8 @@ class Table:
 		self.rows = []
 		self.buttons = {}
 		self.action = None
+		self._translated_fields = None
+		self._translate_row = None
 
 	def default_fields_builder(self, row, model_fields_to_display):
 		"""
@@ -35,22 +40,57 @@ class Table:
 		:return: a list of fields as they have to be displayed.
 
 		"""
-		return translate_row(row[1:], model_fields_to_display)
+		if model_fields_to_display is not self._translated_fields:
+			self._translate_row = build_row_translator(model_fields_to_display)
+			self._translated_fields = model_fields_to_display
+		return self._translate_row(row[1:])
 
-	def build_from_request(self, request_result, class_builder=lambda fields_dict: ()):
+	def _build_header(self, request_result):
 		self.header = tuple([{'name': field.column_name, 'i18n': field.i18n, 'values': ()} for field in request_result.model_fields_to_display])
+
+	def _iter_rows(self, query, request_result, class_builder):
 		cols = [i['name'] for i in self.header]
-		self.rows = []
-		for row in request_result.query:
-			self.rows.append({
+		for row in query:
+			yield {
 				'id': row[0],
 				'fields': self.default_fields_builder(row, request_result.model_fields_to_display),
 				'class': class_builder(dict(zip(cols + request_result.model_fields_for_compute, row[1:]))),
 				'title': self.row_title_builder(row),
-			})
-		self.rows = tuple(self.rows)
+			}
+
+	@timed('table')
+	def build_from_request(self, request_result, class_builder=lambda fields_dict: ()):
+		self._build_header(request_result)
+		self.rows = tuple(self._iter_rows(request_result.query, request_result, class_builder))
 		return self
 
+	def iter_json(self, request_result, class_builder=lambda fields_dict: ()):
+		"""
+		Streaming alternative to build_from_request() followed by dict: the table's JSON document is yielded chunk by chunk
+		and each row is read from the DB cursor, translated and serialized only when it is about to be sent. The memory
+		usage does not depend on the number of rows.
+
+		The header and buttons are serialized when the first chunk is requested so they can be set after calling this method.
+
+		"""
+		self._build_header(request_result)
+		query = request_result.query
+		if isinstance(query, SelectBase):
+			query = query.iterator()  # Do not cache the rows in the query
+		assert not self.buttons or not self.action
+		head = flask_json_dumps({
+			'name': self.name,
+			'header': self.header,
+			'buttons': self.buttons,
+			'action': self.action,
+		})
+		yield head[:-1] + ', "rows": ['
+		separator = ""
+		for row in self._iter_rows(query, request_result, class_builder):
+			yield separator + flask_json_dumps(row)
+			separator = ", "
+		yield "]}"
+
 	@property
 	def is_empty(self):
 		return False  # FIXME always empty when used in the table template request
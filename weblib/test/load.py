@@ -0,0 +1,199 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Headless load generator: concurrent simulated users replay sessions (login, users page and table, creation, update and
+deletion of a row of a crud_page() table, logout) on the app created in process and driven by Flask test clients. The
+throughput and the latency percentiles of each endpoint are reported. The DB is a Postgres one or, for reproducible
+capacity planning without any server, a SQLite file standing in for it.
+
+Usage: python3 weblib/test/load.py [--users 10] [--sessions 20] [--database-name NAME | --database-url URL]
+	[--output REPORT.json]
+
+"""
+import argparse
+import json
+import logging
+import math
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from os.path import dirname, join
+from urllib.parse import urlsplit
+
+from bcrypt import gensalt, hashpw
+
+_LOGGER = logging.getLogger(__name__)
+
+PASSWORD = "load"
+CRUD_URL = "/comprehensive_2/open/comprehensive"
+LIST_URL = dirname(CRUD_URL) + "/"
+
+
+def percentile(sorted_durations, percent):
+	"""
+	:return: the nearest-rank *percent* percentile of the *sorted_durations*
+
+	"""
+	return sorted_durations[max(0, math.ceil(percent / 100 * len(sorted_durations)) - 1)]
+
+
+class Statistics:
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._durations = defaultdict(list)
+		self._errors = defaultdict(int)
+
+	def add(self, endpoint, duration, is_error):
+		with self._lock:
+			self._durations[endpoint].append(duration)
+			self._errors[endpoint] += is_error
+
+	def get_report(self, elapsed):
+		endpoints = {}
+		for endpoint, durations in self._durations.items():
+			durations = sorted(durations)
+			endpoints[endpoint] = {
+				'requests': len(durations),
+				'errors': self._errors[endpoint],
+				'throughput': len(durations) / elapsed,
+				'mean_ms': sum(durations) / len(durations) * 1000,
+				'p50_ms': percentile(durations, 50) * 1000,
+				'p95_ms': percentile(durations, 95) * 1000,
+				'p99_ms': percentile(durations, 99) * 1000,
+			}
+		requests_nb = sum(len(durations) for durations in self._durations.values())
+		return {
+			'elapsed': elapsed,
+			'requests': requests_nb,
+			'errors': sum(self._errors.values()),
+			'throughput': requests_nb / elapsed,
+			'endpoints': endpoints,
+		}
+
+
+class SimulatedUser:
+
+	def __init__(self, app, username, remote_addr, statistics):
+		self._client = app.test_client()
+		# Each user comes from its own address, as the limits of the password hashes apply per IP address
+		self._client.environ_base['REMOTE_ADDR'] = remote_addr
+		self._username = username
+		self._statistics = statistics
+
+	def _request(self, endpoint, method, path, expected_status=200, expected_location=None, **kwargs):
+		"""
+		:param expected_location: the path a 302 *expected_status* redirects to, a redirection to the login page
+			meaning that the session was lost
+
+		"""
+		start = time.perf_counter()
+		response = self._client.open(path, method=method, **kwargs)
+		duration = time.perf_counter() - start
+		location = urlsplit(response.location).path if response.location else None
+		is_error = response.status_code != expected_status or location != expected_location
+		if is_error:
+			_LOGGER.warning("%s %s answered %s (%s) instead of %s (%s)", method, path, response.status_code, location,
+				expected_status, expected_location)
+		self._statistics.add(endpoint, duration, is_error)
+		return response
+
+	def run_session(self, session_idx):
+		text = f"{self._username} {session_idx}"
+		self._request("POST /login", "POST", "/login", 302, "/", data={'username': self._username, 'password': PASSWORD})
+		self._request("GET /users", "GET", "/users")
+		self._request("GET /users/users.table", "GET", "/users/users.table")
+		self._request("GET crud create", "GET", join(CRUD_URL, "create"))
+		self._request("POST crud create", "POST", join(CRUD_URL, "create"), 302, LIST_URL, data={'text': text, 'integer': session_idx})
+		response = self._request("GET crud table", "GET", CRUD_URL + ".table", query_string={'q': text})
+		item_ids = [row['id'] for row in (response.json or {}).get('rows', ()) if row['fields'][0] == text]
+		if item_ids:
+			self._request("GET crud update", "GET", join(CRUD_URL, "update"), query_string={'id': item_ids[0]})
+			self._request("POST crud update", "POST", join(CRUD_URL, "update"), 302, LIST_URL,
+				data={'id': item_ids[0], 'text': text, 'integer': session_idx + 1}
+			)
+			self._request("GET crud del", "GET", join(CRUD_URL, "del"), 302, LIST_URL, query_string={'id': item_ids[0]})
+		self._request("GET /logout", "GET", "/logout", 302, "/")
+
+	def run(self, sessions_nb):
+		for session_idx in range(sessions_nb):
+			self.run_session(session_idx)
+
+
+def create_load_users(users_nb):
+	from weblib.requests import create_users
+	password = hashpw(PASSWORD.encode('utf-8'), gensalt()).decode('utf-8')
+	usernames = [f"load{i}" for i in range(users_nb)]
+	create_users([{
+		'username': username,
+		'password': password,
+		'first_name': "Load",
+		'last_name': username,
+		'roles': ("admin", ),
+	} for username in usernames])
+	return usernames
+
+
+def run(app, users_nb, sessions_nb):
+	"""
+	:return: the report of *users_nb* concurrent users running *sessions_nb* sessions each
+
+	"""
+	with app.app_context():
+		usernames = create_load_users(users_nb)
+	statistics = Statistics()
+	threads = [
+		threading.Thread(
+			target=SimulatedUser(app, username, f"10.0.{user_idx // 256}.{user_idx % 256}", statistics).run,
+			args=(sessions_nb, ),
+			name=username,
+		)
+		for user_idx, username in enumerate(usernames)
+	]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return statistics.get_report(time.perf_counter() - start)
+
+
+def print_report(report):
+	print(f"{report['requests']} requests in {report['elapsed']:.1f} s: {report['throughput']:.1f} requests/s, {report['errors']} errors")
+	print(f"{'endpoint':25} {'requests':>8} {'errors':>6} {'req/s':>8} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+	for endpoint, stats in report['endpoints'].items():
+		print(
+			f"{endpoint:25} {stats['requests']:8} {stats['errors']:6} {stats['throughput']:8.1f} {stats['mean_ms']:8.1f}"
+			f" {stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f} {stats['p99_ms']:8.1f}"
+		)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="In process load test")
+	parser.add_argument('--users', type=int, default=10, help="number of concurrent simulated users")
+	parser.add_argument('--sessions', type=int, default=20, help="number of sessions run by each user")
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument('--database-name', help="Postgres DB, cleaned up before the test")
+	group.add_argument('--database-url', help="peewee DB URL of an empty DB (default: a temporary SQLite file)")
+	parser.add_argument('--output', help="JSON report file")
+	args = parser.parse_args()
+
+	logging.disable(logging.INFO)
+	from weblib.server import create_app
+	with tempfile.TemporaryDirectory() as directory:
+		database_url = args.database_url
+		if not args.database_name and not database_url:
+			database_url = f"sqlite:///{join(directory, 'load.db')}?timeout=60"
+		app, _database = create_app(cleanup=bool(args.database_name), database_name=args.database_name or "", database_url=database_url or "")
+		report = run(app, args.users, args.sessions)
+	print_report(report)
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+	main()
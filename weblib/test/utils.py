@@ -24,7 +24,6 @@ from weblib.models import WEBLIB_MODELS
 from weblib.requests import create_user
 from weblib.server import create_app
 from weblib.test.data import USERS
-from weblib.views import gensalt, hashpw
 
 _LOGGER = logging.getLogger(__name__)
 
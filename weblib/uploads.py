@@ -0,0 +1,230 @@
+#
+# Copyright 2021-2025, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Content addressed store of the uploaded files.
+
+Usage: python3 weblib/uploads.py gc [--dry-run] [--grace-period SECONDS]
+
+"""
+import argparse
+import logging
+import mimetypes
+import re
+import time
+from collections import Counter
+from os import environ, listdir, makedirs, remove, replace, scandir, utime
+from os.path import exists, expanduser, isdir, isfile, join, realpath, relpath
+
+from flask import abort, current_app, request, send_from_directory
+from peewee import fn
+
+from weblib.models import FileField
+
+_LOGGER = logging.getLogger(__name__)
+
+
+TEMPORARY_FILE_PREFIX = ".upload-"
+STORED_FILENAME_RE = re.compile(r"^[0-9a-f]{64}(\.[0-9A-Za-z]+)?$")
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+
+
+class UnsafeUploadStoreException(Exception):
+	pass
+
+
+class UploadStore:
+	"""
+	A file is stored once whatever the number of rows referencing it, under ``<root>/ab/cd/<filename>`` where the filename
+	is the hash of its content (followed by an extension, see forms.fields.FileField) and ``abcd`` its first characters.
+	Files uploaded before the sharding are still found at ``<root>/<filename>``. Only the files having such a name and
+	path are handled by the maintenance operations (shard(), collect_garbage()). The root can not be the home directory,
+	whose files and directories are not all uploads (see check_root()).
+
+	"""
+
+	def __init__(self, root):
+		self.root = expanduser(root)
+		self.check_root()
+
+	def get_relative_path(self, filename):
+		"""
+		:return: the path of the file relative to the store's root, the legacy flat one if the file was not sharded yet
+
+		"""
+		sharded_path = join(filename[0:2], filename[2:4], filename)
+		if not exists(join(self.root, sharded_path)) and exists(join(self.root, filename)):
+			return filename
+		return sharded_path
+
+	def get_path(self, filename):
+		return join(self.root, self.get_relative_path(filename))
+
+	def add(self, temporary_filepath, filename):
+		"""
+		Moves the *temporary_filepath* (which must be on the same filesystem) to the store, unless a file with the same
+		content is already stored: then the temporary file is just removed.
+
+		:return: True if the file was written
+
+		"""
+		path = self.get_path(filename)
+		if exists(path):
+			_LOGGER.info("File '%s' is already stored", filename)
+			remove(temporary_filepath)
+			utime(path)  # Protects it from the garbage collection's grace period like a new file
+			return False
+		makedirs(join(self.root, filename[0:2], filename[2:4]), exist_ok=True)
+		replace(temporary_filepath, path)
+		return True
+
+	def check_root(self):
+		"""
+		Raises UnsafeUploadStoreException if the root is the home directory (the default UPLOAD_DIR): its files and
+		directories are not all uploads.
+
+		"""
+		if realpath(self.root) == realpath(expanduser("~")):
+			raise UnsafeUploadStoreException(f"The upload store '{self.root}' is the home directory: set UPLOAD_DIR")
+
+	def shard(self, dry_run=False):
+		"""
+		Moves the files stored flat by the previous versions to their sharded path.
+
+		:return: the names of the files (to be) moved
+
+		"""
+		filenames = [entry.name for entry in scandir(self.root) if entry.is_file() and STORED_FILENAME_RE.match(entry.name)]
+		for filename in filenames:
+			_LOGGER.info("%s file '%s'", "Would shard" if dry_run else "Sharding", filename)
+			if not dry_run:
+				makedirs(join(self.root, filename[0:2], filename[2:4]), exist_ok=True)
+				replace(join(self.root, filename), join(self.root, filename[0:2], filename[2:4], filename))
+		return filenames
+
+	def iter_files(self):
+		"""
+		:return: an iterator on the (filename, path, modification time) of the stored files, ie. those named after a hash
+			in the shard of their first characters
+
+		"""
+		for shard_1 in sorted(listdir(self.root)):
+			if not _is_shard(self.root, shard_1):
+				continue
+			for shard_2 in sorted(listdir(join(self.root, shard_1))):
+				if not _is_shard(join(self.root, shard_1), shard_2):
+					continue
+				for entry in scandir(join(self.root, shard_1, shard_2)):
+					if entry.is_file() and STORED_FILENAME_RE.match(entry.name) and entry.name[0:4] == shard_1 + shard_2:
+						yield entry.name, entry.path, entry.stat().st_mtime
+
+	def collect_garbage(self, references, grace_period=3600, dry_run=False):
+		"""
+		Removes the stored files that are not in *references* and the temporary files of the interrupted uploads. The files
+		modified during the last *grace_period* seconds are kept since the rows referencing them may not be committed yet.
+
+		:param references: the referenced filenames, see get_references()
+		:return: the relative paths of the removed files
+
+		"""
+		deadline = time.time() - grace_period
+		orphans = [path for filename, path, mtime in self.iter_files() if filename not in references and mtime < deadline]
+		orphans += [
+			entry.path for entry in scandir(self.root)
+			if entry.is_file() and entry.name.startswith(TEMPORARY_FILE_PREFIX) and entry.stat().st_mtime < deadline
+		]
+		for path in orphans:
+			_LOGGER.info("%s orphan file '%s'", "Would remove" if dry_run else "Removing", path)
+			if not dry_run:
+				remove(path)
+		return [relpath(path, self.root) for path in orphans]
+
+
+def _is_shard(directory, name):
+	return len(name) == 2 and all(c in "0123456789abcdef" for c in name) and isdir(join(directory, name))
+
+
+def get_upload_store():
+	return UploadStore(environ.get('UPLOAD_DIR', environ['HOME']))
+
+
+def upload_response(filename):
+	"""
+	Sends the uploaded file *filename* of the store. Its name is the hash of its content so it never changes: it is sent
+	with a strong ETag and is cached by the clients without revalidation. Range requests are supported.
+
+	Sending the bytes can be delegated to the web server with the USE_X_SENDFILE config (Apache's mod_xsendfile, the
+	UPLOAD_DIR must be allowed by XSendFilePath) or the X_ACCEL_REDIRECT_PREFIX one (nginx, the internal location aliasing
+	the UPLOAD_DIR). The web server then handles the range requests.
+
+	"""
+	if not STORED_FILENAME_RE.match(filename):
+		abort(404)
+	etag = filename.split(".")[0]
+	if etag in request.if_none_match:
+		response = current_app.response_class(status=304)
+	else:
+		store = get_upload_store()
+		relative_path = store.get_relative_path(filename)
+		x_accel_redirect_prefix = current_app.config.get('X_ACCEL_REDIRECT_PREFIX')
+		if x_accel_redirect_prefix or current_app.config.get('USE_X_SENDFILE'):
+			if not isfile(join(store.root, relative_path)):
+				abort(404)
+			response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+			if x_accel_redirect_prefix:
+				response.headers['X-Accel-Redirect'] = join(x_accel_redirect_prefix, relative_path)
+			else:
+				response.headers['X-Sendfile'] = join(store.root, relative_path)
+		else:
+			response = send_from_directory(store.root, relative_path, etag=etag, max_age=UPLOAD_MAX_AGE)
+	response.set_etag(etag)
+	response.cache_control.public = False
+	response.cache_control.no_cache = None
+	response.cache_control.private = True
+	response.cache_control.max_age = UPLOAD_MAX_AGE
+	response.cache_control.immutable = True
+	return response
+
+
+def get_references(models):
+	"""
+	:return: a Counter of the number of rows referencing each filename in the columns of the *models* declared as
+		models.FileField
+
+	"""
+	references = Counter()
+	for model in models:
+		for field in model._meta.sorted_fields:
+			if isinstance(field, FileField):
+				references.update(dict(model
+					.select(field, fn.COUNT(model._meta.primary_key))
+					.where(field.is_null(False) & (field != ""))
+					.group_by(field)
+					.tuples()
+				))
+	return references
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Uploaded files store maintenance")
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	gc_parser = subparsers.add_parser('gc', help="remove the uploaded files no longer referenced by the DB")
+	gc_parser.add_argument('--dry-run', action='store_true', help="only log the files that would be removed")
+	gc_parser.add_argument('--grace-period', type=int, default=3600, help="keep the files younger than this (seconds)")
+	args = parser.parse_args()
+
+	from weblib.server import MODELS, create_app
+	from weblib.models import WEBLIB_MODELS
+	store = get_upload_store()
+	app, _database = create_app(is_migrating=False)
+	with app.app_context():
+		references = get_references(WEBLIB_MODELS + MODELS)
+	# With --dry-run, the flat files are only reported: they are not collected until they are sharded
+	store.shard(dry_run=args.dry_run)
+	removed = store.collect_garbage(references, grace_period=args.grace_period, dry_run=args.dry_run)
+	_LOGGER.info("%d referenced files, %d orphan files %s", len(references), len(removed), "found" if args.dry_run else "removed")
+
+
+if __name__ == "__main__":
+	main()
@@ -4,18 +4,21 @@
 #
 import logging
 from copy import copy
+from hashlib import sha1
 from os import environ
 from secrets import token_urlsafe
 from urllib.parse import urljoin, urlparse
 
 import peewee
-from bcrypt import gensalt, hashpw
-from flask import Blueprint, abort, current_app, jsonify, redirect, render_template, request, session, url_for
-from flask_babel import gettext as _, lazy_gettext as _l
+from flask import (Blueprint, abort, current_app, get_template_attribute, jsonify, redirect, render_template, request, session,
+	stream_with_context, url_for)
+from flask_babel import get_locale, gettext as _, lazy_gettext as _l
 from flask_login import current_user, fresh_login_required, login_required, login_user, logout_user
+from markupsafe import Markup
 from os.path import join
-from weblib.requests import (DatabaseException, TableRequestResult, create_user, delete_user, get_user, get_user_roles,
-	get_users, has_any_registered_user, update_roles)
+from weblib.requests import (DatabaseException, TablePage, TableRequestResult, bump_table_version, create_user,
+	delete_user, get_table_versions, get_user, get_user_roles, get_users, has_any_registered_user, set_user_password,
+	update_roles, user_cache)
 from werkzeug.exceptions import HTTPException
 
 
@@ -24,13 +27,19 @@ if environ.get('APP_MODULE') == "testapp":
 else:
 	from webapp import CONFIG_CUSTOMIZATION
 
-from weblib.forms.forms import LoginForm, ModifyPasswordForm, ModifyRolesForm, RegistrationForm, UserForm
-from weblib.models import User
-from weblib.roles import ROLE_ADMIN, roles_required, user_has_one_of_these_roles
+from weblib.forms.fields import DatalistField, DoubleSelectField, invalidate_choices
+from weblib.fragments import fragment_cache
+from weblib.forms.forms import BaseForm, LoginForm, ModifyPasswordForm, ModifyRolesForm, RegistrationForm, UserForm
+from weblib.models import User, flask_db, table_modified_listeners
+from weblib.passwords import get_hashing_keys, password_hasher
+from weblib.profiler import timed
+from weblib.roles import ROLE_ADMIN, get_role_set, permission_index, roles_required
 from weblib.table import Table
 
 _LOGGER = logging.getLogger(__name__)
 
+TYPEAHEAD_MAX_LIMIT = 100
+
 
 class Tab:
 
@@ -46,47 +55,106 @@ class Tab:
 		return self.__str__()
 
 
+def get_tabs_signature(tabs):
+	"""
+	:return: a digest of the names and untranslated labels of the *tabs* and of their children, the same in every process
+
+	"""
+	def describe(tabs):
+		return tuple((tab.name, getattr(tab.i18n, '_args', tab.i18n), describe(tab.children)) for tab in tabs.values())
+
+	return sha1(repr(describe(tabs or {})).encode()).hexdigest()
+
+
 class Site:
+	"""
+	The tabs being static once set, the template and the tabs of a page are resolved once per URL rule (see
+	_resolve_page()) and the HTML of the tabs is cached in the fragment cache per tabs signature and active tabs (see
+	_render_navigation()).
+
+	"""
 
 	def __init__(self):
 		self._tabs = None
+		self._tabs_signature = get_tabs_signature(None)
+		self._pages = {}
 
 	def set_tabs(self, tabs):
 		self._tabs = tabs
+		self._tabs_signature = get_tabs_signature(tabs)
+		self._pages.clear()
+
+	def _resolve_page(self, url_rule, active_path, is_display_main_tabs):
+		"""
+		:param active_path: the path of the tab to activate, the URL rule's one if None
+		:return: the (template, tabs variables, default tabs variables) of the page. The tabs that could not be resolved
+			are not part of the variables.
+
+		"""
+		html_template = "%s.html" % url_rule.lstrip('/')
+		page_path = html_template.split('.')[0].split('/')
+		if page_path[0] not in self._tabs:
+			return html_template, {'available_tabs': None, 'active_tab': None, 'available_sub_tabs': None, 'active_sub_tab': None}, {}
+		variables = {'available_tabs': tuple(self._tabs.values()) if is_display_main_tabs else None}
+		default_variables = {}
+		active_path = active_path.split('/') if active_path else page_path
+		try:
+			variables['active_tab'] = self._tabs[active_path[0]]
+			default_variables['available_sub_tabs'] = tuple(self._tabs[active_path[0]].children.values())
+			variables['active_sub_tab'] = self._tabs[active_path[0]].children[active_path[1]]
+		except (IndexError, KeyError):
+			pass
+		return html_template, variables, default_variables
+
+	def _render_navigation(self, available_tabs, active_tab, available_sub_tabs, active_sub_tab):
+		tabs = get_template_attribute("/macros.html", "tabs")
+
+		def render():
+			html = tabs(1, available_tabs, active_tab, "/") if available_tabs else ""
+			if available_sub_tabs:
+				html += tabs(2, available_sub_tabs, active_sub_tab, "/" + active_tab.name + "/")
+			return Markup(html)
+
+		def get_name(tab):
+			# The pages may give another object than a tab, which is then not activated by the macro
+			return tab.name if isinstance(tab, Tab) else None
+
+		def get_names(tabs):
+			return tuple(get_name(tab) for tab in tabs) if tabs else None
+
+		vary = (
+			self._tabs_signature,
+			get_names(available_tabs), get_name(active_tab), get_names(available_sub_tabs), get_name(active_sub_tab),
+		)
+		return fragment_cache.get_or_render('navigation', vary, render)
 
 	def render_page(self, in_login_process=False, is_display_main_tabs=True, **kwargs):
-		computed_html_template = "%s.html" % str(request.url_rule).lstrip('/')
-		page_path = computed_html_template.split('.')[0].split('/')
-		_LOGGER.info("Rendering page '%s'", page_path)
+		url_rule = str(request.url_rule)
+		page_key = (url_rule, kwargs.get('active_tab'), is_display_main_tabs)
+		try:
+			computed_html_template, variables, default_variables = self._pages[page_key]
+		except KeyError:
+			computed_html_template, variables, default_variables = self._pages[page_key] = self._resolve_page(*page_key)
+		_LOGGER.info("Rendering page '%s'", computed_html_template)
 		favicon = kwargs.pop('favicon', "favicon")
-		if page_path[0] in self._tabs:
-			try:
-				kwargs['available_tabs'] = self._tabs.values() if is_display_main_tabs else None
-				active_path = kwargs.get('active_tab')
-				if active_path:
-					active_path = active_path.split('/')
-				else:
-					active_path = page_path
-				_LOGGER.info("Will activate tab '%s'", active_path)
-				kwargs['active_tab'] = self._tabs[active_path[0]]
-				kwargs.setdefault('available_sub_tabs', self._tabs[active_path[0]].children.values())
-				#_LOGGER.debug("Available sub tabs are '%s'", kwargs['available_sub_tabs'])
-				kwargs['active_sub_tab'] = self._tabs[active_path[0]].children[active_path[1]]
-			except (IndexError, KeyError):
-				pass
-		else:
-			kwargs['available_tabs'] = kwargs['active_tab'] = kwargs['available_sub_tabs'] = kwargs['active_sub_tab'] = None
-		return render_template("index.html",
-			html_template=kwargs.pop('html_template', None) or computed_html_template,
-			project_css=current_app.config['APP_CSS'],
-			title=CONFIG_CUSTOMIZATION['title'],
-			app_name=current_app.config['APP_NAME'],
-			app_version=current_app.config['APP_VERSION'],
-			in_login_process=in_login_process,
-			is_private_app=current_app.config.get('IS_PRIVATE_APP', False),
-			favicon=favicon,
-			**kwargs
+		kwargs.update(variables)
+		for key, value in default_variables.items():
+			kwargs.setdefault(key, value)
+		kwargs['navigation'] = self._render_navigation(
+			kwargs.get('available_tabs'), kwargs.get('active_tab'), kwargs.get('available_sub_tabs'), kwargs.get('active_sub_tab'),
 		)
+		with timed('render'):
+			return render_template("index.html",
+				html_template=kwargs.pop('html_template', None) or computed_html_template,
+				project_css=current_app.config['APP_CSS'],
+				title=CONFIG_CUSTOMIZATION['title'],
+				app_name=current_app.config['APP_NAME'],
+				app_version=current_app.config['APP_VERSION'],
+				in_login_process=in_login_process,
+				is_private_app=current_app.config.get('IS_PRIVATE_APP', False),
+				favicon=favicon,
+				**kwargs
+			)
 
 
 site = Site()
@@ -113,22 +181,76 @@ def form_to_model_kwargs(form, model, filtered_keys=()):
 
 
 def build_buttons(buttons):
-	""" Filter the buttons according to the roles of the target they are pointing to """
-	built_buttons = []
-	for button in buttons:
-		target = button['target']
-		try:
-			authorized_roles = current_app.view_functions.get(target).roles
-		except AttributeError:
-			_LOGGER.warning("No role defined for this view, expect admin.")
-			authorized_roles = (ROLE_ADMIN, )
-		if not user_has_one_of_these_roles(current_user, authorized_roles):
-			continue
-		button = copy(button)
-		button['href'] = url_for(target)
-		built_buttons.append(button)
+	"""
+	Filter the buttons according to the roles of the target they are pointing to. The result is cached per role set and
+	buttons (including their texts, thus their locale) and must not be modified.
+
+	"""
+	role_set = get_role_set(current_user)
+
+	def builder():
+		built_buttons = []
+		for button in buttons:
+			if not permission_index.is_allowed(role_set, button['target']):
+				continue
+			button = copy(button)
+			button['href'] = url_for(button['target'])
+			built_buttons.append(button)
+		return tuple(built_buttons)
+
+	key = tuple((button['target'], button['i18n'], button.get('confirmation_message')) for button in buttons)
+	return permission_index.get_buttons(role_set, key, builder)
+
+
+def table_etag(models):
+	"""
+	The ETag of the table being requested, built from the versions of the tables of the *models* it displays (see
+	bump_table_version), the requested page, the user, the locale and the application's version. Cheap to compute: no row
+	is read.
+
+	"""
+	versions = sorted(get_table_versions(models).items())
+	key = f"{request.full_path}|{current_user.get_id()}|{get_locale()}|{current_app.config.get('APP_VERSION')}|{versions}"
+	return sha1(key.encode()).hexdigest()
+
 
-	return built_buttons
+def not_modified_response(etag):
+	response = current_app.response_class(status=304)
+	response.set_etag(etag)
+	return response
+
+
+def table_modified(model):
+	"""
+	Must be called after each modification of the *model*'s table by a query for refreshing the choices and tables
+	displaying it. It is called after the saves and deletions of the models' instances (see models.BaseModel).
+
+	"""
+	invalidate_choices(model)
+	bump_table_version(model)
+
+
+table_modified_listeners.append(table_modified)
+
+
+def table_response(table, total_count=None, streamed_request_result=None, etag=None):
+	"""
+	The JSON response of a table. The total count of a paginated table is given by the X-Total-Count header.
+	If *streamed_request_result* is set, the table's rows are built from it while the response is being sent instead of
+	being taken from the already built table (see Table.iter_json).
+
+	"""
+	if streamed_request_result is None:
+		with timed('json'):
+			response = jsonify(table.dict)
+	else:
+		response = current_app.response_class(stream_with_context(table.iter_json(streamed_request_result)), mimetype="application/json")
+	if total_count is not None:
+		response.headers['X-Total-Count'] = str(total_count)
+	if etag is not None:
+		response.set_etag(etag)
+		response.cache_control.no_cache = True
+	return response
 
 
 def page_forbidden(e, http_status=403):
@@ -167,10 +289,14 @@ def crud_page(table_name, crud_step,
 		form_factory = cur_table.get('form_factory')
 		row_title_builder = cur_table.get('row_title_builder')
 		fields_builder = cur_table.get('fields_builder')
+		is_streamed = cur_table.get('is_streamed', current_app.config.get('IS_TABLE_STREAMING', False))
 	except:
 		pass
 
 	if table_name and crud_step == "read":
+		etag = table_etag([model for model in (model_factory, *cur_table.get('depends_on', ())) if model is not None])
+		if etag in request.if_none_match:
+			return not_modified_response(etag)
 		table = Table(table_name, row_title_builder=row_title_builder, fields_builder=fields_builder)
 		query = query if query is not None else (model_factory
 			.select(model_factory.id, *columns)
@@ -178,12 +304,23 @@ def crud_page(table_name, crud_step,
 			.where(where_predicate)
 			.tuples()
 		)
-		table.build_from_request(TableRequestResult(columns, query))
+		query, total_count = TablePage.from_args(request.args).apply(query, columns)
+		request_result = TableRequestResult(columns, query)
 		table.buttons = (
 			{'href': join(url, table_name, "update"), 'i18n': _("Modify")},
 			{'href': join(url, table_name, "del"), 'i18n': _("Delete"), 'confirmation_message': _l("Confirm deletion ?")},
 		)
-		return jsonify(table.dict)
+		if is_streamed:
+			return table_response(table, total_count, streamed_request_result=request_result, etag=etag)
+		table.build_from_request(request_result)
+		return table_response(table, total_count, etag=etag)
+
+	fetched_resource = request.args.get('fetch', "")
+	if table_name and form_factory is not None and fetched_resource.endswith(".choices"):
+		field = form_factory.fields.get(fetched_resource.removesuffix(".choices"))
+		if isinstance(field, DatalistField):
+			limit = min(request.args.get('limit', 10, type=int), TYPEAHEAD_MAX_LIMIT)
+			return jsonify(field.search(request.args.get('q', ""), limit))
 
 	item_id = request.form.get('id', None) or request.args.get('id')
 	form = None
@@ -213,6 +350,7 @@ def crud_page(table_name, crud_step,
 						raise DatabaseException(f"Could not update {table_name} '%s'" % item_id)
 				except peewee.IntegrityError as e:
 					raise AbortException(description=str(e))
+				table_modified(model_factory)
 				return redirect(url)
 			else:
 				_LOGGER.info(f"Displaying form errors for {table_name} '%s'", ", ".join(["%s=%s" % (field.name, field.data) for field in form.fields.values()]))
@@ -221,6 +359,7 @@ def crud_page(table_name, crud_step,
 		query = model_factory.delete().where(model_factory.id == item_id)
 		if query.execute() != 1:
 			raise DatabaseException(f"Could not delete {table_name} '%s'" % item_id)
+		table_modified(model_factory)
 		return redirect(url)
 
 	return site.render_page(
@@ -243,6 +382,9 @@ def login():
 	form = LoginForm()
 	if request.method == 'POST':
 		if form.validate():
+			if password_hasher.needs_rehash(form.user.password):
+				_LOGGER.info("Rehashing user's '%s' password with cost %d", form.user.id, password_hasher.cost)
+				set_user_password(form.user.id, password_hasher.hash(form.password.data, keys=get_hashing_keys(form.user.username)))
 			login_user(User.get(username=form.username.data), remember=True)  # default value is , duration=timedelta(days=31)
 			session.permanent = True
 			next = request.args.get('next')
@@ -272,14 +414,61 @@ def users():
 @login_required
 @roles_required(ROLE_ADMIN)
 def users_table():
+	etag = table_etag([User])
+	if etag in request.if_none_match:
+		return not_modified_response(etag)
 	table = Table("users", row_title_builder=lambda row: f"{row[2]} {row[1]}")
-	table.build_from_request(get_users())
+	users = get_users()
+	users.query, total_count = TablePage.from_args(request.args).apply(users.query, users.model_fields_to_display)
 	table.buttons = build_buttons((
 		{'target': "user_views.user_modify_roles", 'i18n': _("Modify roles")},
 		{'target': "user_views.user_reset_password", 'i18n': _("Reset password")},
 		{'target': "user_views.user_del", 'i18n': _("Delete"), 'confirmation_message': _("Confirm deleting user ?")},
 	))
-	return jsonify(table.dict)
+	if current_app.config.get('IS_TABLE_STREAMING', False):
+		return table_response(table, total_count, streamed_request_result=users, etag=etag)
+	table.build_from_request(users)
+	return table_response(table, total_count, etag=etag)
+
+
+@user_views.route('/metrics/db_pool')
+@login_required
+@roles_required(ROLE_ADMIN)
+def db_pool_metrics():
+	database = flask_db.database
+	if not hasattr(database, 'get_metrics'):
+		abort(404)
+	return jsonify(database.get_metrics())
+
+
+@user_views.route('/choices/<form_path>/<field_name>')
+@login_required
+def children_choices(form_path, field_name):
+	"""
+	The children choices of all the parents of a DoubleSelectField declaring *children_choices*, revalidated by the
+	browsers with their ETag. The users need one of the field's *children_roles*.
+
+	"""
+	form_class = BaseForm.get_form_class(form_path)
+	field = form_class.fields.get(field_name) if form_class is not None else None
+	if not isinstance(field, DoubleSelectField) or field.children_choices is None:
+		abort(404)
+	if field.children_roles.isdisjoint(get_role_set(current_user)):
+		abort(403)
+	body, etag = field.get_children_json()
+	if etag in request.if_none_match:
+		return not_modified_response(etag)
+	response = current_app.response_class(body, mimetype="application/json")
+	response.set_etag(etag)
+	response.cache_control.no_cache = True
+	return response
+
+
+@user_views.route('/metrics/fragments')
+@login_required
+@roles_required(ROLE_ADMIN)
+def fragments_metrics():
+	return jsonify(fragment_cache.get_metrics())
 
 
 @user_views.route('/user/register', methods=['GET', 'POST'])
@@ -292,7 +481,7 @@ def user_register():
 		if form.validate():
 			create_user(
 				username=form.username.data,
-				password=hashpw(form.password.data.encode(), gensalt()),
+				password=password_hasher.hash(form.password.data, keys=get_hashing_keys(form.username.data)),
 				last_name=form.last_name.data,
 				first_name=form.first_name.data,
 				active=True,
@@ -327,6 +516,8 @@ def user_modify():
 			query = User.update(**form.dict).where(User.id == user_id)
 			if query.execute() != 1:
 				raise DatabaseException("Could not update user '%s'" % user_id)
+			user_cache.invalidate(user_id)
+			bump_table_version(User)
 			return redirect('/users' if current_user.is_admin else '/')
 	return site.render_page(
 		form=form
@@ -338,12 +529,10 @@ def user_modify():
 def user_modify_password():
 	form = ModifyPasswordForm()
 	if request.method == 'POST':
-		user_id = current_user.get_id()
+		user_id = current_user.get_id()  # Only one's own password, so its hashes are accounted to the current user
 		if form.validate():
 			_LOGGER.info("Modifying user's '%s' password", user_id)
-			query = User.update(password=hashpw(form.password.data.encode(), gensalt())).where(User.id == user_id)
-			if query.execute() != 1:
-				raise DatabaseException("Could not update user '%s'" % user_id)
+			set_user_password(user_id, password_hasher.hash(form.password.data, keys=get_hashing_keys(current_user.username)))
 			return redirect('/users' if current_user.is_admin else '/')
 	return site.render_page(
 		form=form
@@ -376,9 +565,7 @@ def user_reset_password():
 	user = get_user(user_id)
 	_LOGGER.info("Modifying '%s''s password", user_id)
 	temp_password = token_urlsafe()
-	query = User.update(password=hashpw(temp_password.encode(), gensalt())).where(User.id == user_id)
-	if query.execute() != 1:
-		raise DatabaseException("Could not update user '%s'" % user_id)
+	set_user_password(user_id, password_hasher.hash(temp_password, keys=get_hashing_keys(user.username)))
 	return site.render_page(temp_password=temp_password, firstname=user.first_name, lastname=user.last_name)
 
 